@@ -9,12 +9,16 @@
 # +-------------------------------------------------------------------
 from __future__ import absolute_import, print_function, division
 
+import hashlib
+import math
 import os
 import platform
 import random
 import re
 import string
+import subprocess
 import sys
+import threading
 import time
 import json
 
@@ -27,6 +31,11 @@ import oss2
 from oss2.exceptions import NoSuchKey, OssError, NotFound
 import public, db
 
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
 
 PROGRESS_FILE_NAME = "PROGRESS_FILE_NAME"
 
@@ -40,37 +49,101 @@ is_py3 = (_ver[0] == 3)
 if is_py2:
     reload(sys)
     sys.setdefaultencoding('utf-8')
+    from Queue import Queue, Empty
+else:
+    from queue import Queue, Empty
+
+
+class ProgressState(object):
+    """进度文件对应的内存状态
+
+    记录开始时间与最近一段时间的进度采样，用于计算滑动平均速度与剩余时间。
+    """
+
+    # 进度文件最短写入间隔(秒)
+    FLUSH_INTERVAL = 0.5
+    # 滑动平均速度的采样窗口(秒)
+    SPEED_WINDOW = 5
+
+    def __init__(self, start_time):
+        self.start_time = start_time
+        self.samples = []
+        self.last_flush = 0
+
+    def add_sample(self, now, consumed_bytes):
+        self.samples.append((now, consumed_bytes))
+        while len(self.samples) > 2 and \
+                now - self.samples[1][0] >= self.SPEED_WINDOW:
+            self.samples.pop(0)
+
+    def get_speed(self):
+        """滑动窗口内的平均速度(字节/秒)"""
+        if len(self.samples) < 2:
+            return 0
+        (t0, b0), (t1, b1) = self.samples[0], self.samples[-1]
+        if t1 <= t0:
+            return 0
+        return (b1 - b0) / (t1 - t0)
+
+
+_progress_states = {}
+_progress_lock = threading.Lock()
 
 
 def report_progress(consumed_bytes, total_bytes):
     """上传进度回调函数
 
     本函数依赖系统环境变量 PROGRESS_FILE_NAME 所指定的文件，进度信息会写入到该文件当中
+    进度状态保存在内存中，进度文件每FLUSH_INTERVAL秒最多写入一次，开始与结束时总是写入。
     进度格式:
     上传百分比|速度(Mb/s)|时间(s)|上传字节|总字节|开始时间戳
+    速度为最近SPEED_WINDOW秒的滑动平均值，标准输出额外显示预计剩余时间。
     :param consumed_bytes: 已上传字节数
     :param total_bytes: 总字节数
     """
-    import public
     p_file = os.environ[PROGRESS_FILE_NAME]
-    rate = int(100 * (float(consumed_bytes) / float(total_bytes)))
-    if consumed_bytes == 0:
-        start_time = time.time()
-    else:
-        p_text = public.readFile(p_file)
-        if not p_text:
-            return
-        start_time = float(p_text.split("|")[-1])
     now = time.time()
-    diff = round(now - start_time, 2)
-    speed = round(consumed_bytes / diff / 1024 / 1024, 2) if diff > 0 else 0
+    finished = consumed_bytes == total_bytes
+    with _progress_lock:
+        state = _progress_states.get(p_file)
+        if consumed_bytes == 0 or state is None:
+            start_time = now
+            if consumed_bytes != 0:
+                # 续传时沿用进度文件中记录的开始时间
+                try:
+                    start_time = float(
+                        public.readFile(p_file).split("|")[-1])
+                except Exception:
+                    pass
+            state = ProgressState(start_time)
+            _progress_states[p_file] = state
+        state.add_sample(now, consumed_bytes)
+        if not finished and consumed_bytes != 0 and \
+                now - state.last_flush < state.FLUSH_INTERVAL:
+            return
+        state.last_flush = now
+        if finished:
+            del _progress_states[p_file]
+
+    rate = int(100 * (float(consumed_bytes) / float(total_bytes))) \
+        if total_bytes else 100
+    diff = round(now - state.start_time, 2)
+    speed = state.get_speed()
+    if not speed and diff > 0:
+        speed = consumed_bytes / diff
     progress_text = "{0}%|{1}Mb/s|{2}|{3}|{4}|{5}".format(
-        rate, speed, diff, consumed_bytes, total_bytes, start_time
+        rate, round(speed / 1024 / 1024, 2), diff, consumed_bytes,
+        total_bytes, state.start_time
     )
-    if consumed_bytes == total_bytes:
+    if finished:
         progress_text += "\n"
     public.writeFile(p_file, progress_text)
-    sys.stdout.write("\r" + progress_text)
+    eta = ""
+    if not finished and speed > 0:
+        eta = " 剩余{}秒".format(
+            int((total_bytes - consumed_bytes) / speed))
+    sys.stdout.write("\r" + progress_text.rstrip("\n") + eta +
+                     ("\n" if finished else ""))
     sys.stdout.flush()
 
 
@@ -149,6 +222,30 @@ def verify_dir_name(dir_name):
     return True
 
 
+def find_executable(name):
+    """在PATH中查找可执行文件
+
+    :return: 可执行文件路径/None未找到
+    """
+    paths = os.getenv("PATH", "").split(os.pathsep)
+    paths += ["/usr/local/bin", "/usr/bin", "/bin"]
+    for p in paths:
+        exe = os.path.join(p, name)
+        if os.path.isfile(exe) and os.access(exe, os.X_OK):
+            return exe
+    return None
+
+
+# 压缩方式: (扩展名, 压缩命令, 解压命令, 依赖的可执行文件)
+# pigz输出为标准gzip格式，tar xzf 可直接解压
+COMPRESSORS = {
+    "gzip": (".tar.gz", "gzip -c", "gzip -dc", "gzip"),
+    "pigz": (".tar.gz", "pigz -c -p {threads}", "pigz -dc", "pigz"),
+    "zstd": (".tar.zst", "zstd -q -c -T{threads}", "zstd -q -dc", "zstd"),
+    "none": (".tar", "", "cat", None),
+}
+
+
 """
 =============自定义异常===================
 """
@@ -193,6 +290,60 @@ class OSClient(object):
     _exclude = ""
     _db_mysql = None
     _err_log = '/tmp/backup_err.log'
+    # 流式备份：打包输出直接分片上传，不在本地生成压缩包
+    stream_backup = False
+    # 压缩方式，参见COMPRESSORS；压缩线程数，0表示使用全部CPU核心
+    compress_type = "gzip"
+    compress_threads = 0
+    # 批量备份并发数：同时进行的备份任务/压缩阶段/上传阶段
+    backup_workers = 1
+    compress_workers = 1
+    upload_workers = 1
+    # 数据库按表并行导出，每张表一个压缩对象
+    parallel_dump = False
+    dump_workers = 4
+    # 并发调度时由BackupScheduler设置的阶段并发限制
+    _stage_slots = None
+    # 最近一次备份上传的字节数，失败时为None
+    last_backup_size = None
+    # 定期取消过期的分片上传：检查间隔与分片上传的最长保留时间(小时)，0表示不自动清理
+    reap_interval = 24
+    reap_age = 24
+    # 批量备份期间延迟清理过期备份，全部完成后统一批量删除
+    _defer_cleanup = False
+    _expired_backups = None
+    _mypass_lock = threading.Lock()
+    # 备份源目录大小缓存的有效期(秒)，过期后才重新遍历目录统计
+    SOURCE_SIZE_TTL = 86400
+    _source_size_lock = threading.Lock()
+    _mypass_users = 0
+    # 增量备份：按文件清单只上传变化的文件，每N次备份做一次全量备份
+    incremental_backup = False
+    incremental_full_every = 7
+    incremental_hash = False
+    _exclude_list = []
+    # 目录备份去重：按内容分块存储，相同数据块只保存一份
+    dedup_backup = False
+    dedup_chunk_size = 1024 * 1024
+    # 可检索压缩包：按块压缩并生成成员索引，可以只下载需要的部分还原单个文件
+    seekable_archive = False
+    # 限速：上传总速度(KB/s)，压缩/导出进程的nice值(1-19)与IO优先级(1-7)，
+    # 0表示不限制；throttle_schedule按时间段覆盖，如
+    # [{"time": "09:00-18:00", "upload_limit": 2048, "nice": 19, "ionice": 7}]
+    upload_limit = 0
+    nice_level = 0
+    ionice_level = 0
+    throttle_schedule = []
+    # 客户端加密：密钥文件路径(相对路径基于插件目录)，为空表示不加密
+    encrypt_key_file = ""
+    _cipher = None
+    # 分片上传参数，0表示根据文件大小与历史上传速度自动计算
+    upload_part_size = 0
+    upload_threads = 0
+    MIN_PART_SIZE = 1024 * 1024 * 2
+    MAX_PART_SIZE = 1024 * 1024 * 1024 * 5
+    MAX_PARTS = 10000
+    TARGET_PARTS = 1000
 
     def __init__(self, load_config=True, config_file=None):
         if config_file:
@@ -233,7 +384,7 @@ class OSClient(object):
         """
         return self.auth
 
-    def get_list(self, path="/"):
+    def get_list(self, path="/", with_url=False):
         """子类实现获取文件列表
 
         参考以下字段返回文件列表
@@ -265,6 +416,85 @@ class OSClient(object):
         """断点续传子类实现"""
         raise RuntimeError("不支持上传操作！")
 
+    def stream_upload(self, stream, object_name, *args, **kwargs):
+        """流式分片上传子类实现
+
+        :return: 上传的字节数/False上传失败
+        """
+        raise RuntimeError("不支持流式上传操作！")
+
+    def dedup_upload(self, stream, object_name, *args, **kwargs):
+        """去重分块上传子类实现
+
+        :return: 数据总字节数/False上传失败
+        """
+        raise RuntimeError("不支持去重备份！")
+
+    def dedup_gc(self):
+        """清理没有被任何快照引用的数据块，子类实现"""
+        return 0, 0
+
+    def open_upload_stream(self, object_name, size_hint=0, num_threads=None):
+        """打开对象的流式写入，子类实现
+
+        :return: 支持write/close/abort的写入对象，close返回上传的字节数
+        """
+        raise RuntimeError("不支持流式上传操作！")
+
+    def read_object(self, object_name):
+        """读取对象内容，子类实现
+
+        :return: 支持read(size)的文件对象
+        """
+        raise RuntimeError("不支持读取文件对象！")
+
+    def delete_prefix(self, prefix):
+        """删除指定前缀下的所有对象，子类实现"""
+        raise RuntimeError("文件无法被删除！")
+
+    def delete_objects(self, object_names):
+        """批量删除对象，子类可使用批量删除接口覆盖
+
+        :return: 删除失败的对象名称列表
+        """
+        return [o for o in object_names if not self.delete_object(o)]
+
+    def list_prefix_keys(self, prefix):
+        """列出指定前缀下的所有对象名称，子类实现"""
+        return []
+
+    def read_object_range(self, object_name, start, end):
+        """读取对象[start, end]范围内的数据，子类实现
+
+        :return: 支持read(size)的文件对象
+        """
+        raise RuntimeError("不支持读取文件对象！")
+
+    def open_range_reader(self, object_name):
+        """并发分片读取对象，子类实现
+
+        :return: 支持read(size)/close的文件对象
+        """
+        raise RuntimeError("不支持读取文件对象！")
+
+    def iter_dedup_data(self, object_name):
+        """按顺序读取去重快照的数据，子类实现"""
+        raise RuntimeError("不支持去重备份！")
+
+    def reap_uploads(self, max_age, dry_run=False):
+        """取消过期的分片上传，子类实现
+
+        :return: {"count": 数量, "size": 释放的字节数, "failed": 失败数}
+        """
+        return {"count": 0, "size": 0, "failed": 0}
+
+    def get_object_index(self):
+        """远程对象的本地索引，子类实现
+
+        :return: ObjectIndex/None不支持索引
+        """
+        return None
+
     def delete_object_by_os(self, object_name):
         """OS客户端实现删除操作"""
         raise RuntimeError("文件无法被删除！")
@@ -351,6 +581,211 @@ class OSClient(object):
 
         return object_name
 
+    def get_index_prefix(self):
+        """对象索引覆盖的前缀，即备份目录"""
+        prefix = self.backup_path or ""
+        if prefix[:1] == "/":
+            prefix = prefix[1:]
+        return prefix
+
+    def index_put(self, object_name, size, etag=None, crc64=None):
+        """上传完成后写入对象索引，索引出错不影响上传结果"""
+        try:
+            index = self.get_object_index()
+            if index and object_name.startswith(self.get_index_prefix()):
+                index.put(object_name, size, etag, crc64)
+        except Exception as e:
+            print("更新对象索引失败：" + str(e))
+
+    def index_remove(self, object_names):
+        try:
+            index = self.get_object_index()
+            if index:
+                index.remove(object_names)
+        except Exception as e:
+            print("更新对象索引失败：" + str(e))
+
+    def index_remove_prefix(self, prefix):
+        try:
+            index = self.get_object_index()
+            if index:
+                index.remove_prefix(prefix)
+        except Exception as e:
+            print("更新对象索引失败：" + str(e))
+
+    def get_ready_index(self, path=None):
+        """已完成至少一轮同步且覆盖path的对象索引，否则返回None"""
+        try:
+            index = self.get_object_index()
+            if not index or not index.is_ready():
+                return None
+        except Exception:
+            return None
+        if path is not None and not path.startswith(self.get_index_prefix()):
+            return None
+        return index
+
+    def sync_object_index(self, max_pages=0):
+        """同步对象索引，已有同步进程在运行时直接返回
+
+        :return: True本轮同步完成/False未完成
+        """
+        import fcntl
+        index = self.get_object_index()
+        if not index:
+            return False
+        with open(index.db_file + ".lock", "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return False
+            return index.sync(self.get_bucket(), self.get_index_prefix(),
+                              max_pages=max_pages)
+
+    def start_index_sync(self, interval=300):
+        """距上次同步超过interval秒时，在后台进程中同步对象索引"""
+        try:
+            index = self.get_object_index()
+            if not index or time.time() - float(
+                    index.get_meta("sync_requested", 0)) < interval:
+                return False
+            index.set_meta("sync_requested", time.time())
+        except Exception as e:
+            print("对象索引不可用：" + str(e))
+            return False
+        script = os.path.join(self.get_base_path(), "plugin", self._name,
+                              self._name + "_main.py")
+        public.ExecShell("nohup {} {} sync_index >/dev/null 2>&1 &".format(
+            sys.executable, script))
+        return True
+
+    def drop_missing_backups(self, backups):
+        """去除对象已不存在的备份记录
+
+        依据对象索引判断。只处理在最近一次完整同步开始之前添加的记录，
+        避免把尚未同步到索引的新备份误判为丢失；对象不在索引覆盖的备份目录下
+        （如修改备份目录前的记录）时无法判断，保留记录。
+        :param backups: 备份记录，需要包含id,filename,addtime字段
+        :return: 对象仍然存在的备份记录
+        """
+        index = self.get_ready_index()
+        if not index:
+            return backups
+        synced_since = index.get_synced_since()
+        prefix = self.get_index_prefix()
+        object_names = {}
+        for backup in backups:
+            tags = backup["filename"].split(self.CONFIG_SEPARATOR)
+            if len(tags) < 2 or not tags[0].startswith(prefix):
+                continue
+            try:
+                add_time = time.mktime(time.strptime(backup["addtime"],
+                                                     "%Y/%m/%d %H:%M:%S"))
+            except Exception:
+                continue
+            if add_time < synced_since:
+                object_names[backup["id"]] = tags[0]
+        existing = index.exists(object_names.values())
+        result = []
+        for backup in backups:
+            object_name = object_names.get(backup["id"])
+            if object_name is not None and object_name not in existing:
+                db.Sql().table('backup').where('id=?',
+                                               (backup['id'],)).delete()
+                self.echo_info("备份文件已不存在，移除备份记录：" + object_name)
+                continue
+            result.append(backup)
+        return result
+
+    def find_orphans(self):
+        """查找没有任何备份记录引用的备份对象
+
+        去重数据块由快照索引引用，按表导出的表对象由清单引用，均不视为孤立对象。
+        :return: [{"key": 对象名称, "size": 大小}]
+        """
+        index = self.get_ready_index()
+        if not index:
+            raise OsError("对象索引尚未同步完成，请稍后再试。")
+        rows = db.Sql().table('backup').where(
+            'filename LIKE ?', ('%' + self.CONFIG_SEPARATOR + self._name + '%',)
+        ).field('filename').select()
+        referenced = set()
+        table_prefixes = []
+        for row in rows:
+            object_name = row["filename"].split(self.CONFIG_SEPARATOR)[0]
+            referenced.add(object_name)
+            referenced.add(object_name + SeekableArchiveWriter.INDEX_SUFFIX)
+            if object_name.endswith(ParallelDumper.MANIFEST_SUFFIX):
+                table_prefixes.append(
+                    ParallelDumper.get_tables_prefix(object_name))
+        prefix = self.get_index_prefix()
+        chunk_prefix = prefix + DedupStore.CHUNK_DIR
+        orphans = []
+        for key, size in index.iter_keys(prefix):
+            if key in referenced or key.endswith("/") or \
+                    key.startswith(chunk_prefix):
+                continue
+            if any(key.startswith(p) for p in table_prefixes):
+                continue
+            orphans.append({"key": key, "size": size})
+        return orphans
+
+    def get_upload_stats_file(self):
+        return os.path.join(self.get_setup_path(), "upload_stats.json")
+
+    def get_upload_speed(self):
+        """历史单线程平均上传速度(字节/秒)，没有记录时返回0"""
+        try:
+            stats = json.loads(public.readFile(self.get_upload_stats_file()))
+            return float(stats.get("thread_speed", 0))
+        except Exception:
+            return 0
+
+    def record_upload_speed(self, size, seconds, threads):
+        """记录本次上传的单线程速度，与历史速度取平均"""
+        if size < self.MIN_PART_SIZE or seconds <= 0:
+            return
+        speed = float(size) / seconds / max(1, threads)
+        old_speed = self.get_upload_speed()
+        if old_speed > 0:
+            speed = (old_speed + speed) / 2
+        public.writeFile(self.get_upload_stats_file(),
+                         json.dumps({"thread_speed": speed,
+                                     "time": int(time.time())}))
+
+    def get_upload_params(self, file_size):
+        """根据文件大小与历史上传速度计算分片参数
+
+        分片大小使分片数接近TARGET_PARTS且不超过MAX_PARTS，小文件保持MIN_PART_SIZE；
+        单线程速度越低(高延迟链路)使用越多的并发线程。配置中的值优先。
+        :param file_size: 文件大小
+        :return: (分片大小, 分片上传阈值, 并发线程数)
+        """
+        part_size = self.upload_part_size
+        if not part_size:
+            part_size = -(-file_size // self.TARGET_PARTS)
+            # 按MB对齐
+            part_size = -(-part_size // (1024 * 1024)) * 1024 * 1024
+        part_size = max(part_size, -(-file_size // self.MAX_PARTS),
+                        self.MIN_PART_SIZE)
+        part_size = min(part_size, self.MAX_PART_SIZE)
+
+        threads = self.upload_threads
+        if not threads:
+            speed = self.get_upload_speed()
+            if not speed:
+                threads = 8
+            elif speed < 1024 * 1024 * 2:
+                threads = 16
+            elif speed < 1024 * 1024 * 10:
+                threads = 8
+            else:
+                threads = 4
+            threads = min(threads, max(1, -(-file_size // part_size)))
+
+        multipart_threshold = max(part_size, 1024 * 1024 * 8)
+        return part_size, multipart_threshold, threads
+
     def upload_file(self, file_name, data_type=None, *args, **kwargs):
         """按照数据类型上传文件
 
@@ -376,6 +811,13 @@ class OSClient(object):
             temp_name = os.path.split(file_name)[1]
             object_name = self.build_object_name(data_type, temp_name)
 
+            if self.get_cipher():
+                # 加密备份：读取文件的同时加密并分片上传，不生成加密的中间文件
+                with open(file_name, "rb") as f:
+                    return self.stream_upload(
+                        f, object_name,
+                        size_hint=os.path.getsize(file_name)) is not False
+
             return self.resumable_upload(file_name,
                                          object_name=object_name,
                                          *args,
@@ -386,6 +828,54 @@ class OSClient(object):
             self.error_msg += "文件上传出现错误：{}".format(str(e))
             return False
 
+    def upload_command_output(self, command, data_type, file_name,
+                              ok_codes=(0,), dedup=False, size_hint=0,
+                              seekable=False):
+        """执行命令并将其标准输出直接流式上传
+
+        命令通过bash执行并开启pipefail，管道中任意一个命令失败都会被识别。
+        :param command: 产生备份数据的shell命令
+        :param data_type: 数据类型 site/database/path
+        :param file_name: 备份文件名称，用于构建对象名称
+        :param ok_codes: 视为成功的命令退出码
+        :param dedup: 使用去重分块存储，file_name对应快照索引对象
+        :param size_hint: 预估的数据大小，用于计算分片参数
+        :param seekable: 命令输出未压缩的tar数据，上传为可检索压缩包
+        :return: 上传的字节数/False上传失败
+        """
+        self.error_msg = ""
+        object_name = self.build_object_name(data_type, file_name)
+        process = subprocess.Popen("set -o pipefail; " + command,
+                                   shell=True,
+                                   executable="/bin/bash",
+                                   stdout=subprocess.PIPE)
+        size = False
+        try:
+            if dedup:
+                size = self.dedup_upload(process.stdout, object_name)
+            elif seekable:
+                size = self.seekable_upload(process.stdout, object_name,
+                                            size_hint=size_hint)
+            else:
+                size = self.stream_upload(process.stdout, object_name,
+                                          size_hint=size_hint)
+        except Exception as e:
+            self.error_msg = "文件上传出现错误：{}".format(str(e))
+        finally:
+            process.stdout.close()
+            return_code = process.wait()
+
+        if size is False:
+            return False
+        if return_code not in ok_codes:
+            self.error_msg = "备份命令执行失败，退出码：{}".format(return_code)
+            self.delete_object(object_name)
+            if seekable:
+                self.delete_object(
+                    object_name + SeekableArchiveWriter.INDEX_SUFFIX)
+            return False
+        return size
+
     def delete_object(self, object_name, retries=2):
         """删除对象
 
@@ -440,7 +930,9 @@ class OSClient(object):
             self.echo_end()
             return;
 
-        p_size = public.get_path_size(path)
+        # 增量备份扫描文件清单时会得到准确的大小，本地打包需要准确的大小检查磁盘空间
+        p_size = self.get_source_size(
+            path, refresh=not self.stream_backup and not self.incremental_backup)
         self.echo_info("目录大小：{}".format(public.to_size(p_size)))
 
         backup_path = sql.table('config').where("id=?", (1,)).getField(
@@ -448,67 +940,139 @@ class OSClient(object):
         if not os.path.exists(backup_path): public.ExecShell(
             "mkdir -p " + backup_path);
 
-        base_file_name = "web_" + name + "_" + time.strftime(
-            '%Y%m%d_%H%M%S', time.localtime()) + '.tar.gz'
-        filename = backup_path + "/" + base_file_name
-
         self.get_exclude(exclude)
         exclude_config = self._exclude
         if not self._exclude:
             exclude_config = "未设置"
 
-        disk_path, disk_free, disk_inode = self.get_disk_free(filename)
-        self.echo_info("分区{}可用磁盘空间为：{}，可用Inode为：{}".format(
-            disk_path,
-            public.to_size(disk_free),
-            disk_inode))
-        if disk_path:
-            if disk_free < p_size:
-                self.echo_error(
-                    "目标分区可用的磁盘空间小于{},无法完成备份，请增加磁盘容量，或在设置页面更改默认备份目录!".format(
-                        public.to_size(p_size)))
-                return False
-
-            if disk_inode < self._inode_min:
-                self.echo_error(
-                    "目标分区可用的Inode小于{},无法完成备份，请增加磁盘容量，或在设置页面更改默认备份目录!".format(
-                        self._inode_min))
-                return False
-
-        public.ExecShell("cd " +
-                         os.path.dirname(path) +
-                         " && tar zcvf '" + filename +
-                         "' " + self._exclude + " '" +
-                         os.path.basename(path) +
-                         "' 2>{err_log} 1> /dev/null".format(
-                             err_log=self._err_log))
-        endDate = time.strftime('%Y/%m/%d %X', time.localtime())
-
-        if not os.path.exists(filename):
-            log = "网站[" + name + "]备份失败!"
-            self.echo_error("★[" + endDate + "] " + log)
-            self.echo_end()
-            return;
+        compress_type, ext, _ = self.get_compressor()
+        if self.seekable_archive:
+            compress_type, ext = "gzip(可检索)", ".tar.gz"
+        self.echo_info("压缩方式：{}".format(compress_type))
+
+        tar_options = {}
+        incremental = None
+        if self.incremental_backup:
+            incremental = self.prepare_incremental(name, path)
+            # 扫描文件清单时已得到准确的目录大小
+            p_size = sum(e[0] for e in incremental["files"].values())
+            if incremental["mode"] == "incr":
+                self.echo_info("增量备份：基于全量备份{}，新增/修改文件{}个，删除文件{}个".format(
+                    incremental["full"], len(incremental["changed"]),
+                    len(incremental["deleted"])))
+                if not incremental["changed"] and not incremental["deleted"]:
+                    self.echo_info("网站文件没有变化，跳过本次备份")
+                    self.clean_incremental(incremental)
+                    self.last_backup_size = 0
+                    self.echo_end()
+                    return None
+                ext = ".incr" + ext
+                tar_options = {
+                    "file_list": incremental["list_file"],
+                    "extra_file": incremental["deleted_file"],
+                }
+            else:
+                self.echo_info("增量备份：本次进行全量备份")
 
-        self.echo_info("站点已备份到:" + filename)
+        base_file_name = "web_" + name + "_" + time.strftime(
+            '%Y%m%d_%H%M%S', time.localtime()) + ext
+        filename = backup_path + "/" + base_file_name
 
-        # 上传文件
-        self.echo_info("正在上传到{}，请稍候...".format(self._title))
-        if self.upload_file(filename, data_type=data_type):
+        if self.stream_backup:
+            # 流式备份：打包数据边压缩边上传
+            self.echo_info("正在打包并流式上传到{}，请稍候...".format(self._title))
+            with self.stage("compress"), self.stage("upload"):
+                backup_size = self.upload_command_output(
+                    self.build_tar_command(
+                        path, compress=not self.seekable_archive,
+                        **tar_options),
+                    data_type, base_file_name, ok_codes=(0, 1),
+                    size_hint=p_size, seekable=self.seekable_archive)
+            endDate = time.strftime('%Y/%m/%d %X', time.localtime())
+            if backup_size is False:
+                log = "网站[" + name + "]备份失败!"
+                self.echo_error("★[" + endDate + "] " + log)
+                self.echo_info(self.error_msg)
+                self.clean_incremental(incremental)
+                self.echo_end()
+                return False
             self.echo_info("已成功上传到{}".format(self._title))
         else:
-            self.echo_error('错误：文件上传失败，跳过本次备份!')
-            if os.path.exists(filename):
-                os.remove(filename)
-            return False
+            disk_path, disk_free, disk_inode = self.get_disk_free(filename)
+            self.echo_info("分区{}可用磁盘空间为：{}，可用Inode为：{}".format(
+                disk_path,
+                public.to_size(disk_free),
+                disk_inode))
+            if disk_path:
+                if disk_free < p_size:
+                    self.echo_error(
+                        "目标分区可用的磁盘空间小于{},无法完成备份，请增加磁盘容量，或在设置页面更改默认备份目录!".format(
+                            public.to_size(p_size)))
+                    self.clean_incremental(incremental)
+                    return False
+
+                if disk_inode < self._inode_min:
+                    self.echo_error(
+                        "目标分区可用的Inode小于{},无法完成备份，请增加磁盘容量，或在设置页面更改默认备份目录!".format(
+                            self._inode_min))
+                    self.clean_incremental(incremental)
+                    return False
+
+            archive_index = None
+            with self.stage("compress"):
+                if self.seekable_archive:
+                    archive_index = self.build_seekable_archive(
+                        self.build_tar_command(path, compress=False,
+                                               **tar_options), filename)
+                else:
+                    self.build_archive(
+                        self.build_tar_command(path, filename, **tar_options),
+                        filename)
+            self.clean_incremental(incremental)
+            endDate = time.strftime('%Y/%m/%d %X', time.localtime())
+
+            if not os.path.exists(filename):
+                log = "网站[" + name + "]备份失败!"
+                self.echo_error("★[" + endDate + "] " + log)
+                self.echo_info(self.error_msg)
+                self.echo_info(public.readFile(self._err_log))
+                self.echo_end()
+                return;
+
+            self.echo_info("站点已备份到:" + filename)
+
+            # 上传文件
+            self.echo_info("正在上传到{}，请稍候...".format(self._title))
+            with self.stage("upload"):
+                uploaded = self.upload_file(filename, data_type=data_type)
+                if uploaded and archive_index:
+                    self.write_archive_index(
+                        self.build_object_name(data_type, base_file_name),
+                        archive_index)
+            if uploaded:
+                self.echo_info("已成功上传到{}".format(self._title))
+            else:
+                self.echo_error('错误：文件上传失败，跳过本次备份!')
+                if os.path.exists(filename):
+                    os.remove(filename)
+                return False
+            backup_size = os.path.getsize(filename)
 
         object_name = self.build_object_name(data_type, base_file_name)
         outTime = time.time() - startTime
         db_filename = object_name + self.CONFIG_SEPARATOR + self._name
+        if incremental:
+            self.clean_incremental(incremental)
+            self.save_incremental(name, incremental, base_file_name)
+            if incremental["mode"] == "incr":
+                # 增量备份记录所属的全量备份: 对象名|插件名|incr|全量备份名
+                db_filename += self.CONFIG_SEPARATOR + "incr" + \
+                               self.CONFIG_SEPARATOR + incremental["full"]
         pid = sql.table('sites').where('name=?', (name,)).getField('id');
         sql.table('backup').add('type,name,pid,filename,addtime,size', (
             '0', base_file_name, pid, db_filename, endDate,
-            os.path.getsize(filename)))
+            backup_size))
+        self.last_backup_size = backup_size
         log = "网站[" + name + "]已成功备份到" + self._title + ",用时[" + str(
             round(outTime, 2)) + "]秒";
         public.WriteLog('计划任务', log)
@@ -524,30 +1088,11 @@ class OSClient(object):
         backups = sql.table('backup').where(
             'type=? and pid=? and '
             'filename LIKE \'%{}%\''.format(self._name),
-            ('0', pid)).field('id,name,filename').select();
-
-        num = len(backups) - int(count)
-        if num > 0:
-            for backup in backups:
-                _base_file_name = backup["name"]
-                _local_file_name = os.path.join(backup_path,
-                                                _base_file_name)
-
-                if os.path.isfile(_local_file_name):
-                    public.ExecShell("rm -f " + _local_file_name);
-                    self.echo_info("已清理本地备份文件:" + _local_file_name)
+            ('0', pid)).field('id,name,filename,addtime').select();
+        backups = self.drop_missing_backups(backups)
 
-                _file_name = backup["filename"]
-                if _file_name.find(self.CONFIG_SEPARATOR) != -1:
-                    os_file_name = _file_name.split(self.CONFIG_SEPARATOR)[0]
-                else:
-                    os_file_name = _file_name
-                self.delete_object(os_file_name)
-                sql.table('backup').where('id=?', (backup['id'],)).delete();
-                num -= 1;
-                self.echo_info("已清理{}过期备份文件：".format(self._title) +
-                               os_file_name)
-                if num < 1: break;
+        self.expire_backups(self.get_expired_backups(backups, count),
+                            backup_path)
 
         if os.path.exists(self._err_log):
             os.remove(self._err_log)
@@ -556,6 +1101,17 @@ class OSClient(object):
 
     # 配置
     def mypass(self, act, root):
+        # 并发备份数据库时，仅在第一个任务开始和最后一个任务结束时修改my.cnf
+        with OSClient._mypass_lock:
+            if act:
+                OSClient._mypass_users += 1
+                if OSClient._mypass_users > 1: return True
+            else:
+                OSClient._mypass_users = max(0, OSClient._mypass_users - 1)
+                if OSClient._mypass_users > 0: return True
+            return self.__mypass(act, root)
+
+    def __mypass(self, act, root):
         conf_file = '/etc/my.cnf'
         public.ExecShell("sed -i '/user=root/d' {}".format(conf_file))
         public.ExecShell("sed -i '/password=/d' {}".format(conf_file))
@@ -609,68 +1165,133 @@ class OSClient(object):
         if not os.path.exists(backup_path): public.ExecShell(
             "mkdir -p " + backup_path);
 
+        # 数据库导出文件固定为.sql.gz，面板的数据库备份列表与恢复只识别该格式
+        compress_type, ext, compress_command = self.get_compressor(
+            gzip_only=True)
+        self.echo_info("压缩方式：{}".format(compress_type))
         base_file_name = "db_" + name + "_" + time.strftime(
-            '%Y%m%d_%H%M%S', time.localtime()) + ".sql.gz"
+            '%Y%m%d_%H%M%S', time.localtime()) + ext.replace(".tar", ".sql")
         filename = os.path.join(backup_path, base_file_name)
-
-        disk_path, disk_free, disk_inode = self.get_disk_free(filename)
-        self.echo_info("分区{}可用磁盘空间为：{}，可用Inode为：{}".format(
-            disk_path,
-            public.to_size(disk_free),
-            disk_inode))
-        if disk_path:
-            if disk_free < p_size:
-                self.echo_error(
-                    "目标分区可用的磁盘空间小于{},无法完成备份，请增加磁盘容量，或在设置页面更改默认备份目录!".format(
-                        public.to_size(p_size)))
-                return False
-
-            if disk_inode < self._inode_min:
-                self.echo_error(
-                    "目标分区可用的Inode小于{},无法完成备份，请增加磁盘容量，或在设置页面更改默认备份目录!".format(
-                        self._inode_min))
-                return False
-
-        stime = time.time()
-        self.echo_info("开始导出数据库：{}".format(public.format_date(times=stime)))
-
-        if os.path.exists(filename):
-            os.remove(filename)
+        dump_command = self.get_priority_prefix() + \
+                       "/www/server/mysql/bin/mysqldump " \
+                       "--default-character-set=" + character + \
+                       " --force --opt " + name + \
+                       " 2>{err_log}".format(err_log=self._err_log)
+        if compress_command:
+            dump_command += " | " + compress_command
 
         mysql_root = sql.table('config').where("id=?", (1,)).getField(
             'mysql_root')
-        self.mypass(True, mysql_root)
-
-        public.ExecShell(
-            "/www/server/mysql/bin/mysqldump --default-character-set=" +
-            character + " --force --opt " + name + " | gzip > " + filename)
-
-        self.mypass(False, mysql_root)
+        stime = time.time()
+        parallel_dump = self.parallel_dump
+        if parallel_dump and is_py2:
+            self.echo_info("按表并行导出需要Python3，使用mysqldump导出")
+            parallel_dump = False
+        if parallel_dump:
+            # 按表并行导出：每张表一个压缩对象，清单对象记录所有表
+            base_file_name = base_file_name[:-len(
+                ext.replace(".tar", ".sql"))] + ParallelDumper.MANIFEST_SUFFIX
+            filename = os.path.join(backup_path, base_file_name)
+            self.echo_info("开始按表并行导出数据库并上传到{}，并发数：{}：{}".format(
+                self._title, self.dump_workers,
+                public.format_date(times=stime)))
+            dumper = ParallelDumper(self, name, character, mysql_root,
+                                    workers=self.dump_workers)
+            try:
+                with self.stage("compress"), self.stage("upload"):
+                    gz_size = dumper.dump(
+                        self.build_object_name(data_type, base_file_name))
+            except Exception as e:
+                self.error_msg = "数据库导出失败：{}".format(e)
+                gz_size = False
+            if gz_size is False:
+                endDate = time.strftime('%Y/%m/%d %X', time.localtime())
+                log = "数据库[" + name + "]备份失败!"
+                self.echo_error("★[" + endDate + "] " + log)
+                self.echo_info(self.error_msg)
+                self.echo_end()
+                return False
+            self.echo_info("已成功上传到{}，耗时{:.2f}秒，压缩后总大小：{}".format(
+                self._title, time.time() - stime, public.to_size(gz_size)))
+        elif self.stream_backup:
+            # 流式备份：导出数据边压缩边上传，以mysqldump的退出码判断是否成功
+            self.echo_info("开始导出数据库并流式上传到{}：{}".format(
+                self._title, public.format_date(times=stime)))
+            self.mypass(True, mysql_root)
+            try:
+                with self.stage("compress"), self.stage("upload"):
+                    gz_size = self.upload_command_output(
+                        dump_command, data_type, base_file_name,
+                        size_hint=p_size)
+            finally:
+                self.mypass(False, mysql_root)
+            if gz_size is False:
+                endDate = time.strftime('%Y/%m/%d %X', time.localtime())
+                log = "数据库[" + name + "]备份失败!"
+                self.echo_error("★[" + endDate + "] " + log)
+                self.echo_info(self.error_msg)
+                self.echo_info(public.readFile(self._err_log))
+                self.echo_end()
+                return False
+            self.echo_info("已成功上传到{}，耗时{:.2f}秒，压缩包大小：{}".format(
+                self._title, time.time() - stime, public.to_size(gz_size)))
+        else:
+            disk_path, disk_free, disk_inode = self.get_disk_free(filename)
+            self.echo_info("分区{}可用磁盘空间为：{}，可用Inode为：{}".format(
+                disk_path,
+                public.to_size(disk_free),
+                disk_inode))
+            if disk_path:
+                if disk_free < p_size:
+                    self.echo_error(
+                        "目标分区可用的磁盘空间小于{},无法完成备份，请增加磁盘容量，或在设置页面更改默认备份目录!".format(
+                            public.to_size(p_size)))
+                    return False
+
+                if disk_inode < self._inode_min:
+                    self.echo_error(
+                        "目标分区可用的Inode小于{},无法完成备份，请增加磁盘容量，或在设置页面更改默认备份目录!".format(
+                            self._inode_min))
+                    return False
+
+            self.echo_info("开始导出数据库：{}".format(public.format_date(times=stime)))
 
-        if not os.path.exists(filename):
-            endDate = time.strftime('%Y/%m/%d %X', time.localtime())
-            log = "数据库[" + name + "]备份失败!"
-            self.echo_error("★[" + endDate + "] " + log)
-            self.echo_end()
-            return;
+            if os.path.exists(filename):
+                os.remove(filename)
 
-        gz_size = os.path.getsize(filename)
-        if gz_size < 400:
-            self.echo_error("数据库导出失败!")
-            self.echo_info(public.readFile(self._err_log))
-            return False
+            self.mypass(True, mysql_root)
+            try:
+                with self.stage("compress"):
+                    public.ExecShell(dump_command + " > " + filename)
+            finally:
+                self.mypass(False, mysql_root)
+
+            if not os.path.exists(filename):
+                endDate = time.strftime('%Y/%m/%d %X', time.localtime())
+                log = "数据库[" + name + "]备份失败!"
+                self.echo_error("★[" + endDate + "] " + log)
+                self.echo_end()
+                return;
+
+            gz_size = os.path.getsize(filename)
+            if gz_size < 400:
+                self.echo_error("数据库导出失败!")
+                self.echo_info(public.readFile(self._err_log))
+                return False
 
-        self.echo_info("数据库已备份到本地:" + filename)
+            self.echo_info("数据库已备份到本地:" + filename)
 
-        # 上传文件
-        self.echo_info("正在上传到{}，请稍候...".format(self._title))
-        if self.upload_file(filename, data_type=data_type):
-            self.echo_info("已成功上传到{}".format(self._title))
-        else:
-            self.echo_error('错误：文件上传失败，跳过本次备份!')
-            if os.path.exists(filename):
-                os.remove(filename)
-            return False
+            # 上传文件
+            self.echo_info("正在上传到{}，请稍候...".format(self._title))
+            with self.stage("upload"):
+                uploaded = self.upload_file(filename, data_type=data_type)
+            if uploaded:
+                self.echo_info("已成功上传到{}".format(self._title))
+            else:
+                self.echo_error('错误：文件上传失败，跳过本次备份!')
+                if os.path.exists(filename):
+                    os.remove(filename)
+                return False
 
         object_name = self.build_object_name(data_type, base_file_name)
         endDate = time.strftime('%Y/%m/%d %X', time.localtime())
@@ -680,8 +1301,8 @@ class OSClient(object):
         tag = self.CONFIG_SEPARATOR + self._name
         db_filename = object_name + tag
         sql.table('backup').add('type,name,pid,filename,addtime,size', (
-            1, base_file_name, pid, db_filename, endDate,
-            os.path.getsize(filename)))
+            1, base_file_name, pid, db_filename, endDate, gz_size))
+        self.last_backup_size = gz_size
         log = "数据库[" + name + "]已成功备份到" + os_title + ",用时[" + str(
             round(outTime, 2)) + "]秒";
         public.WriteLog('计划任务', log)
@@ -696,122 +1317,605 @@ class OSClient(object):
         backups = sql.table('backup').where(
             'type=? and pid=? and filename '
             'LIKE \'%{}%\''.format(self._name),
-            ('1', pid)).field('id,name,filename').select();
+            ('1', pid)).field('id,name,filename,addtime').select();
+        backups = self.drop_missing_backups(backups)
 
         num = len(backups) - int(count)
-        if num > 0:
-            for backup in backups:
-                _base_file_name = backup["name"]
-                _local_file_name = os.path.join(backup_path, _base_file_name)
-                if os.path.isfile(_local_file_name):
-                    public.ExecShell("rm -f " + _local_file_name);
-                    self.echo_info("已清理本地备份文件:" + _local_file_name)
-
-                _file_name = backup["filename"]
-                if _file_name.find(self.CONFIG_SEPARATOR) != -1:
-                    _object_name = _file_name.split(self.CONFIG_SEPARATOR)[0]
-                else:
-                    _object_name = self.build_object_name(data_type,
-                                                          _base_file_name)
-                self.delete_object(_object_name)
-
-                sql.table('backup').where('id=?', (backup['id'],)).delete();
-                num -= 1;
-                self.echo_info(
-                    "已清理{}过期备份文件：".format(self._title) + _object_name)
-                if num < 1: break;
+        self.expire_backups(backups[:max(num, 0)], backup_path, data_type)
 
         if os.path.exists(self._err_log):
             os.remove(self._err_log)
         self.echo_end()
 
-    # 备份指定目录
-    def backupPath(self, path, count, exclude=[]):
-        self.echo_start()
-        data_type = "path"
-
-        sql = db.Sql();
-        startTime = time.time();
-        if path[-1:] == '/': path = path[:-1]
+    def restore_database_tables(self, manifest_object, db_name=None):
+        """按表并行导入数据库备份
 
-        self.echo_info('备份目录：{}'.format(path))
-        p_size = public.get_path_size(path)
-        self.echo_info("目录大小：{}".format(public.to_size(p_size)))
+        :param manifest_object: 按表导出备份的清单对象名称
+        :param db_name: 导入的目标数据库，默认为原数据库
+        :return: True/False
+        """
+        mysql_root = db.Sql().table('config').where("id=?", (1,)).getField(
+            'mysql_root')
+        dumper = ParallelDumper(self, db_name or "", "utf8", mysql_root,
+                                workers=self.dump_workers)
+        start_time = time.time()
+        try:
+            count = dumper.restore(manifest_object, db_name)
+        except Exception as e:
+            self.error_msg = str(e)
+            print(self.error_msg)
+            return False
+        print("|-已导入{}张表，耗时{:.2f}秒".format(count,
+                                              time.time() - start_time))
+        return True
 
-        self.get_exclude(exclude)
-        exclude_config = self._exclude
-        if not self._exclude:
-            exclude_config = "未设置"
+    def seekable_upload(self, stream, object_name, size_hint=0):
+        """将tar数据流压缩为可检索压缩包并流式上传，随后上传成员索引
 
-        # TODO(LX) 同名目录备份影响验证
-        name = os.path.basename(path)
+        :return: 上传的字节数
+        """
+        uploader = self.open_upload_stream(object_name, size_hint=size_hint)
+        try:
+            index = SeekableArchiveWriter(
+                uploader, num_threads=self.get_compress_threads()).build(stream)
+        except Exception:
+            uploader.abort()
+            raise
+        size = uploader.close()
+        self.write_archive_index(object_name, index)
+        return size
+
+    def build_archive(self, command, file_name, ok_codes=(0, 1)):
+        """执行输出到本地压缩包的打包命令
+
+        命令通过bash执行并开启pipefail，tar中途失败时压缩程序仍会生成
+        非空的文件，需要以退出码判断是否成功。
+        :param command: 打包压缩命令
+        :param file_name: 压缩包路径，失败时删除
+        :return: True/False
+        """
+        self.error_msg = ""
+        return_code = subprocess.call("set -o pipefail; " + command,
+                                      shell=True, executable="/bin/bash")
+        if return_code in ok_codes:
+            return True
+        self.error_msg = "备份命令执行失败，退出码：{}".format(return_code)
+        if os.path.exists(file_name):
+            os.remove(file_name)
+        return False
 
-        backup_path = os.path.join(
-            sql.table('config').where("id=?", (1,)).getField('backup_path'),
-            data_type);
-        if not os.path.exists(backup_path): os.makedirs(backup_path, 384);
-        base_file_name = "path_" + name + "_" + time.strftime(
-            '%Y%m%d_%H%M%S', time.localtime()) + '.tar.gz'
-        filename = os.path.join(backup_path, base_file_name)
+    def build_seekable_archive(self, command, file_name, ok_codes=(0, 1)):
+        """执行打包命令，输出压缩为本地的可检索压缩包
 
-        disk_path, disk_free, disk_inode = self.get_disk_free(filename)
-        self.echo_info("分区{}可用磁盘空间为：{}，可用Inode为：{}".format(disk_path,
-                                                           public.to_size(
-                                                               disk_free),
-                                                           disk_inode))
-        if disk_path:
-            if disk_free < p_size:
-                self.echo_error(
-                    "目标分区可用的磁盘空间小于{},无法完成备份，请增加磁盘容量，或在设置页面更改默认备份目录!".format(
-                        public.to_size(p_size)))
-                return False
+        :param command: 输出未压缩tar数据的命令
+        :param file_name: 压缩包路径
+        :return: 成员索引/False失败
+        """
+        self.error_msg = ""
+        process = subprocess.Popen("set -o pipefail; " + command,
+                                   shell=True,
+                                   executable="/bin/bash",
+                                   stdout=subprocess.PIPE)
+        index = False
+        try:
+            with open(file_name, "wb") as f:
+                index = SeekableArchiveWriter(
+                    f, num_threads=self.get_compress_threads()).build(
+                    process.stdout)
+        except Exception as e:
+            self.error_msg = "压缩出现错误：{}".format(str(e))
+        finally:
+            process.stdout.close()
+            return_code = process.wait()
+        if index is not False and return_code not in ok_codes:
+            self.error_msg = "备份命令执行失败，退出码：{}".format(return_code)
+            index = False
+        if index is False and os.path.exists(file_name):
+            os.remove(file_name)
+        return index
+
+    def write_archive_index(self, object_name, index):
+        """上传可检索压缩包的成员索引
+
+        索引上传失败不影响备份本身，只是无法浏览压缩包内容。
+        :return: 上传的字节数/False上传失败
+        """
+        data = SeekableArchiveWriter.dumps_index(index)
+        uploader = self.open_upload_stream(
+            object_name + SeekableArchiveWriter.INDEX_SUFFIX,
+            size_hint=len(data))
+        try:
+            uploader.write(data)
+            return uploader.close()
+        except Exception as e:
+            uploader.abort()
+            self.echo_error("成员索引上传失败：{}".format(e))
+            return False
 
-            if disk_inode < self._inode_min:
-                self.echo_error(
-                    "目标分区可用的Inode小于{},无法完成备份，请增加磁盘容量，或在设置页面更改默认备份目录!".format(
-                        self._inode_min))
-                return False
+    def get_archive_index_cache(self, object_name):
+        return os.path.join(self.get_setup_path(), "archive_index",
+                            hashlib.md5(object_name.encode("utf-8")).hexdigest())
 
-        stime = time.time()
-        self.echo_info("开始压缩文件：{}".format(public.format_date(times=stime)))
+    def load_archive_index(self, object_name):
+        """读取压缩包的成员索引
 
-        if os.path.exists(filename):
-            os.remove(filename)
+        备份对象不会被修改，索引下载后缓存在本地，只保留最近使用的若干个。
+        """
+        if object_name[:1] == "/":
+            object_name = object_name[1:]
+        cache_file = self.get_archive_index_cache(object_name)
+        if os.path.exists(cache_file):
+            os.utime(cache_file, None)
+            with open(cache_file, "rb") as f:
+                return SeekableArchiveWriter.loads_index(f.read())
+        try:
+            data = self.read_object(
+                object_name + SeekableArchiveWriter.INDEX_SUFFIX).read()
+        except Exception:
+            raise OsError("{}没有成员索引，不支持浏览压缩包内容".format(
+                object_name))
+        index = SeekableArchiveWriter.loads_index(data)
+
+        cache_dir = os.path.dirname(cache_file)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, 384)
+        with open(cache_file, "wb") as f:
+            f.write(data)
+        caches = sorted((os.path.join(cache_dir, n)
+                         for n in os.listdir(cache_dir)),
+                        key=os.path.getmtime)
+        for cache in caches[:-10]:
+            os.remove(cache)
+        return index
+
+    def list_archive(self, object_name, path=""):
+        """列出压缩包中指定目录下的成员
+
+        :param path: 压缩包中的目录，空字符串表示根目录
+        :return: {"list": [{"name", "type", "size", "time"}], "path": path}
+        """
+        path = path.strip("/")
+        prefix = path + "/" if path else ""
+        entries = {}
+        for name, member_type, size, mtime, _ in \
+                self.load_archive_index(object_name)["members"]:
+            name = name.rstrip("/")
+            if not name.startswith(prefix) or name == path:
+                continue
+            parts = name[len(prefix):].split("/", 1)
+            if len(parts) > 1:
+                # 只有深层成员时也显示其所在的目录
+                entries.setdefault(parts[0], {"name": parts[0], "type": "d",
+                                              "size": 0, "time": mtime})
+                continue
+            entries[parts[0]] = {"name": parts[0], "type": member_type,
+                                 "size": size, "time": mtime}
+        mlist = sorted(entries.values(),
+                       key=lambda e: (e["type"] != "d", e["name"]))
+        return {"list": mlist, "path": path}
+
+    def extract_archive_file(self, object_name, member_name, target):
+        """从压缩包中还原单个文件，只下载包含该文件的压缩块
+
+        :param member_name: 压缩包中的文件路径
+        :param target: 还原到的目录，文件保持在压缩包中的相对路径
+        :return: 还原后的文件路径
+        """
+        if object_name[:1] == "/":
+            object_name = object_name[1:]
+        member_name = member_name.strip("/")
+        index = self.load_archive_index(object_name)
+        member = None
+        for m in index["members"]:
+            if m[0].rstrip("/") == member_name:
+                member = m
+        if not member:
+            raise OsError("压缩包中不存在文件：{}".format(member_name))
+        if member[1] != "f":
+            raise OsError("只能还原普通文件：{}".format(member_name))
+        if ".." in member_name.split("/"):
+            raise OsError("文件路径不合法：{}".format(member_name))
+
+        file_name = os.path.join(target, member_name)
+        if not os.path.exists(os.path.dirname(file_name)):
+            os.makedirs(os.path.dirname(file_name))
+        _, _, size, mtime, offset = member
+        temp_file_name = file_name + ".bt-download"
+        try:
+            self.__extract_range(object_name, index, offset, size,
+                                 temp_file_name)
+        except Exception:
+            if os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
+            raise
+        os.utime(temp_file_name, (mtime, mtime))
+        os.rename(temp_file_name, file_name)
+        return file_name
+
+    def __extract_range(self, object_name, index, offset, size, file_name):
+        """下载并解压包含未压缩数据[offset, offset+size)的压缩块，写入文件"""
+        import zlib
+        with open(file_name, "wb") as f:
+            if size > 0:
+                start, end, block_offset = SeekableArchiveWriter.\
+                    get_block_range(index, offset, offset + size)
+                stream = self.read_object_range(object_name, start, end - 1)
+                skip = offset - block_offset
+                remaining = size
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                while remaining > 0:
+                    data = stream.read(1024 * 1024)
+                    if not data:
+                        raise OsError("压缩包数据不完整")
+                    while data and remaining > 0:
+                        out = decompressor.decompress(data)
+                        # 每个压缩块是独立的gzip成员
+                        data = decompressor.unused_data
+                        if data:
+                            decompressor = zlib.decompressobj(
+                                16 + zlib.MAX_WBITS)
+                        if skip:
+                            dropped = min(skip, len(out))
+                            out = out[dropped:]
+                            skip -= dropped
+                        out = out[:remaining]
+                        f.write(out)
+                        remaining -= len(out)
+
+    def get_decompress_command(self, file_name):
+        """根据备份文件扩展名获取解压命令，未压缩时返回空字符串"""
+        if file_name.endswith(".zst"):
+            return COMPRESSORS["zstd"][2]
+        if file_name.endswith(".gz"):
+            if find_executable("pigz"):
+                return COMPRESSORS["pigz"][2]
+            return COMPRESSORS["gzip"][2]
+        return ""
 
-        os.system("cd " + os.path.dirname(path) +
-                  " && tar zcvf '" + filename + "' " +
-                  self._exclude + " '" + os.path.basename(path) +
-                  "' 2>{err_log} 1> /dev/null".format(
-                      err_log=self._err_log))
+    def restore_stream(self, sources, command, env=None):
+        """将数据源依次写入命令的标准输入
 
-        if not os.path.exists(filename):
-            endDate = time.strftime('%Y/%m/%d %X', time.localtime())
-            log = u"目录[" + path + "]备份失败"
-            self.echo_info(u"★[" + endDate + "] " + log)
-            self.echo_end()
-            return;
+        下载(读取线程)、解压与解包/导入(子进程)同时进行，内存占用受预取窗口限制。
+        :param sources: 对象名称或可迭代数据块的列表
+        :param command: 接收数据的shell命令
+        :return: 命令退出码
+        """
+        process = subprocess.Popen("set -o pipefail; " + command,
+                                   shell=True,
+                                   executable="/bin/bash",
+                                   stdin=subprocess.PIPE,
+                                   env=env)
+        size = 0
+        start_time = time.time()
+        try:
+            for source in sources:
+                if isinstance(source, (str, type(u""))):
+                    self.echo_info("正在还原{}...".format(source))
+                    reader = self.open_range_reader(source)
+                    try:
+                        while True:
+                            data = reader.read(1024 * 1024)
+                            if not data:
+                                break
+                            process.stdin.write(data)
+                            size += len(data)
+                    finally:
+                        reader.close()
+                else:
+                    for data in source:
+                        process.stdin.write(data)
+                        size += len(data)
+        finally:
+            try:
+                process.stdin.close()
+            except Exception:
+                pass
+            return_code = process.wait()
+        self.echo_info("已处理{}，耗时{:.2f}秒".format(
+            public.to_size(size), time.time() - start_time))
+        return return_code
 
-        tar_size = os.path.getsize(filename)
-        if tar_size < 1:
-            self.echo_error("数据压缩失败")
-            self.echo_info(public.readFile(self._err_log))
-            self.echo_end()
-            return False
+    def resolve_object_name(self, data_type, file_name):
+        """备份文件名转换为对象名称，已包含目录时视为对象名称"""
+        if "/" in file_name:
+            return file_name[1:] if file_name[:1] == "/" else file_name
+        return self.build_object_name(data_type, file_name)
 
-        self.echo_info("文件压缩完成，耗时{:.2f}秒，压缩包大小：{}".format(time.time() - stime,
-                                                          public.to_size(
-                                                              tar_size)))
-        self.echo_info("目录已备份到：{}".format(filename))
+    def restore(self, data_type, file_name, target=None):
+        """还原备份
 
-        # 上传文件
-        self.echo_info("正在上传到{}，请稍候...".format(self._title))
-        if self.upload_file(filename, data_type=data_type):
-            self.echo_info("已成功上传到{}".format(self._title))
+        :param data_type: 数据类型 site/database/path
+        :param file_name: 备份文件名称或对象名称
+        :param target: 网站/目录备份解包到的目录，默认还原到原位置；
+                       数据库备份导入的数据库，默认为原数据库
+        :return: True/False
+        """
+        self.error_msg = ""
+        start_time = time.time()
+        print("=" * 90)
+        print("★开始还原[{}]".format(public.format_date()))
+        try:
+            if data_type == "site":
+                result = self.restore_site(file_name, target)
+            elif data_type == "database":
+                result = self.restore_database(file_name, target)
+            elif data_type == "path":
+                result = self.restore_path(file_name, target)
+            else:
+                raise OsError("不支持的数据类型：{}".format(data_type))
+        except Exception as e:
+            self.error_msg = str(e)
+            result = False
+        if result:
+            print("☆还原完成，耗时{:.2f}秒".format(time.time() - start_time))
+        else:
+            self.echo_error("还原失败：{}".format(self.error_msg))
+        print("=" * 90)
+        return result
+
+    def extract_archives(self, sources, file_name, target):
+        """解压并解包到target目录，sources的格式见restore_stream"""
+        if not os.path.exists(target):
+            os.makedirs(target)
+        command = "tar xf - -C '{}'".format(target)
+        decompress = self.get_decompress_command(file_name)
+        if decompress:
+            command = decompress + " | " + command
+        return_code = self.restore_stream(sources, command)
+        if return_code != 0:
+            self.error_msg = "解包失败，退出码：{}".format(return_code)
+            return False
+        return True
+
+    def restore_site(self, file_name, target=None):
+        """还原网站备份
+
+        增量备份会先还原所属的全量备份，再按顺序还原到指定的增量备份为止，
+        每个增量包解包后按其中的.bt_deleted_files删除文件。
+        """
+        base_name = os.path.basename(file_name)
+        if not target:
+            site_path = None
+            sub_search = re.search(r"web_(.+)_20\d+_\d+\.", base_name)
+            if sub_search:
+                site_path = public.M('sites').where(
+                    'name=?', (sub_search.groups()[0],)).getField('path')
+            if not site_path:
+                raise OsError("无法确定网站目录，请指定还原目录")
+            target = os.path.dirname(site_path.rstrip("/"))
+
+        chain = [self.resolve_object_name("site", file_name)]
+        if ".incr." in base_name:
+            backups = public.M('backup').where(
+                'type=? and filename LIKE ?',
+                ('0', '%' + self.CONFIG_SEPARATOR + self._name + '%')
+            ).field('id,name,filename').order('id asc').select()
+            full = None
+            for backup in backups:
+                tags = backup["filename"].split(self.CONFIG_SEPARATOR)
+                if backup["name"] == base_name and len(tags) > 3:
+                    full = tags[3]
+            if not full:
+                raise OsError("找不到增量备份{}所属的全量备份".format(base_name))
+            chain = [self.resolve_object_name("site", full)]
+            for backup in backups:
+                tags = backup["filename"].split(self.CONFIG_SEPARATOR)
+                if len(tags) > 3 and tags[2] == "incr" and tags[3] == full:
+                    chain.append(tags[0])
+                    if backup["name"] == base_name:
+                        break
+        self.echo_info("还原到：{}，共{}个备份文件".format(target, len(chain)))
+
+        encode = getattr(os, "fsencode", lambda x: x)
+        deleted_file = os.path.join(target, ".bt_deleted_files")
+        root = os.path.realpath(encode(target)).rstrip(b"/")
+        for object_name in chain:
+            if not self.extract_archives([object_name], object_name, target):
+                return False
+            if not os.path.exists(deleted_file):
+                continue
+            with open(deleted_file, "rb") as f:
+                for rel in f.read().split(b"\0"):
+                    # 只删除还原目录内的文件，拒绝绝对路径与..
+                    if not rel or rel.startswith(b"/") or \
+                            b".." in rel.split(b"/"):
+                        continue
+                    path = os.path.join(root, rel)
+                    real = os.path.realpath(os.path.dirname(path))
+                    if real != root and not real.startswith(root + b"/"):
+                        continue
+                    if os.path.lexists(path) and not os.path.isdir(path):
+                        os.remove(path)
+            os.remove(deleted_file)
+        return True
+
+    def restore_database(self, file_name, db_name=None):
+        """还原数据库备份，按表导出的备份并行导入"""
+        object_name = self.resolve_object_name("database", file_name)
+        if object_name.endswith(ParallelDumper.MANIFEST_SUFFIX):
+            return self.restore_database_tables(object_name, db_name)
+        if not db_name:
+            sub_search = re.search(r"db_(.+)_20\d+_\d+\.",
+                                   os.path.basename(file_name))
+            if not sub_search:
+                raise OsError("无法确定数据库名称，请指定还原的数据库")
+            db_name = sub_search.groups()[0]
+        mysql_root = db.Sql().table('config').where("id=?", (1,)).getField(
+            'mysql_root')
+        command = "/www/server/mysql/bin/mysql -uroot " \
+                  "--default-character-set={} '{}'".format(
+                      self.get_database_character(db_name), db_name)
+        decompress = self.get_decompress_command(object_name)
+        if decompress:
+            command = decompress + " | " + command
+        self.echo_info("导入到数据库：{}".format(db_name))
+        env = dict(os.environ)
+        env["MYSQL_PWD"] = mysql_root
+        return_code = self.restore_stream([object_name], command, env=env)
+        if return_code != 0:
+            self.error_msg = "导入数据库失败，退出码：{}".format(return_code)
+            return False
+        return True
+
+    def restore_path(self, file_name, target=None):
+        """还原目录备份，包括去重备份快照"""
+        object_name = self.resolve_object_name("path", file_name)
+        if not target:
+            path = public.M('backup').where(
+                'type=? and filename LIKE ?',
+                ('2', object_name + self.CONFIG_SEPARATOR + '%')
+            ).getField('name')
+            if not path:
+                raise OsError("无法确定备份目录，请指定还原目录")
+            target = os.path.dirname(path.rstrip("/"))
+        self.echo_info("还原到：{}".format(target))
+        if object_name.endswith(DedupStore.INDEX_SUFFIX):
+            return self.extract_archives([self.iter_dedup_data(object_name)],
+                                         ".tar", target)
+        return self.extract_archives([object_name], object_name, target)
+
+    # 备份指定目录
+    def backupPath(self, path, count, exclude=[]):
+        self.echo_start()
+        data_type = "path"
+
+        sql = db.Sql();
+        startTime = time.time();
+        if path[-1:] == '/': path = path[:-1]
+
+        self.echo_info('备份目录：{}'.format(path))
+        # 本地打包需要准确的大小检查磁盘空间
+        p_size = self.get_source_size(
+            path, refresh=not self.stream_backup and not self.dedup_backup)
+        self.echo_info("目录大小：{}".format(public.to_size(p_size)))
+
+        self.get_exclude(exclude)
+        exclude_config = self._exclude
+        if not self._exclude:
+            exclude_config = "未设置"
+
+        # TODO(LX) 同名目录备份影响验证
+        name = os.path.basename(path)
+
+        backup_path = os.path.join(
+            sql.table('config').where("id=?", (1,)).getField('backup_path'),
+            data_type);
+        if not os.path.exists(backup_path): os.makedirs(backup_path, 384);
+        compress_type, ext, _ = self.get_compressor()
+        if self.dedup_backup:
+            ext = ".dedup"
         else:
-            self.echo_error('错误：文件上传失败，跳过本次备份!')
+            if self.seekable_archive:
+                compress_type, ext = "gzip(可检索)", ".tar.gz"
+            self.echo_info("压缩方式：{}".format(compress_type))
+        base_file_name = "path_" + name + "_" + time.strftime(
+            '%Y%m%d_%H%M%S', time.localtime()) + ext
+        filename = os.path.join(backup_path, base_file_name)
+
+        stime = time.time()
+        if self.dedup_backup:
+            # 去重备份：tar数据流按内容分块，只上传新的数据块和快照索引
+            self.echo_info("开始去重备份到{}：{}".format(
+                self._title, public.format_date(times=stime)))
+            with self.stage("compress"), self.stage("upload"):
+                tar_size = self.upload_command_output(
+                    self.build_tar_command(path, compress=False),
+                    data_type, base_file_name, ok_codes=(0, 1), dedup=True)
+            if tar_size is False:
+                self.echo_error("数据去重备份失败")
+                self.echo_info(self.error_msg)
+                self.echo_info(public.readFile(self._err_log))
+                self.echo_end()
+                return False
+            self.echo_info("已成功备份到{}，耗时{:.2f}秒，数据大小：{}".format(
+                self._title, time.time() - stime, public.to_size(tar_size)))
+        elif self.stream_backup:
+            # 流式备份：打包数据边压缩边上传
+            self.echo_info("开始压缩并流式上传到{}：{}".format(
+                self._title, public.format_date(times=stime)))
+            with self.stage("compress"), self.stage("upload"):
+                tar_size = self.upload_command_output(
+                    self.build_tar_command(
+                        path, compress=not self.seekable_archive),
+                    data_type, base_file_name, ok_codes=(0, 1),
+                    size_hint=p_size, seekable=self.seekable_archive)
+            if tar_size is False:
+                self.echo_error("数据压缩上传失败")
+                self.echo_info(self.error_msg)
+                self.echo_info(public.readFile(self._err_log))
+                self.echo_end()
+                return False
+            self.echo_info("已成功上传到{}，耗时{:.2f}秒，压缩包大小：{}".format(
+                self._title, time.time() - stime, public.to_size(tar_size)))
+        else:
+            disk_path, disk_free, disk_inode = self.get_disk_free(filename)
+            self.echo_info("分区{}可用磁盘空间为：{}，可用Inode为：{}".format(disk_path,
+                                                               public.to_size(
+                                                                   disk_free),
+                                                               disk_inode))
+            if disk_path:
+                if disk_free < p_size:
+                    self.echo_error(
+                        "目标分区可用的磁盘空间小于{},无法完成备份，请增加磁盘容量，或在设置页面更改默认备份目录!".format(
+                            public.to_size(p_size)))
+                    return False
+
+                if disk_inode < self._inode_min:
+                    self.echo_error(
+                        "目标分区可用的Inode小于{},无法完成备份，请增加磁盘容量，或在设置页面更改默认备份目录!".format(
+                            self._inode_min))
+                    return False
+
+            self.echo_info("开始压缩文件：{}".format(public.format_date(times=stime)))
+
             if os.path.exists(filename):
                 os.remove(filename)
-            return False
+
+            archive_index = None
+            with self.stage("compress"):
+                if self.seekable_archive:
+                    archive_index = self.build_seekable_archive(
+                        self.build_tar_command(path, compress=False), filename)
+                else:
+                    self.build_archive(self.build_tar_command(path, filename),
+                                       filename)
+
+            if not os.path.exists(filename):
+                endDate = time.strftime('%Y/%m/%d %X', time.localtime())
+                log = u"目录[" + path + "]备份失败"
+                self.echo_info(u"★[" + endDate + "] " + log)
+                self.echo_info(self.error_msg)
+                self.echo_info(public.readFile(self._err_log))
+                self.echo_end()
+                return;
+
+            tar_size = os.path.getsize(filename)
+            if tar_size < 1:
+                self.echo_error("数据压缩失败")
+                self.echo_info(public.readFile(self._err_log))
+                self.echo_end()
+                return False
+
+            self.echo_info("文件压缩完成，耗时{:.2f}秒，压缩包大小：{}".format(time.time() - stime,
+                                                              public.to_size(
+                                                                  tar_size)))
+            self.echo_info("目录已备份到：{}".format(filename))
+
+            # 上传文件
+            self.echo_info("正在上传到{}，请稍候...".format(self._title))
+            with self.stage("upload"):
+                uploaded = self.upload_file(filename, data_type=data_type)
+                if uploaded and archive_index:
+                    self.write_archive_index(
+                        self.build_object_name(data_type, base_file_name),
+                        archive_index)
+            if uploaded:
+                self.echo_info("已成功上传到{}".format(self._title))
+            else:
+                self.echo_error('错误：文件上传失败，跳过本次备份!')
+                if os.path.exists(filename):
+                    os.remove(filename)
+                return False
 
         # 添加备份记录
         object_name = self.build_object_name(data_type, base_file_name)
@@ -823,7 +1927,8 @@ class OSClient(object):
         outTime = time.time() - startTime
         sql.table('backup').add('type,name,pid,filename,addtime,size', (
             '2', path, '0', db_filename, endDate,
-            os.path.getsize(filename)))
+            tar_size))
+        self.last_backup_size = tar_size
         log = u"目录[" + path + "]备份成功,用时[" + str(round(outTime, 2)) + "]秒";
         public.WriteLog(u'计划任务', log)
         self.echo_info(u"★[" + endDate + "] " + log)
@@ -838,43 +1943,411 @@ class OSClient(object):
         backups = sql.table('backup').where(
             'type=? and pid=? and name=? and filename LIKE "%{}%"'.format(
                 self._name),
-            ('2', 0, path)).field('id,name,filename').select();
+            ('2', 0, path)).field('id,name,filename,addtime').select();
+        backups = self.drop_missing_backups(backups)
 
         num = len(backups) - int(count)
-        if num > 0:
-            for backup in backups:
-                _base_file_name = backup["name"]
-                _local_file_name = os.path.join(backup_path, _base_file_name)
-                if os.path.isfile(_local_file_name):
-                    os.remove(_local_file_name)
-                    self.echo_info("已清理本地备份文件:" + _local_file_name)
-
-                _filename = backup["filename"]
-                if _filename.find(self.CONFIG_SEPARATOR) != -1:
-                    info = _filename.split(self.CONFIG_SEPARATOR)
-                    os_file_name = info[0]
-                else:
-                    os_file_name = _filename
-                self.delete_object(os_file_name)
-                sql.table('backup').where('id=?', (backup['id'],)).delete();
-                num -= 1;
-                self.echo_info(
-                    u"已清理{}过期备份文件：".format(self._title) + os_file_name)
-                if num < 1: break;
+        self.expire_backups(backups[:max(num, 0)], backup_path)
 
         if os.path.exists(self._err_log):
             os.remove(self._err_log)
         self.echo_end()
 
     def backupSiteAll(self, save):
-        sites = public.M('sites').field('name').select()
+        sites = public.M('sites').field('name,path').select()
+        jobs = []
         for site in sites:
-            self.backupSite(site['name'], save)
+            size = 0
+            if site['path'] and os.path.exists(site['path']):
+                size = self.get_source_size(site['path'])
+            jobs.append((site['name'], size, "backupSite", (site['name'], save)))
+        return self.run_with_deferred_cleanup(jobs)
 
     def backupDatabaseAll(self, save):
         databases = public.M('databases').field('name').select()
+        sizes = {}
+        try:
+            import panelMysql
+            if not self._db_mysql: self._db_mysql = panelMysql.panelMysql()
+            d_tmp = self.map_to_list(self._db_mysql.query(
+                "select table_schema,sum(DATA_LENGTH)+sum(INDEX_LENGTH) from "
+                "information_schema.tables group by table_schema"))
+            if isinstance(d_tmp, list):
+                for row in d_tmp:
+                    sizes[row[0]] = int(row[1] or 0)
+        except Exception:
+            pass
+        jobs = []
         for database in databases:
-            self.backupDatabase(database['name'], save)
+            name = database['name']
+            jobs.append((name, sizes.get(name, 0), "backupDatabase", (name, save)))
+        return self.run_with_deferred_cleanup(jobs)
+
+    def run_with_deferred_cleanup(self, jobs):
+        """执行批量备份，各任务的过期备份在全部完成后统一清理"""
+        self._expired_backups = []
+        self._defer_cleanup = True
+        try:
+            results = self.get_scheduler().run(jobs)
+        finally:
+            self._defer_cleanup = False
+        expired, self._expired_backups = self._expired_backups, None
+        self.flush_expired(expired)
+        self.auto_reap()
+        return results
+
+    def expire_backups(self, backups, backup_path, data_type=None):
+        """清理过期备份
+
+        删除本地备份文件并收集需要删除的对象；批量备份期间只收集，
+        由run_with_deferred_cleanup在全部完成后统一删除。
+        :param backups: 过期的备份记录
+        :param backup_path: 本地备份目录
+        :param data_type: 记录中没有对象名称时用于构建对象名称
+        """
+        expired = self._expired_backups if self._defer_cleanup else []
+        for backup in backups:
+            _local_file_name = os.path.join(backup_path, backup["name"])
+            if os.path.isfile(_local_file_name):
+                os.remove(_local_file_name)
+                self.echo_info("已清理本地备份文件:" + _local_file_name)
+
+            _file_name = backup["filename"]
+            if _file_name.find(self.CONFIG_SEPARATOR) != -1:
+                object_name = _file_name.split(self.CONFIG_SEPARATOR)[0]
+            elif data_type:
+                object_name = self.build_object_name(data_type,
+                                                     backup["name"])
+            else:
+                object_name = _file_name
+            object_names = [object_name]
+            if object_name.endswith(".tar.gz"):
+                # 可检索压缩包的成员索引，不存在时删除也会成功
+                object_names.append(
+                    object_name + SeekableArchiveWriter.INDEX_SUFFIX)
+            if object_name.endswith(ParallelDumper.MANIFEST_SUFFIX):
+                try:
+                    object_names += self.list_prefix_keys(
+                        ParallelDumper.get_tables_prefix(object_name))
+                except Exception as e:
+                    self.echo_error("列出表备份对象失败：{}".format(e))
+            expired.append((backup["id"], object_names))
+        if not self._defer_cleanup:
+            self.flush_expired(expired)
+            self.auto_reap()
+
+    def get_reap_stats_file(self):
+        return os.path.join(self.get_setup_path(), "reap.json")
+
+    def auto_reap(self):
+        """距上次清理超过reap_interval小时时，取消过期的分片上传"""
+        if not self.reap_interval:
+            return
+        stats_file = self.get_reap_stats_file()
+        try:
+            last_time = json.loads(public.readFile(stats_file))["time"]
+        except Exception:
+            last_time = 0
+        if time.time() - last_time < self.reap_interval * 3600:
+            return
+        public.writeFile(stats_file, json.dumps({"time": int(time.time())}))
+        try:
+            self.reap_uploads(self.reap_age * 3600)
+        except Exception as e:
+            self.echo_error("清理过期分片上传失败：{}".format(e))
+
+    def flush_expired(self, expired):
+        """批量删除过期备份对象，再一次性删除对应的备份记录
+
+        有对象删除失败的记录会被保留，下次清理时重试。
+        :param expired: [(备份记录id, [对象名称])]
+        """
+        if not expired:
+            return
+        object_names = []
+        for _, names in expired:
+            object_names += names
+        failed = set(self.delete_objects(object_names))
+
+        done_ids = []
+        for backup_id, names in expired:
+            if failed.intersection(names):
+                continue
+            done_ids.append(backup_id)
+            self.echo_info(
+                "已清理{}过期备份文件：".format(self._title) + names[0])
+        sql = db.Sql()
+        for i in range(0, len(done_ids), 500):
+            ids = done_ids[i:i + 500]
+            sql.table('backup').where(
+                "id in ({})".format(",".join("?" * len(ids))),
+                tuple(ids)).delete()
+        if failed:
+            self.echo_error("{}个过期备份文件删除失败，将在下次清理时重试：{}".format(
+                len(failed), ", ".join(sorted(failed)[:10])))
+
+        if any(names[0].endswith(DedupStore.INDEX_SUFFIX)
+               for backup_id, names in expired if backup_id in done_ids):
+            # 删除快照后回收不再被引用的数据块
+            chunk_count, chunk_size = self.dedup_gc()
+            self.echo_info("已回收{}个未引用的数据块，释放空间：{}".format(
+                chunk_count, public.to_size(chunk_size)))
+
+    def get_scheduler(self):
+        """根据配置构造批量备份调度器"""
+        return BackupScheduler(self,
+                               workers=self.backup_workers,
+                               compress_workers=self.compress_workers,
+                               upload_workers=self.upload_workers)
+
+    def stage(self, name):
+        """备份阶段并发限制
+
+        由BackupScheduler调度时返回对应阶段的信号量，否则不做限制。
+        :param name: compress/upload
+        """
+        if self._stage_slots and name in self._stage_slots:
+            return self._stage_slots[name]
+        return _NoLimit()
+
+    def get_expired_backups(self, backups, count):
+        """计算需要清理的过期备份
+
+        增量备份记录与其全量备份属于同一个备份链，按备份链保留最新的count份；
+        普通备份每条记录各自成链，即保留最新的count条记录。
+        :param backups: 按时间先后排列的备份记录
+        :param count: 保留份数
+        :return: 过期的备份记录
+        """
+        chains = []
+        backup_chains = []
+        for backup in backups:
+            tags = backup["filename"].split(self.CONFIG_SEPARATOR)
+            if len(tags) > 3 and tags[2] == "incr":
+                chain = tags[3]
+            else:
+                chain = backup["name"]
+            backup_chains.append(chain)
+            if chain not in chains:
+                chains.append(chain)
+        count = int(count)
+        keep = set(chains[-count:]) if count > 0 else set()
+        return [backup for backup, chain in zip(backups, backup_chains)
+                if chain not in keep]
+
+    def get_manifest_file(self, name):
+        """网站文件清单路径"""
+        return os.path.join(self.get_setup_path(), "manifest",
+                            "site_" + name + ".json.gz")
+
+    def load_manifest(self, name):
+        """读取网站文件清单
+
+        :return: {"root", "full", "runs", "size", "files": {相对路径: [大小, 修改时间, 哈希]}}
+        """
+        import gzip
+        manifest_file = self.get_manifest_file(name)
+        if not os.path.exists(manifest_file):
+            return None
+        try:
+            with gzip.open(manifest_file, "rb") as f:
+                return json.loads(f.read().decode("utf-8"))
+        except Exception:
+            return None
+
+    def save_manifest(self, name, manifest):
+        import gzip
+        manifest_file = self.get_manifest_file(name)
+        manifest_dir = os.path.dirname(manifest_file)
+        if not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir, 384)
+        tmp_file = manifest_file + ".tmp"
+        with gzip.open(tmp_file, "wb") as f:
+            f.write(json.dumps(manifest).encode("utf-8"))
+        os.rename(tmp_file, manifest_file)
+
+    def get_source_size_file(self):
+        return os.path.join(self.get_setup_path(), "source_size.json")
+
+    def load_source_sizes(self):
+        try:
+            return json.loads(public.readFile(self.get_source_size_file()))
+        except Exception:
+            return {}
+
+    def save_source_size(self, path, size):
+        """记录目录大小，增量备份扫描文件清单后也会更新"""
+        with self._source_size_lock:
+            sizes = self.load_source_sizes()
+            sizes[path] = {"size": int(size), "time": int(time.time())}
+            public.writeFile(self.get_source_size_file(), json.dumps(sizes))
+
+    def get_source_size(self, path, refresh=False):
+        """预估备份源目录的大小
+
+        使用最近一次统计/增量备份扫描的结果，超过SOURCE_SIZE_TTL才重新遍历目录。
+        缓存的结果只用于流式上传的分片参数计算；先在本地打包时需要检查磁盘空间，
+        目录可能在缓存之后变大，应传入refresh=True重新统计。
+        """
+        entry = self.load_source_sizes().get(path)
+        if not refresh and entry and \
+                time.time() - entry["time"] < self.SOURCE_SIZE_TTL:
+            return entry["size"]
+        size = public.get_path_size(path)
+        self.save_source_size(path, size)
+        return size
+
+    def is_excluded(self, rel_path, patterns):
+        """按tar --exclude的规则判断文件是否被排除"""
+        import fnmatch
+        parts = rel_path.split("/")
+        for pattern in patterns:
+            pattern = pattern.rstrip("/")
+            if fnmatch.fnmatch(rel_path, pattern) or \
+                    fnmatch.fnmatch("/".join(parts[1:]), pattern):
+                return True
+            for part in parts:
+                if fnmatch.fnmatch(part, pattern):
+                    return True
+        return False
+
+    def scan_files(self, path, old_files=None, with_hash=False):
+        """遍历目录生成文件清单
+
+        路径相对于path的上级目录，与tar包中的成员名称一致。
+        开启哈希时只对大小或修改时间变化的文件计算MD5，未变化的文件沿用上次的哈希。
+        :return: {相对路径: [大小, 修改时间, 哈希]}
+        """
+        old_files = old_files or {}
+        patterns = self._exclude_list
+        base = os.path.dirname(path)
+        files = {}
+        for root, dirs, names in os.walk(path):
+            rel_root = os.path.relpath(root, base)
+            for d in list(dirs):
+                rel = rel_root + "/" + d
+                if patterns and self.is_excluded(rel, patterns):
+                    dirs.remove(d)
+                elif os.path.islink(os.path.join(root, d)):
+                    # 指向目录的软链接作为文件记录，不进入遍历
+                    names.append(d)
+            for n in names:
+                rel = rel_root + "/" + n
+                if patterns and self.is_excluded(rel, patterns):
+                    continue
+                full_path = os.path.join(root, n)
+                try:
+                    st = os.lstat(full_path)
+                except OSError:
+                    continue
+                entry = [st.st_size, int(st.st_mtime)]
+                old = old_files.get(rel)
+                if old and old[:2] == entry:
+                    entry.extend(old[2:])
+                elif with_hash and os.path.isfile(full_path) and \
+                        not os.path.islink(full_path):
+                    entry.append(self.get_file_md5(full_path))
+                files[rel] = entry
+        return files
+
+    def get_file_md5(self, file_name):
+        md5 = hashlib.md5()
+        try:
+            with open(file_name, "rb") as f:
+                while True:
+                    data = f.read(1024 * 1024)
+                    if not data:
+                        break
+                    md5.update(data)
+        except (IOError, OSError):
+            return ""
+        return md5.hexdigest()
+
+    def prepare_incremental(self, name, path):
+        """对比文件清单，决定本次进行全量备份还是增量备份
+
+        以下情况进行全量备份：没有清单、网站目录变更、全量备份记录已不存在、
+        距上次全量备份已达到incremental_full_every次。
+        :return: 增量备份信息，mode为full/incr
+        """
+        manifest = self.load_manifest(name) or {}
+        old_files = manifest.get("files", {})
+        full = manifest.get("full")
+        runs = int(manifest.get("runs", 0))
+
+        mode = "incr"
+        if not full or manifest.get("root") != path or \
+                runs + 1 >= self.incremental_full_every or \
+                not public.M('backup').where(
+                    'type=? and name=?', ('0', full)).count():
+            mode = "full"
+
+        files = self.scan_files(path, old_files, self.incremental_hash)
+        incremental = {
+            "mode": mode,
+            "root": path,
+            "full": full,
+            "runs": runs,
+            "files": files,
+            "changed": [],
+            "deleted": [],
+            "list_file": None,
+            "deleted_file": None,
+        }
+        if mode == "full":
+            return incremental
+
+        for rel, entry in files.items():
+            old = old_files.get(rel)
+            if old and old[0] == entry[0]:
+                if old[1] == entry[1]:
+                    continue
+                # 仅修改时间变化而内容一致的文件不需要重新上传
+                if len(old) > 2 and len(entry) > 2 and old[2] == entry[2]:
+                    continue
+            incremental["changed"].append(rel)
+        incremental["deleted"] = [rel for rel in old_files
+                                  if rel not in files]
+
+        tmp_dir = os.path.join(get_tmpdir_path(),
+                               "bt_incr_" + generate_random_str())
+        os.makedirs(tmp_dir, 448)
+        encode = getattr(os, "fsencode", lambda x: x)
+        incremental["list_file"] = os.path.join(tmp_dir, "files.list")
+        with open(incremental["list_file"], "wb") as f:
+            for rel in incremental["changed"]:
+                f.write(encode(rel) + b"\0")
+        # 被删除的文件列表随增量包一起上传，还原时据此删除文件
+        incremental["deleted_file"] = os.path.join(tmp_dir,
+                                                   ".bt_deleted_files")
+        with open(incremental["deleted_file"], "wb") as f:
+            for rel in incremental["deleted"]:
+                f.write(encode(rel) + b"\0")
+        return incremental
+
+    def save_incremental(self, name, incremental, file_name):
+        """备份成功后保存文件清单"""
+        if incremental["mode"] == "full":
+            full, runs = file_name, 0
+        else:
+            full, runs = incremental["full"], incremental["runs"] + 1
+        size = sum(e[0] for e in incremental["files"].values())
+        self.save_manifest(name, {
+            "root": incremental["root"],
+            "full": full,
+            "runs": runs,
+            "time": int(time.time()),
+            "size": size,
+            "files": incremental["files"],
+        })
+        self.save_source_size(incremental["root"], size)
+
+    def clean_incremental(self, incremental):
+        """清理增量备份临时文件"""
+        if not incremental or not incremental["list_file"]:
+            return
+        import shutil
+        shutil.rmtree(os.path.dirname(incremental["list_file"]), True)
 
     # 构造排除
     def get_exclude(self, exclude=[]):
@@ -882,12 +2355,145 @@ class OSClient(object):
             tmp_exclude = os.getenv('BT_EXCLUDE')
             if tmp_exclude:
                 exclude = tmp_exclude.split(',')
+        self._exclude_list = list(exclude or [])
         if not exclude: return ""
         for ex in exclude:
             self._exclude += " --exclude=\"" + ex + "\""
         self._exclude += " "
         return self._exclude
 
+    def get_compressor(self, gzip_only=False):
+        """获取当前可用的压缩方式
+
+        配置的压缩程序不存在时回退到gzip。
+        :param gzip_only: 只允许gzip格式输出(gzip/pigz)
+        :return: (压缩方式, 扩展名, 压缩命令)
+        """
+        compress_type = self.compress_type
+        if compress_type not in COMPRESSORS:
+            compress_type = "gzip"
+        if gzip_only and COMPRESSORS[compress_type][0] != ".tar.gz":
+            compress_type = "pigz"
+        ext, command, _, exe = COMPRESSORS[compress_type]
+        if exe and not find_executable(exe):
+            compress_type = "gzip"
+            ext, command, _, exe = COMPRESSORS[compress_type]
+
+        return compress_type, ext, command.format(
+            threads=self.get_compress_threads())
+
+    def get_compress_threads(self):
+        """压缩线程数，未设置时使用全部CPU核心"""
+        threads = int(self.compress_threads or 0)
+        if threads < 1:
+            import multiprocessing
+            threads = multiprocessing.cpu_count()
+        return threads
+
+    def get_throttle(self):
+        """当前时间段生效的限速配置
+
+        :return: {"upload_limit": 上传字节/秒, "nice": nice值, "ionice": IO优先级}
+        """
+        throttle = {
+            "upload_limit": self.upload_limit,
+            "nice": self.nice_level,
+            "ionice": self.ionice_level,
+        }
+        for rule in self.throttle_schedule or []:
+            if in_time_range(rule.get("time", "")):
+                for key in throttle:
+                    if key in rule:
+                        throttle[key] = rule[key]
+                break
+        throttle["upload_limit"] = int(throttle["upload_limit"] or 0) * 1024
+        throttle["nice"] = min(19, int(throttle["nice"] or 0))
+        throttle["ionice"] = min(7, int(throttle["ionice"] or 0))
+        return throttle
+
+    def throttle_upload(self, size):
+        """按当前时间段的上传限速消费令牌，进程内所有上传共享限额"""
+        _upload_bucket.consume(size, self.get_throttle()["upload_limit"])
+
+    def get_traffic_headers(self, num_threads):
+        """当前时间段的单连接限速请求头，未限速时返回None
+
+        令牌桶只能控制平均速度，分片仍会以满速发出；服务端按连接限速(bit/s)
+        使每个请求的上传平滑，num_threads个连接合计不超过上传限速。
+        """
+        upload_limit = self.get_throttle()["upload_limit"]
+        if not upload_limit:
+            return None
+        traffic_limit = min(max(upload_limit * 8 // max(1, num_threads),
+                                819200), 838860800)
+        return {"x-oss-traffic-limit": str(traffic_limit)}
+
+    def get_priority_prefix(self):
+        """降低当前shell及其子进程CPU与IO优先级的命令前缀，不限制时为空"""
+        throttle = self.get_throttle()
+        prefix = ""
+        if throttle["nice"] > 0:
+            prefix += "renice -n {} -p $$ >/dev/null 2>&1; ".format(
+                throttle["nice"])
+        if throttle["ionice"] > 0 and find_executable("ionice"):
+            prefix += "ionice -c2 -n{} -p $$ >/dev/null 2>&1; ".format(
+                throttle["ionice"])
+        return prefix
+
+    def get_key_file(self, key_file=None):
+        return os.path.join(self.get_setup_path(),
+                            key_file or self.encrypt_key_file or "backup.key")
+
+    def get_cipher(self):
+        """配置了密钥文件时返回BackupCipher，否则返回None"""
+        if not self.encrypt_key_file:
+            return None
+        if self._cipher is None:
+            self._cipher = BackupCipher.load(self.get_key_file())
+        return self._cipher
+
+    def require_cipher(self):
+        """读取加密对象时使用，没有配置密钥时抛出异常"""
+        cipher = self.get_cipher()
+        if not cipher:
+            raise OsError("备份文件已加密，请先在配置中设置密钥文件encrypt_key_file")
+        return cipher
+
+    def generate_encrypt_key(self, key_file=None):
+        """生成加密密钥文件，需要在配置中设置encrypt_key_file后生效"""
+        return BackupCipher.generate_key(self.get_key_file(key_file))
+
+    def build_tar_command(self, path, output=None, file_list=None,
+                          extra_file=None, compress=True):
+        """构造打包压缩命令
+
+        :param path: 需要打包的目录
+        :param output: 压缩包路径，不指定时输出到标准输出
+        :param file_list: 只打包清单中的文件(以\\0分隔，相对于path的上级目录)
+        :param extra_file: 额外打包到压缩包根目录的文件
+        :param compress: 是否压缩
+        :return: shell命令
+        """
+        compress_command = ""
+        if compress:
+            _, _, compress_command = self.get_compressor()
+        if file_list:
+            members = "--no-recursion --null -T '" + file_list + "'"
+        else:
+            members = "'" + os.path.basename(path) + "'"
+        if extra_file:
+            members += " -C '" + os.path.dirname(extra_file) + "' '" + \
+                       os.path.basename(extra_file) + "'"
+        command = self.get_priority_prefix() + \
+                  "cd '" + os.path.dirname(path) + \
+                  "' && tar cf - " + self._exclude + " " + members + \
+                  " 2>{err_log}".format(err_log=self._err_log)
+        if compress_command:
+            command += " | " + compress_command
+        if output:
+            command += " > '" + output + "'"
+        return command
+
     # 取数据库字符集
     def get_database_character(self, db_name):
         try:
@@ -962,102 +2568,2339 @@ class OSClient(object):
                 path = "/"
                 if len(args) == 3:
                     path = args[2]
-                data = client.get_list(path);
+                data = client.get_list(path, with_url=True);
             elif _type == 'lib':
                 data = client.get_lib()
+            elif _type == 'restore_tables':
+                db_name = args[3] if len(args) > 3 else None
+                data = client.restore_database_tables(args[2], db_name)
+            elif _type == 'sync_index':
+                data = client.sync_object_index()
+            elif _type == 'restore':
+                target = args[4] if len(args) > 4 else None
+                data = client.restore(args[2], args[3], target)
+            elif _type == 'reap':
+                max_age = float(args[2]) if len(args) > 2 else client.reap_age
+                data = client.reap_uploads(max_age * 3600)
+            elif _type == 'orphans':
+                data = client.find_orphans()
+            elif _type == 'gen_key':
+                key_file = args[2] if len(args) > 2 else None
+                data = client.generate_encrypt_key(key_file)
             elif _type == 'delete_file':
                 result = client.delete_object(args[2]);
                 if result:
                     print("文件{}删除成功。".format(args[2]))
                 else:
-                    print("文件{}删除失败!".format(args[2]))
-            else:
-                data = 'ERROR: 参数不正确!';
-            if data:
-                print()
-                print(json.dumps(data))
-        except Exception as e:
-            print(e)
+                    print("文件{}删除失败!".format(args[2]))
+            else:
+                data = 'ERROR: 参数不正确!';
+            if data:
+                print()
+                print(json.dumps(data))
+        except Exception as e:
+            print(e)
+
+    def echo_start(self):
+        print("=" * 90)
+        print("★开始备份[{}]".format(public.format_date()))
+        print("=" * 90)
+
+    def echo_end(self):
+        print("=" * 90)
+        print("☆备份完成[{}]".format(public.format_date()))
+        print("=" * 90)
+        print("\n")
+
+    def echo_info(self, msg):
+        print("|-{}".format(msg))
+
+    def echo_error(self, msg):
+        print("=" * 90)
+        print("|-错误：{}".format(msg))
+
+    def GetDiskInfo2(self):
+        # 取磁盘分区信息
+        temp = public.ExecShell("df -T -P|grep '/'|grep -v tmpfs")[0]
+        tempInodes = public.ExecShell("df -i -P|grep '/'|grep -v tmpfs")[0]
+        temp1 = temp.split('\n')
+        tempInodes1 = tempInodes.split('\n')
+        diskInfo = []
+        n = 0
+        cuts = []
+        for tmp in temp1:
+            n += 1
+            try:
+                inodes = tempInodes1[n - 1].split()
+                disk = re.findall(
+                    r"^(.+)\s+([\w\.]+)\s+([\w\.]+)\s+([\w\.]+)\s+([\w\.]+)\s+([\d%]{2,4})\s+(/.{0,50})$",
+                    tmp.strip())
+                if disk: disk = disk[0]
+                if len(disk) < 6: continue
+                if disk[2].find('M') != -1: continue
+                if disk[2].find('K') != -1: continue
+                if len(disk[6].split('/')) > 10: continue
+                if disk[6] in cuts: continue
+                if disk[6].find('docker') != -1: continue
+                if disk[1].strip() in ['tmpfs']: continue
+                arr = {}
+                arr['filesystem'] = disk[0].strip()
+                arr['type'] = disk[1].strip()
+                arr['path'] = disk[6]
+                tmp1 = [disk[2], disk[3], disk[4], disk[5]]
+                arr['size'] = tmp1
+                arr['inodes'] = [inodes[1], inodes[2], inodes[3], inodes[4]]
+                diskInfo.append(arr)
+            except:
+                continue
+        return diskInfo
+
+    # 取磁盘可用空间
+    def get_disk_free(self, dfile):
+        """取文件所在分区的可用空间
+
+        直接对文件所在(或最近的已存在的上级)目录调用statvfs。
+        :return: (挂载点, 可用字节数, 可用Inode数)，获取失败时为('', 0, 0)
+        """
+        try:
+            path = os.path.abspath(dfile)
+            while not os.path.exists(path):
+                path = os.path.dirname(path)
+            st = os.statvfs(path)
+            mount_point = os.path.realpath(path)
+            while not os.path.ismount(mount_point):
+                mount_point = os.path.dirname(mount_point)
+            return mount_point, float(st.f_bavail * st.f_frsize), \
+                int(st.f_ffree)
+        except Exception:
+            return '', 0, 0
+
+    # map to list
+    def map_to_list(self, map_obj):
+        try:
+            if type(map_obj) != list and type(map_obj) != str: map_obj = list(
+                map_obj)
+            return map_obj
+        except:
+            return []
+
+
+"""
+=============并发备份调度===================
+"""
+
+
+class _NoLimit(object):
+    """不限制并发的空上下文"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class BackupScheduler(object):
+    """批量备份调度
+
+    任务按数据大小从大到小分发给固定数量的工作线程，压缩(CPU)与上传(网络)
+    两个阶段分别由信号量限制并发数。单个任务失败不会中断其他任务，
+    全部完成后输出耗时与数据量汇总表。
+    """
+
+    def __init__(self, client, workers=1, compress_workers=1,
+                 upload_workers=1):
+        self.client = client
+        self.workers = max(1, int(workers))
+        self.slots = {
+            "compress": threading.Semaphore(max(1, int(compress_workers))),
+            "upload": threading.Semaphore(max(1, int(upload_workers))),
+        }
+        self.results = []
+        self.__queue = Queue()
+        self.__lock = threading.Lock()
+
+    def run(self, jobs):
+        """执行备份任务
+
+        :param jobs: [(名称, 数据大小, 备份方法名, 参数元组)]
+        :return: 执行结果列表
+        """
+        for job in sorted(jobs, key=lambda j: j[1], reverse=True):
+            self.__queue.put(job)
+
+        start_time = time.time()
+        if self.workers == 1:
+            self.__worker(0)
+        else:
+            threads = []
+            for i in range(min(self.workers, len(jobs))):
+                t = threading.Thread(target=self.__worker, args=(i,))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
+        self.echo_summary(time.time() - start_time)
+        return self.results
+
+    def __worker(self, index):
+        import copy
+        client = self.client
+        if self.workers > 1:
+            # 每个线程使用独立的客户端副本，避免共享排除规则、错误日志与数据库连接
+            client = copy.copy(self.client)
+            client._db_mysql = None
+            client._err_log = "/tmp/backup_err_{}.log".format(index)
+        client._stage_slots = self.slots
+
+        while True:
+            try:
+                name, size, method, args = self.__queue.get_nowait()
+            except Empty:
+                return
+            client._exclude = ""
+            client.error_msg = ""
+            client.last_backup_size = None
+            start_time = time.time()
+            error = ""
+            try:
+                getattr(client, method)(*args)
+            except Exception as e:
+                error = str(e)
+                client.echo_error("备份[{}]出现异常：{}".format(name, error))
+            result = {
+                "name": name,
+                "status": client.last_backup_size is not None,
+                "size": client.last_backup_size or 0,
+                "time": round(time.time() - start_time, 2),
+                "error": error or client.error_msg,
+            }
+            with self.__lock:
+                self.results.append(result)
+
+    def echo_summary(self, total_time):
+        success = [r for r in self.results if r["status"]]
+        print("=" * 90)
+        print("★批量备份汇总：成功{}个，失败{}个，总用时{:.2f}秒，上传{}".format(
+            len(success), len(self.results) - len(success), total_time,
+            public.to_size(sum(r["size"] for r in success))))
+        print("{:<40}{:<8}{:>16}{:>12}".format("名称", "状态", "大小", "用时(秒)"))
+        for r in self.results:
+            print("{:<40}{:<8}{:>16}{:>12}".format(
+                r["name"], "成功" if r["status"] else "失败",
+                public.to_size(r["size"]), r["time"]))
+        print("=" * 90)
+
+
+"""
+=============并行导出数据库===================
+"""
+
+
+def connect_mysql(db_name, character, password):
+    """使用root账号连接本机MySQL
+
+    :return: (连接, 流式游标类)
+    """
+    try:
+        import pymysql as driver
+        from pymysql.cursors import SSCursor
+        password_key, db_key = "password", "database"
+    except ImportError:
+        import MySQLdb as driver
+        from MySQLdb.cursors import SSCursor
+        password_key, db_key = "passwd", "db"
+
+    port = 3306
+    ports = re.findall(r"\nport\s*=\s*(\d+)",
+                       public.readFile("/etc/my.cnf") or "")
+    if ports:
+        port = int(ports[0])
+    kwargs = {
+        "host": "localhost",
+        "user": "root",
+        "port": port,
+        "charset": character.replace("-", ""),
+        "use_unicode": True,
+        password_key: password,
+        db_key: db_name,
+    }
+    if os.path.exists("/tmp/mysql.sock"):
+        kwargs["unix_socket"] = "/tmp/mysql.sock"
+    return driver.connect(**kwargs), SSCursor
+
+
+def quote_name(name):
+    return "`" + name.replace("`", "``") + "`"
+
+
+class ParallelDumper(object):
+    """按表并行导出数据库
+
+    主连接执行 FLUSH TABLES WITH READ LOCK 后，每个工作连接开启
+    START TRANSACTION WITH CONSISTENT SNAPSHOT，所有连接看到同一时刻的数据。
+    非事务表(MyISAM等)优先导出，导出完成前一直持有全局读锁；之后立即释放锁，
+    InnoDB表在各自的快照中继续导出。
+    表按information_schema中的数据大小从大到小分配给空闲的工作连接，
+    每张表写为一个独立的gzip压缩对象，最后写入记录所有表的清单对象。
+    """
+
+    INSERT_SIZE = 1024 * 1024
+    FETCH_ROWS = 1000
+    DECOMPRESS_MAX = 4 * 1024 * 1024
+    MANIFEST_SUFFIX = ".manifest"
+    TABLES_SUFFIX = ".tables/"
+    VIEWS_FILE = "__views__.sql.gz"
+    CODECS = {"utf8": "utf-8", "utf-8": "utf-8", "utf8mb4": "utf-8",
+              "gbk": "gbk", "big5": "big5"}
+
+    def __init__(self, client, db_name, character, password, workers=4):
+        self.client = client
+        self.db_name = db_name
+        self.character = character
+        self.password = password
+        self.workers = max(1, int(workers))
+        self.codec = self.CODECS.get(character.lower(), "utf-8")
+        self.error = None
+        self.__queue = Queue()
+        self.__lock = threading.Lock()
+        self.__unlocked = threading.Event()
+        self.__locked_tables = 0
+
+    def connect(self):
+        return connect_mysql(self.db_name, self.character, self.password)
+
+    def encode(self, text):
+        if isinstance(text, bytes):
+            return text
+        return text.encode(self.codec, "surrogateescape")
+
+    def literal(self, conn, value):
+        text = conn.literal(value)
+        if isinstance(text, bytes):
+            text = text.decode(self.codec, "surrogateescape")
+        return text
+
+    @classmethod
+    def get_tables_prefix(cls, manifest_object):
+        """清单对象对应的表对象目录"""
+        return manifest_object[:-len(cls.MANIFEST_SUFFIX)] + cls.TABLES_SUFFIX
+
+    def header(self):
+        return "/*!40101 SET NAMES {} */;\n" \
+               "/*!40014 SET UNIQUE_CHECKS=0 */;\n" \
+               "/*!40014 SET FOREIGN_KEY_CHECKS=0 */;\n" \
+               "/*!40101 SET SQL_MODE='NO_AUTO_VALUE_ON_ZERO' */;\n" \
+               "/*!40111 SET SQL_NOTES=0 */;\n\n".format(self.character)
+
+    def dump(self, manifest_object):
+        """导出数据库并上传
+
+        :param manifest_object: 清单对象名称，表对象存储在同名的.tables/目录下
+        :return: 上传的总字节数/False导出失败
+        """
+        prefix = self.get_tables_prefix(manifest_object)
+        main, _ = self.connect()
+        cursor = main.cursor()
+        cursor.execute(
+            "select TABLE_NAME,TABLE_TYPE,ENGINE,"
+            "ifnull(DATA_LENGTH,0)+ifnull(INDEX_LENGTH,0) "
+            "from information_schema.tables where table_schema=%s",
+            (self.db_name,))
+        tables = []
+        views = []
+        for name, table_type, engine, size in cursor.fetchall():
+            if table_type == "VIEW":
+                views.append(name)
+            else:
+                tables.append({"name": name, "engine": engine or "",
+                               "data_size": int(size)})
+        # 非事务表在持有全局读锁期间导出，排在最前面
+        tables.sort(key=lambda t: (t["engine"].lower() == "innodb",
+                                   -t["data_size"]))
+        self.__locked_tables = len(
+            [t for t in tables if t["engine"].lower() != "innodb"])
+
+        start_time = time.time()
+        conns = []
+        threads = []
+        cursor.execute("SET SESSION lock_wait_timeout=60")
+        cursor.execute("FLUSH TABLES WITH READ LOCK")
+        try:
+            for _ in range(min(self.workers, max(1, len(tables)))):
+                conn, ss_cursor = self.connect()
+                conns.append(conn)
+                c = conn.cursor()
+                c.execute("SET SESSION TRANSACTION ISOLATION LEVEL "
+                          "REPEATABLE READ")
+                c.execute("START TRANSACTION /*!40108 WITH CONSISTENT "
+                          "SNAPSHOT */")
+            for table in tables:
+                self.__queue.put(table)
+
+            for conn in conns:
+                t = threading.Thread(target=self.__worker,
+                                     args=(conn, ss_cursor, prefix))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            if not self.__locked_tables:
+                self.__unlocked.set()
+            self.__unlocked.wait()
+        finally:
+            cursor.execute("UNLOCK TABLES")
+        print("|-已释放全局读锁，持锁{:.2f}秒".format(time.time() - start_time))
+
+        for t in threads:
+            t.join()
+        views_object = None
+        if not self.error and views:
+            try:
+                views_object = prefix + self.VIEWS_FILE
+                self.dump_views(main, views, views_object)
+            except Exception as e:
+                self.error = e
+        for conn in conns + [main]:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+        if self.error:
+            self.client.error_msg = "数据库导出失败：{}".format(self.error)
+            self.client.delete_prefix(prefix)
+            return False
+
+        manifest = {
+            "version": 1,
+            "database": self.db_name,
+            "charset": self.character,
+            "time": int(start_time),
+            "tables": [{
+                "name": t["name"],
+                "engine": t["engine"],
+                "object": t["object"][len(prefix):],
+                "rows": t["rows"],
+                "size": t["size"],
+                "data_size": t["data_size"],
+            } for t in tables],
+            "views": views_object[len(prefix):] if views_object else None,
+            "size": sum(t["size"] for t in tables),
+        }
+        writer = self.client.open_upload_stream(manifest_object)
+        writer.write(json.dumps(manifest).encode("utf-8"))
+        return manifest["size"] + writer.close()
+
+    def __worker(self, conn, ss_cursor, prefix):
+        while True:
+            try:
+                table = self.__queue.get_nowait()
+            except Empty:
+                return
+            if not self.error:
+                try:
+                    start_time = time.time()
+                    table["object"] = prefix + table["name"] + ".sql.gz"
+                    writer = self.client.open_upload_stream(
+                        table["object"], size_hint=table["data_size"],
+                        num_threads=2)
+                    try:
+                        table["rows"] = self.dump_table(conn, ss_cursor,
+                                                        table["name"], writer)
+                        table["size"] = writer.close()
+                    except Exception:
+                        writer.abort()
+                        raise
+                    print("|-已导出表{}：{}行，压缩后{}，耗时{:.2f}秒".format(
+                        table["name"], table["rows"],
+                        public.to_size(table["size"]),
+                        time.time() - start_time))
+                except Exception as e:
+                    self.error = OsError("表{}导出失败：{}".format(
+                        table["name"], e))
+            if table["engine"].lower() != "innodb" or self.error:
+                with self.__lock:
+                    self.__locked_tables -= 1
+                    if self.__locked_tables <= 0 or self.error:
+                        self.__unlocked.set()
+
+    def dump_table(self, conn, ss_cursor, table, writer):
+        """将单张表的结构、数据与触发器写入writer
+
+        :return: 导出的行数
+        """
+        import gzip
+        out = gzip.GzipFile(fileobj=writer, mode="wb", compresslevel=6)
+        cursor = conn.cursor()
+        cursor.execute("SHOW CREATE TABLE " + quote_name(table))
+        create_sql = cursor.fetchone()[1]
+        cursor.execute(
+            "select COLUMN_NAME from information_schema.columns "
+            "where table_schema=%s and table_name=%s "
+            "and EXTRA not like '%%GENERATED%%' order by ORDINAL_POSITION",
+            (self.db_name, table))
+        columns = ",".join(quote_name(c[0]) for c in cursor.fetchall())
+
+        out.write(self.encode(self.header()))
+        out.write(self.encode(
+            "DROP TABLE IF EXISTS {0};\n{1};\n\n".format(quote_name(table),
+                                                         create_sql)))
+        insert = "INSERT INTO {} ({}) VALUES ".format(quote_name(table),
+                                                      columns)
+        rows = 0
+        values = []
+        values_size = 0
+        ss = conn.cursor(ss_cursor)
+        ss.execute("SELECT {} FROM {}".format(columns, quote_name(table)))
+        out.write(self.encode("/*!40000 ALTER TABLE {} DISABLE KEYS */;\n"
+                              .format(quote_name(table))))
+        while True:
+            fetched = ss.fetchmany(self.FETCH_ROWS)
+            if not fetched:
+                break
+            for row in fetched:
+                value = "(" + ",".join(self.literal(conn, v)
+                                       for v in row) + ")"
+                values.append(value)
+                values_size += len(value)
+                rows += 1
+                if values_size >= self.INSERT_SIZE:
+                    out.write(self.encode(insert + ",".join(values) + ";\n"))
+                    values = []
+                    values_size = 0
+        if values:
+            out.write(self.encode(insert + ",".join(values) + ";\n"))
+        ss.close()
+        out.write(self.encode("/*!40000 ALTER TABLE {} ENABLE KEYS */;\n\n"
+                              .format(quote_name(table))))
+
+        cursor.execute(
+            "select TRIGGER_NAME from information_schema.triggers "
+            "where EVENT_OBJECT_SCHEMA=%s and EVENT_OBJECT_TABLE=%s",
+            (self.db_name, table))
+        for trigger in [t[0] for t in cursor.fetchall()]:
+            cursor.execute("SHOW CREATE TRIGGER " + quote_name(trigger))
+            out.write(self.encode(
+                "DROP TRIGGER IF EXISTS {};\nDELIMITER ;;\n{} ;;\n"
+                "DELIMITER ;\n".format(quote_name(trigger),
+                                       cursor.fetchone()[2])))
+        out.close()
+        return rows
+
+    def dump_views(self, conn, views, object_name):
+        """导出视图定义，被引用的视图排在前面"""
+        import gzip
+        cursor = conn.cursor()
+        definitions = {}
+        for view in views:
+            cursor.execute("SHOW CREATE VIEW " + quote_name(view))
+            definitions[view] = cursor.fetchone()[1]
+
+        ordered = []
+
+        def add(view, path):
+            if view in ordered or view in path:
+                return
+            for other in views:
+                if other != view and \
+                        quote_name(other) in definitions[view]:
+                    add(other, path + [view])
+            ordered.append(view)
+
+        for view in views:
+            add(view, [])
+
+        writer = self.client.open_upload_stream(object_name)
+        try:
+            out = gzip.GzipFile(fileobj=writer, mode="wb", compresslevel=6)
+            out.write(self.encode(self.header()))
+            for view in ordered:
+                out.write(self.encode(
+                    "DROP TABLE IF EXISTS {0};\nDROP VIEW IF EXISTS {0};\n"
+                    "{1};\n\n".format(quote_name(view), definitions[view])))
+            out.close()
+            writer.close()
+        except Exception:
+            writer.abort()
+            raise
+
+    def restore(self, manifest_object, db_name=None):
+        """按清单并行导入各表，全部完成后导入视图
+
+        :param manifest_object: 清单对象名称
+        :param db_name: 导入的目标数据库，默认为原数据库
+        :return: 导入的表数量
+        """
+        manifest = json.loads(
+            self.client.read_object(manifest_object).read().decode("utf-8"))
+        db_name = db_name or manifest["database"]
+        self.character = manifest.get("charset", self.character)
+        prefix = self.get_tables_prefix(manifest_object)
+
+        for table in sorted(manifest["tables"],
+                            key=lambda t: t["data_size"], reverse=True):
+            self.__queue.put(prefix + table["object"])
+        threads = []
+        for _ in range(min(self.workers, max(1, len(manifest["tables"])))):
+            t = threading.Thread(target=self.__restore_worker,
+                                 args=(db_name,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if not self.error and manifest.get("views"):
+            try:
+                self.restore_object(prefix + manifest["views"], db_name)
+            except Exception as e:
+                self.error = e
+        if self.error:
+            raise OsError("数据库导入失败：{}".format(self.error))
+        return len(manifest["tables"])
+
+    def __restore_worker(self, db_name):
+        while not self.error:
+            try:
+                object_name = self.__queue.get_nowait()
+            except Empty:
+                return
+            try:
+                start_time = time.time()
+                self.restore_object(object_name, db_name)
+                print("|-已导入{}，耗时{:.2f}秒".format(
+                    object_name, time.time() - start_time))
+            except Exception as e:
+                self.error = e
+
+    def restore_object(self, object_name, db_name):
+        """下载gzip压缩的SQL对象，边解压边导入mysql
+
+        mysql的错误输出写入临时文件，避免管道写满阻塞；mysql出错退出后
+        写入会失败，此时以mysql的错误信息报错。
+        """
+        import tempfile
+        import zlib
+        env = dict(os.environ, MYSQL_PWD=self.password)
+        err_file = tempfile.TemporaryFile()
+        try:
+            process = subprocess.Popen(
+                ["/www/server/mysql/bin/mysql", "-uroot",
+                 "--default-character-set=" + self.character, db_name],
+                stdin=subprocess.PIPE, stderr=err_file, env=env)
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            stream = self.client.read_object(object_name)
+            write_error = None
+            try:
+                while True:
+                    data = stream.read(1024 * 1024)
+                    if not data:
+                        break
+                    # 限制每次解压输出的大小，高压缩比的数据不会一次占满内存
+                    while data:
+                        process.stdin.write(decompressor.decompress(
+                            data, self.DECOMPRESS_MAX))
+                        data = decompressor.unconsumed_tail
+                process.stdin.write(decompressor.flush())
+            except (IOError, OSError) as e:
+                write_error = e
+            finally:
+                try:
+                    process.stdin.close()
+                except (IOError, OSError):
+                    pass
+                return_code = process.wait()
+            err_file.seek(0)
+            error = err_file.read().decode("utf-8", "ignore").strip()
+        finally:
+            err_file.close()
+        if return_code != 0 or write_error:
+            raise OsError("{}导入失败：{}".format(
+                object_name, error or write_error))
+
+
+"""
+=============CRC64校验===================
+"""
+
+# OSS使用的CRC64(ECMA-182)，按位反转的多项式
+CRC64_POLY = 0xC96C5795D7870F42
+_crc64_shift_cache = {}
+_crc64_shift_lock = threading.Lock()
+
+
+def _gf2_matrix_times(mat, vec):
+    result = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            result ^= mat[i]
+        vec >>= 1
+        i += 1
+    return result
+
+
+def _gf2_matrix_multiply(a, b):
+    return [_gf2_matrix_times(a, col) for col in b]
+
+
+def crc64_shift_matrix(length):
+    """CRC值后接length个零字节的变换矩阵，按长度缓存
+
+    参照zlib的crc32_combine：先构造1个零比特的变换，反复平方得到
+    1、2、4...字节的变换，再按length的二进制位组合。
+    """
+    with _crc64_shift_lock:
+        mat = _crc64_shift_cache.get(length)
+    if mat is not None:
+        return mat
+
+    op = [CRC64_POLY] + [1 << n for n in range(63)]
+    for _ in range(3):
+        op = _gf2_matrix_multiply(op, op)
+    mat = [1 << n for n in range(64)]
+    n = length
+    while n:
+        if n & 1:
+            mat = _gf2_matrix_multiply(op, mat)
+        n >>= 1
+        if n:
+            op = _gf2_matrix_multiply(op, op)
+    with _crc64_shift_lock:
+        if len(_crc64_shift_cache) > 64:
+            _crc64_shift_cache.clear()
+        _crc64_shift_cache[length] = mat
+    return mat
+
+
+def crc64_combine(crc1, crc2, len2):
+    """由crc(A)、crc(B)与len(B)计算crc(A+B)，不需要重新读取数据"""
+    if not len2:
+        return crc1
+    return _gf2_matrix_times(crc64_shift_matrix(len2), crc1) ^ crc2
+
+
+def crc64_combine_parts(parts):
+    """按顺序合并各分片的CRC64
+
+    :param parts: [(crc64, 长度)]
+    """
+    crc = 0
+    for part_crc, size in parts:
+        crc = crc64_combine(crc, part_crc, size)
+    return crc
+
+
+"""
+=============备份限速===================
+"""
+
+
+def in_time_range(time_range, now=None):
+    """判断时间是否在"HH:MM-HH:MM"时间段内，结束时间小于开始时间表示跨零点"""
+    try:
+        start, end = [int(t.split(":")[0]) * 60 + int(t.split(":")[1])
+                      for t in time_range.split("-")]
+    except Exception:
+        return False
+    now = time.localtime(now)
+    minutes = now.tm_hour * 60 + now.tm_min
+    if start <= end:
+        return start <= minutes < end
+    return minutes >= start or minutes < end
+
+
+class TokenBucket(object):
+    """令牌桶限速
+
+    速率在每次消费时传入，时间段切换后立即生效；令牌不足时记为欠账，
+    调用方按欠账等待，多个线程并发消费时总速率不超过限制。
+    """
+
+    def __init__(self, burst_seconds=1.0):
+        self.burst_seconds = burst_seconds
+        self.__tokens = 0.0
+        self.__last = time.time()
+        self.__lock = threading.Lock()
+
+    def consume(self, size, rate):
+        """消费size个令牌，rate为每秒令牌数，0表示不限制"""
+        if rate <= 0 or size <= 0:
+            return
+        with self.__lock:
+            now = time.time()
+            self.__tokens = min(rate * self.burst_seconds,
+                                self.__tokens + (now - self.__last) * rate)
+            self.__last = now
+            self.__tokens -= size
+            wait = -self.__tokens / rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+# 进程内所有上传共用的令牌桶
+_upload_bucket = TokenBucket()
+
+
+class _ThrottledProgress(object):
+    """进度回调包装，按已上传字节数的增量消费令牌
+
+    第一次回调只记录起点，断点续传时已完成的部分不计入限速。
+    """
+
+    def __init__(self, throttle, callback=None):
+        self.throttle = throttle
+        self.callback = callback
+        self.__consumed = None
+        self.__lock = threading.Lock()
+
+    def __call__(self, consumed, total):
+        with self.__lock:
+            delta = 0
+            if self.__consumed is not None:
+                delta = consumed - self.__consumed
+            self.__consumed = max(consumed, self.__consumed or 0)
+        if delta > 0:
+            self.throttle(delta)
+        if self.callback:
+            self.callback(consumed, total)
+
+
+"""
+=============客户端加密===================
+"""
+
+# 加密对象的元数据标记
+ENCRYPT_META = "x-oss-meta-bt-encryption"
+ENCRYPT_ALGORITHM = "aes-256-gcm"
+
+
+class BackupCipher(object):
+    """分块AES-256-GCM加密格式
+
+    密文 = 文件头 + 记录...，文件头为 MAGIC + 密钥指纹(8) + 随机nonce前缀(8) +
+    记录明文大小(4)。第i条记录以nonce前缀+序号i作为nonce，文件头与是否为最后
+    一条记录作为附加认证数据，记录被篡改、调换顺序或截断都无法通过认证。
+    每条记录可以独立加解密，多个线程可以并行处理。
+    """
+
+    MAGIC = b"BTENC\x01"
+    HEADER_SIZE = 26
+    TAG_SIZE = 16
+    RECORD_SIZE = 1024 * 1024
+
+    def __init__(self, key):
+        if AESGCM is None:
+            raise OsError("加密备份需要安装cryptography模块：pip install cryptography")
+        if len(key) != 32:
+            raise OsError("密钥长度必须为32字节")
+        self.aead = AESGCM(key)
+        self.key_id = hashlib.sha256(key).digest()[:8]
+
+    @classmethod
+    def load(cls, key_file):
+        """从密钥文件(64位十六进制字符串)加载"""
+        import binascii
+        try:
+            with open(key_file) as f:
+                key = binascii.unhexlify(f.read().strip())
+        except Exception as e:
+            raise OsError("读取密钥文件{}失败：{}".format(key_file, e))
+        return cls(key)
+
+    @staticmethod
+    def generate_key(key_file):
+        """生成随机密钥并保存，密钥文件已存在时不覆盖"""
+        import binascii
+        if os.path.exists(key_file):
+            raise OsError("密钥文件{}已存在".format(key_file))
+        fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 384)
+        with os.fdopen(fd, "w") as f:
+            f.write(binascii.hexlify(os.urandom(32)).decode("ascii") + "\n")
+        return key_file
+
+    def new_header(self):
+        import struct
+        return self.MAGIC + self.key_id + os.urandom(8) + \
+            struct.pack(">I", self.RECORD_SIZE)
+
+    def parse_header(self, header):
+        """校验文件头，返回记录明文大小"""
+        import struct
+        if len(header) != self.HEADER_SIZE or \
+                header[:len(self.MAGIC)] != self.MAGIC:
+            raise OsError("不是有效的加密备份文件")
+        if header[6:14] != self.key_id:
+            raise OsError("加密备份使用的密钥与当前密钥不一致")
+        return struct.unpack(">I", header[22:26])[0]
+
+    def __nonce_aad(self, header, index, last):
+        import struct
+        return header[14:22] + struct.pack(">I", index), \
+            header + (b"\x01" if last else b"\x00")
+
+    def encrypt_record(self, header, index, data, last):
+        nonce, aad = self.__nonce_aad(header, index, last)
+        return self.aead.encrypt(nonce, data, aad)
+
+    def decrypt_record(self, header, index, data, last):
+        nonce, aad = self.__nonce_aad(header, index, last)
+        try:
+            return self.aead.decrypt(nonce, data, aad)
+        except Exception:
+            raise OsError("加密备份第{}条记录认证失败，数据已损坏或被篡改".format(
+                index))
+
+
+class EncryptingWriter(object):
+    """加密写入
+
+    写入的明文按记录切分，由多个线程并行加密后按顺序写入fileobj
+    (如StreamUploader)；close/abort同时结束fileobj。
+    """
+
+    def __init__(self, fileobj, cipher, num_threads=4):
+        self.fileobj = fileobj
+        self.cipher = cipher
+        self.header = cipher.new_header()
+        self.size = 0
+        self.__index = 0
+        self.__buffer = []
+        self.__buffered = 0
+        self.__pending = []
+        self.__jobs = Queue()
+        self.__window = max(1, num_threads) * 2
+        self.__threads = []
+        for _ in range(max(1, num_threads)):
+            t = threading.Thread(target=self.__worker)
+            t.daemon = True
+            t.start()
+            self.__threads.append(t)
+        self.fileobj.write(self.header)
+
+    def __worker(self):
+        while True:
+            job = self.__jobs.get()
+            if job is None:
+                return
+            try:
+                job["result"] = self.cipher.encrypt_record(
+                    self.header, job["index"], job["data"], job["last"])
+            except Exception as e:
+                job["error"] = e
+            job["data"] = None
+            job["event"].set()
+
+    def write(self, data):
+        self.__buffer.append(data)
+        self.__buffered += len(data)
+        record_size = self.cipher.RECORD_SIZE
+        # 至少保留1字节，保证最后一条记录在close时才提交
+        if self.__buffered > record_size:
+            data = b"".join(self.__buffer)
+            while len(data) > record_size:
+                self.__submit(data[:record_size], False)
+                data = data[record_size:]
+            self.__buffer = [data]
+            self.__buffered = len(data)
+
+    def __submit(self, data, last):
+        job = {"index": self.__index, "data": data, "last": last,
+               "result": None, "error": None, "event": threading.Event()}
+        self.__index += 1
+        self.size += len(data)
+        self.__pending.append(job)
+        self.__jobs.put(job)
+        while len(self.__pending) > self.__window:
+            self.__write_next()
+
+    def __write_next(self):
+        job = self.__pending.pop(0)
+        job["event"].wait()
+        if job["error"]:
+            raise job["error"]
+        self.fileobj.write(job["result"])
+
+    def __stop(self):
+        for _ in self.__threads:
+            self.__jobs.put(None)
+        self.__threads = []
+
+    def close(self):
+        """加密剩余数据并结束fileobj
+
+        :return: fileobj.close()的返回值
+        """
+        try:
+            self.__submit(b"".join(self.__buffer), True)
+            self.__buffer = []
+            self.__buffered = 0
+            while self.__pending:
+                self.__write_next()
+        finally:
+            self.__stop()
+        return self.fileobj.close()
+
+    def abort(self):
+        self.__stop()
+        self.fileobj.abort()
+
+
+class DecryptingReader(object):
+    """解密读取
+
+    按顺序读取stream中的记录并解密，预读一条记录以判断是否为最后一条，
+    数据被截断时无法通过认证。
+    """
+
+    def __init__(self, stream, cipher):
+        self.stream = stream
+        self.cipher = cipher
+        self.header = self.__read_exact(cipher.HEADER_SIZE)
+        self.record_size = cipher.parse_header(self.header) + cipher.TAG_SIZE
+        self.__index = 0
+        self.__next = self.__read_exact(self.record_size)
+        self.__buffer = b""
+        self.__pos = 0
+        self.__done = False
+
+    def __read_exact(self, size):
+        chunks = []
+        while size > 0:
+            data = self.stream.read(size)
+            if not data:
+                break
+            chunks.append(data)
+            size -= len(data)
+        return b"".join(chunks)
+
+    def __decrypt_next(self):
+        record = self.__next
+        self.__next = b""
+        if len(record) == self.record_size:
+            self.__next = self.__read_exact(self.record_size)
+        last = not self.__next
+        if len(record) < self.cipher.TAG_SIZE:
+            raise OsError("加密备份数据不完整")
+        data = self.cipher.decrypt_record(self.header, self.__index, record,
+                                          last)
+        self.__index += 1
+        self.__done = last
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self.__buffer[self.__pos:]]
+            while not self.__done:
+                chunks.append(self.__decrypt_next())
+            self.__buffer, self.__pos = b"", 0
+            return b"".join(chunks)
+        while self.__pos >= len(self.__buffer):
+            if self.__done:
+                return b""
+            self.__buffer = self.__decrypt_next()
+            self.__pos = 0
+        data = self.__buffer[self.__pos:self.__pos + size]
+        self.__pos += len(data)
+        return data
+
+    def close(self):
+        if hasattr(self.stream, "close"):
+            self.stream.close()
+
+
+"""
+=============流式分片上传===================
+"""
+
+
+class StreamUploader(object):
+    """流式分片上传
+
+    写入的数据按part_size切分成分片，由后台线程并发上传，数据不需要在本地落地。
+    每个分片失败时独立重试；数据只能顺序读取一次，中断后不能续传，
+    store_dir下只记录upload id，供清理过期分片上传时对应本地记录；
+    待上传分片队列有上限，内存占用不超过 (num_threads + 2) * part_size。
+    数据总量未知，每上传GROW_PARTS个分片后分片大小翻倍，避免超出分片数上限。
+    """
+
+    MIN_PART_SIZE = 1024 * 1024 * 8
+    MAX_PART_SIZE = 1024 * 1024 * 1024
+    GROW_PARTS = 2000
+
+    def __init__(self, bucket, object_name,
+                 part_size=1024 * 1024 * 32,
+                 num_threads=3,
+                 store_dir="/tmp",
+                 retries=2,
+                 on_complete=None,
+                 throttle=None,
+                 headers=None,
+                 traffic_headers=None):
+        self.bucket = bucket
+        self.object_name = object_name
+        self.on_complete = on_complete
+        self.throttle = throttle
+        self.traffic_headers = traffic_headers
+        self.headers = headers
+        self.part_size = part_size
+        self.num_threads = max(1, num_threads)
+        self.retries = retries
+        self.upload_id = None
+        self.size = 0
+        self.parts = {}
+        self.error = None
+        self.crc = None
+
+        self.__buffer = []
+        self.__buffer_size = 0
+        self.__part_number = 0
+        self.__queue = Queue(maxsize=1)
+        self.__threads = []
+        self.__lock = threading.Lock()
+
+        store_key = hashlib.md5(
+            "{}/{}".format(bucket.bucket_name, object_name).encode("utf-8")
+        ).hexdigest()
+        self.store_file = os.path.join(store_dir, ".bt-stream-upload",
+                                       store_key)
+
+    def write(self, data):
+        """写入数据，缓冲区满一个分片时提交上传"""
+        if self.error:
+            raise self.error
+        if not data:
+            return
+        self.__buffer.append(data)
+        self.__buffer_size += len(data)
+        while self.__buffer_size >= self.part_size:
+            buffered = b"".join(self.__buffer)
+            self.__submit(buffered[:self.part_size])
+            rest = buffered[self.part_size:]
+            self.__buffer = [rest] if rest else []
+            self.__buffer_size = len(rest)
+
+    def close(self):
+        """提交剩余数据并完成分片上传
+
+        :return: 上传的总字节数
+        """
+        if self.__buffer_size or not self.__part_number:
+            self.__submit(b"".join(self.__buffer))
+            self.__buffer = []
+            self.__buffer_size = 0
+        self.__join()
+        if self.error:
+            raise self.error
+
+        parts = [self.parts[n] for n in sorted(self.parts)]
+        result = self.bucket.complete_multipart_upload(self.object_name,
+                                                       self.upload_id,
+                                                       parts)
+        self.__remove_record()
+        self.crc = self.check_crc(parts, result)
+        if self.on_complete:
+            self.on_complete(self.object_name, self.size, result.etag,
+                             getattr(result, "crc", None))
+        return self.size
+
+    def check_crc(self, parts, result):
+        """由各分片的CRC64合并出整个对象的CRC64并与服务器返回值比较
+
+        :return: 对象的CRC64，服务器未返回CRC64时为None
+        """
+        server_crc = getattr(result, "crc", None)
+        if server_crc is None or \
+                any(p.part_crc is None for p in parts):
+            return None
+        crc = crc64_combine_parts((p.part_crc, p.size) for p in parts)
+        if crc != int(server_crc):
+            try:
+                self.bucket.delete_object(self.object_name)
+            except Exception:
+                pass
+            raise OsError("文件{}校验失败，CRC64不一致：本地{}，服务器{}".format(
+                self.object_name, crc, server_crc))
+        return crc
+
+    def abort(self):
+        """取消分片上传并清理本地记录"""
+        if not self.error:
+            self.error = OsError("上传已取消。")
+        self.__join()
+        if self.upload_id:
+            try:
+                self.bucket.abort_multipart_upload(self.object_name,
+                                                   self.upload_id)
+            except Exception as e:
+                print("取消文件{}上传失败：{}".format(self.object_name, e))
+        self.__remove_record()
+
+    def __submit(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.bucket.init_multipart_upload(
+                self.object_name, headers=self.headers).upload_id
+            self.__save_record()
+            for i in range(self.num_threads):
+                t = threading.Thread(target=self.__worker)
+                t.daemon = True
+                t.start()
+                self.__threads.append(t)
+        self.__part_number += 1
+        self.size += len(data)
+        self.__queue.put((self.__part_number, data))
+        if self.__part_number % self.GROW_PARTS == 0 and \
+                self.part_size * 2 <= self.MAX_PART_SIZE:
+            self.part_size *= 2
+
+    def __join(self):
+        for _ in self.__threads:
+            self.__queue.put(None)
+        for t in self.__threads:
+            t.join()
+        self.__threads = []
+
+    def __worker(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            if self.error:
+                continue
+            part_number, data = item
+            try:
+                self.__upload_part(part_number, data)
+            except Exception as e:
+                self.error = e
+
+    def __upload_part(self, part_number, data, retries=None):
+        if retries is None:
+            retries = self.retries
+        if self.throttle:
+            self.throttle(len(data))
+        headers = None
+        if self.traffic_headers:
+            headers = self.traffic_headers(self.num_threads)
+        try:
+            result = self.bucket.upload_part(self.object_name,
+                                             self.upload_id,
+                                             part_number,
+                                             data,
+                                             headers=headers)
+        except Exception as e:
+            if retries > 0:
+                print("重试上传分片{}...".format(part_number))
+                time.sleep(1)
+                return self.__upload_part(part_number, data, retries - 1)
+            raise OsError("分片{}上传失败：{}".format(part_number, str(e)))
+
+        with self.__lock:
+            self.parts[part_number] = oss2.models.PartInfo(
+                part_number, result.etag, size=len(data),
+                part_crc=getattr(result, "crc", None))
+
+    def __save_record(self):
+        record = {
+            "bucket": self.bucket.bucket_name,
+            "key": self.object_name,
+            "upload_id": self.upload_id,
+            "mtime": int(time.time()),
+        }
+        store_dir = os.path.dirname(self.store_file)
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        public.writeFile(self.store_file, json.dumps(record))
+
+    def __remove_record(self):
+        if os.path.exists(self.store_file):
+            os.remove(self.store_file)
+
+
+"""
+=============分片并行下载===================
+"""
+
+
+class ParallelDownloader(object):
+    """分片并行下载
+
+    按part_size将对象切分为多个Range请求并发下载，写入本地临时文件的对应位置。
+    每个分片在接收数据时计算CRC64，全部完成后用crc64_combine合并并与
+    对象的x-oss-hash-crc64ecma比较，不需要再次读取整个文件。
+    已完成的分片及其CRC64记录在断点文件中，中断后可以继续下载。
+    """
+
+    def __init__(self, bucket, object_name, file_name,
+                 part_size=1024 * 1024 * 8,
+                 num_threads=4,
+                 store_dir="/tmp",
+                 progress_callback=None,
+                 multiget_threshold=0,
+                 retries=2):
+        self.bucket = bucket
+        self.object_name = object_name
+        self.file_name = file_name
+        self.part_size = max(1, part_size)
+        self.multiget_threshold = multiget_threshold
+        self.num_threads = max(1, num_threads)
+        self.progress_callback = progress_callback
+        self.retries = retries
+        self.temp_file = file_name + ".bt-download"
+        self.error = None
+        self.size = 0
+        self.parts = {}
+        self.__consumed = 0
+        self.__lock = threading.Lock()
+        self.__queue = Queue()
+
+        store_key = hashlib.md5("{}/{}:{}".format(
+            bucket.bucket_name, object_name,
+            os.path.abspath(file_name)).encode("utf-8")).hexdigest()
+        self.store_file = os.path.join(store_dir, ".bt-download", store_key)
+
+    def download(self):
+        """下载并校验
+
+        :return: 对象的CRC64
+        :raises OsError: 下载或校验失败
+        """
+        meta = self.bucket.head_object(self.object_name)
+        self.size = meta.content_length
+        etag = meta.etag
+        server_crc = meta.headers.get("x-oss-hash-crc64ecma")
+        if self.size <= self.multiget_threshold:
+            # 小文件不分片
+            self.part_size = max(1, self.size)
+
+        record = self.__load_checkpoint()
+        if not record or record.get("etag") != etag or \
+                record.get("size") != self.size or \
+                record.get("part_size") != self.part_size or \
+                not os.path.exists(self.temp_file):
+            record = {"etag": etag, "size": self.size,
+                      "part_size": self.part_size, "parts": {}}
+            with open(self.temp_file, "wb") as f:
+                f.truncate(self.size)
+        self.record = record
+        self.parts = dict((int(k), v) for k, v in record["parts"].items())
+
+        part_count = max(1, -(-self.size // self.part_size))
+        for n in range(part_count):
+            start = n * self.part_size
+            end = min(self.size, start + self.part_size)
+            if n in self.parts:
+                self.__consumed += end - start
+            else:
+                self.__queue.put((n, start, end))
+        self.__report()
+
+        threads = []
+        for _ in range(min(self.num_threads, self.__queue.qsize())):
+            t = threading.Thread(target=self.__worker, args=(etag,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if self.error:
+            raise self.error
+
+        crc = crc64_combine_parts(
+            (self.parts[n], min(self.size, (n + 1) * self.part_size) -
+             n * self.part_size) for n in range(part_count))
+        if server_crc is not None and str(crc) != str(server_crc):
+            self.__remove_checkpoint()
+            os.remove(self.temp_file)
+            raise OsError("文件校验失败，CRC64不一致：本地{}，服务器{}".format(
+                crc, server_crc))
+        os.rename(self.temp_file, self.file_name)
+        self.__remove_checkpoint()
+        return crc
+
+    def __worker(self, etag):
+        with open(self.temp_file, "r+b") as f:
+            while not self.error:
+                try:
+                    n, start, end = self.__queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    crc = self.__download_part(f, n, start, end, etag)
+                    with self.__lock:
+                        self.parts[n] = crc
+                        self.__save_checkpoint()
+                except Exception as e:
+                    self.error = e
+
+    def __download_part(self, f, n, start, end, etag, retries=None):
+        if retries is None:
+            retries = self.retries
+        if start == end:
+            return 0
+        crc64 = oss2.utils.Crc64(0)
+        received = 0
+        try:
+            stream = self.bucket.get_object(self.object_name,
+                                            byte_range=(start, end - 1),
+                                            headers={"If-Match":
+                                                     '"' + etag + '"'})
+            f.seek(start)
+            while True:
+                data = stream.read(1024 * 256)
+                if not data:
+                    break
+                crc64.update(data)
+                f.write(data)
+                received += len(data)
+                self.__add_progress(len(data))
+            if received != end - start:
+                raise OsError("分片{}数据不完整".format(n))
+        except Exception as e:
+            self.__add_progress(-received)
+            if retries > 0:
+                print("重试下载分片{}...".format(n))
+                time.sleep(1)
+                return self.__download_part(f, n, start, end, etag,
+                                            retries - 1)
+            raise OsError("分片{}下载失败：{}".format(n, str(e)))
+        return crc64.crc
+
+    def __add_progress(self, size):
+        with self.__lock:
+            self.__consumed += size
+            self.__report()
+
+    def __report(self):
+        if self.progress_callback:
+            self.progress_callback(self.__consumed, self.size)
+
+    def __load_checkpoint(self):
+        try:
+            return json.loads(public.readFile(self.store_file))
+        except Exception:
+            return None
+
+    def __save_checkpoint(self):
+        self.record["parts"] = dict((str(k), v) for k, v in self.parts.items())
+        store_dir = os.path.dirname(self.store_file)
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        public.writeFile(self.store_file, json.dumps(self.record))
+
+    def __remove_checkpoint(self):
+        if os.path.exists(self.store_file):
+            os.remove(self.store_file)
+
+
+class OrderedPrefetcher(object):
+    """有序并发预取
+
+    多个线程并发执行fetch(0..count-1)，结果按序号顺序返回；
+    已取回但尚未被读取的结果最多window个，内存占用有上限。
+    """
+
+    def __init__(self, fetch, count, num_threads=4, window=None):
+        self.fetch = fetch
+        self.count = count
+        self.window = max(1, window or num_threads * 2)
+        self.error = None
+        self.__results = {}
+        self.__next_fetch = 0
+        self.__next_read = 0
+        self.__closed = False
+        self.__cond = threading.Condition()
+        for _ in range(min(max(1, num_threads), count)):
+            t = threading.Thread(target=self.__worker)
+            t.daemon = True
+            t.start()
+
+    def __worker(self):
+        while True:
+            with self.__cond:
+                while not self.__closed and not self.error and \
+                        self.__next_fetch < self.count and \
+                        self.__next_fetch - self.__next_read >= self.window:
+                    self.__cond.wait()
+                if self.__closed or self.error or \
+                        self.__next_fetch >= self.count:
+                    return
+                n = self.__next_fetch
+                self.__next_fetch += 1
+            try:
+                result = self.fetch(n)
+            except Exception as e:
+                with self.__cond:
+                    self.error = e
+                    self.__cond.notify_all()
+                return
+            with self.__cond:
+                self.__results[n] = result
+                self.__cond.notify_all()
+
+    def __iter__(self):
+        while self.__next_read < self.count:
+            with self.__cond:
+                while self.__next_read not in self.__results and \
+                        not self.error:
+                    self.__cond.wait(1)
+                if self.error:
+                    raise self.error
+                result = self.__results.pop(self.__next_read)
+                self.__next_read += 1
+                self.__cond.notify_all()
+            yield result
+
+    def close(self):
+        with self.__cond:
+            self.__closed = True
+            self.__results.clear()
+            self.__cond.notify_all()
+
+
+class RangeReader(object):
+    """并发分片读取对象的文件对象
+
+    按part_size分片并发发起Range请求，read()按顺序返回数据，适合作为解压、
+    解包命令的输入。读取完毕时合并各分片的CRC64与对象的CRC64比较。
+    """
+
+    def __init__(self, bucket, object_name, part_size=1024 * 1024 * 8,
+                 num_threads=4, window=None, retries=2):
+        self.bucket = bucket
+        self.object_name = object_name
+        self.part_size = part_size
+        self.retries = retries
+        meta = bucket.head_object(object_name)
+        self.size = meta.content_length
+        self.etag = meta.etag
+        self.headers = meta.headers
+        self.server_crc = meta.headers.get("x-oss-hash-crc64ecma")
+        self.crc = 0
+        self.__buffer = b""
+        self.__pos = 0
+        self.__prefetcher = OrderedPrefetcher(
+            self.__fetch, -(-self.size // part_size),
+            num_threads=num_threads, window=window)
+        self.__parts = iter(self.__prefetcher)
+
+    def __fetch(self, n, retries=None):
+        if retries is None:
+            retries = self.retries
+        start = n * self.part_size
+        end = min(self.size, start + self.part_size)
+        try:
+            data = self.bucket.get_object(
+                self.object_name, byte_range=(start, end - 1),
+                headers={"If-Match": '"' + self.etag + '"'}).read()
+            if len(data) != end - start:
+                raise OsError("分片{}数据不完整".format(n))
+        except Exception as e:
+            if retries > 0:
+                time.sleep(1)
+                return self.__fetch(n, retries - 1)
+            raise OsError("分片{}下载失败：{}".format(n, str(e)))
+        crc64 = oss2.utils.Crc64(0)
+        crc64.update(data)
+        return data, crc64.crc
+
+    def read(self, size=-1):
+        while self.__pos >= len(self.__buffer):
+            try:
+                data, part_crc = next(self.__parts)
+            except StopIteration:
+                self.__verify()
+                return b""
+            self.crc = crc64_combine(self.crc, part_crc, len(data))
+            self.__buffer = data
+            self.__pos = 0
+        if size is None or size < 0:
+            size = len(self.__buffer) - self.__pos
+        data = self.__buffer[self.__pos:self.__pos + size]
+        self.__pos += len(data)
+        return data
+
+    def __verify(self):
+        if self.server_crc is not None and \
+                str(self.crc) != str(self.server_crc):
+            raise OsError("文件{}校验失败，CRC64不一致：本地{}，服务器{}".format(
+                self.object_name, self.crc, self.server_crc))
+
+    def close(self):
+        self.__prefetcher.close()
+
+
+"""
+=============可检索压缩包===================
+"""
+
+
+class _TeeReader(object):
+    """读取数据的同时交给sink处理"""
+
+    def __init__(self, stream, sink):
+        self.stream = stream
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data:
+            self.sink(data)
+        return data
+
+
+class SeekableArchiveWriter(object):
+    """可检索的tar.gz压缩包
+
+    tar数据流按BLOCK_SIZE切分，每块压缩为一个独立的gzip成员，拼接后仍是标准的
+    tar.gz；同时用tarfile解析经过的tar头，记录每个成员数据在未压缩流中的偏移。
+    还原单个文件时根据成员索引只下载包含该成员的压缩块。
+
+    索引格式(gzip压缩的json)：
+        blocks: [[压缩流偏移, 未压缩流偏移]]
+        members: [[名称, 类型f/d/l/o, 大小, 修改时间, 数据偏移]]
+    """
+
+    BLOCK_SIZE = 1024 * 1024 * 4
+    INDEX_SUFFIX = ".idx"
+
+    def __init__(self, fileobj, num_threads=4, level=6):
+        self.fileobj = fileobj
+        self.level = level
+        self.blocks = []
+        self.members = []
+        self.size = 0
+        self.compressed_size = 0
+        self.__buffer = []
+        self.__buffered = 0
+        self.__pending = []
+        self.__jobs = Queue()
+        self.__window = max(1, num_threads) * 2
+        self.__threads = []
+        for _ in range(max(1, num_threads)):
+            t = threading.Thread(target=self.__worker)
+            t.daemon = True
+            t.start()
+            self.__threads.append(t)
+
+    def __worker(self):
+        import zlib
+        while True:
+            job = self.__jobs.get()
+            if job is None:
+                return
+            try:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                              16 + zlib.MAX_WBITS)
+                job["result"] = compressor.compress(job["data"]) + \
+                    compressor.flush()
+            except Exception as e:
+                job["error"] = e
+            job["data"] = None
+            job["event"].set()
+
+    def write(self, data):
+        self.__buffer.append(data)
+        self.__buffered += len(data)
+        if self.__buffered >= self.BLOCK_SIZE:
+            data = b"".join(self.__buffer)
+            while len(data) >= self.BLOCK_SIZE:
+                self.__submit(data[:self.BLOCK_SIZE])
+                data = data[self.BLOCK_SIZE:]
+            self.__buffer = [data]
+            self.__buffered = len(data)
+
+    def __submit(self, data):
+        job = {"data": data, "offset": self.size, "result": None,
+               "error": None, "event": threading.Event()}
+        self.size += len(data)
+        self.__pending.append(job)
+        self.__jobs.put(job)
+        while len(self.__pending) > self.__window:
+            self.__write_next()
+
+    def __write_next(self):
+        job = self.__pending.pop(0)
+        job["event"].wait()
+        if job["error"]:
+            raise job["error"]
+        self.blocks.append([self.compressed_size, job["offset"]])
+        self.fileobj.write(job["result"])
+        self.compressed_size += len(job["result"])
+
+    def add_stream(self, stream):
+        """读取tar数据流，压缩写入并记录成员索引"""
+        import tarfile
+        reader = _TeeReader(stream, self.write)
+        with tarfile.open(fileobj=reader, mode="r|",
+                          bufsize=1024 * 1024) as tar:
+            for info in tar:
+                if info.isfile():
+                    member_type = "f"
+                elif info.isdir():
+                    member_type = "d"
+                elif info.issym():
+                    member_type = "l"
+                else:
+                    member_type = "o"
+                self.members.append([info.name, member_type, info.size,
+                                     int(info.mtime), info.offset_data])
+        # tar结尾的空块等剩余数据
+        while reader.read(1024 * 1024):
+            pass
 
-    def echo_start(self):
-        print("=" * 90)
-        print("★开始备份[{}]".format(public.format_date()))
-        print("=" * 90)
+    def close(self):
+        """写入剩余数据
 
-    def echo_end(self):
-        print("=" * 90)
-        print("☆备份完成[{}]".format(public.format_date()))
-        print("=" * 90)
-        print("\n")
+        :return: 成员索引
+        """
+        if self.__buffered:
+            self.__submit(b"".join(self.__buffer))
+            self.__buffer = []
+            self.__buffered = 0
+        while self.__pending:
+            self.__write_next()
+        return {
+            "version": 1,
+            "block_size": self.BLOCK_SIZE,
+            "blocks": self.blocks,
+            "members": self.members,
+            "size": self.size,
+            "compressed_size": self.compressed_size,
+        }
 
-    def echo_info(self, msg):
-        print("|-{}".format(msg))
+    def build(self, stream):
+        """压缩整个tar数据流
 
-    def echo_error(self, msg):
-        print("=" * 90)
-        print("|-错误：{}".format(msg))
+        :return: 成员索引
+        """
+        try:
+            self.add_stream(stream)
+            return self.close()
+        finally:
+            for _ in self.__threads:
+                self.__jobs.put(None)
+
+    @staticmethod
+    def dumps_index(index):
+        import gzip
+        import io
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+            f.write(json.dumps(index).encode("utf-8"))
+        return buf.getvalue()
+
+    @staticmethod
+    def loads_index(data):
+        import gzip
+        import io
+        with gzip.GzipFile(fileobj=io.BytesIO(data), mode="rb") as f:
+            return json.loads(f.read().decode("utf-8"))
+
+    @staticmethod
+    def get_block_range(index, start, end):
+        """获取未压缩数据[start, end)所在压缩块的字节范围
+
+        :return: (压缩流起始偏移, 压缩流结束偏移(不含), 起始块的未压缩偏移)
+        """
+        import bisect
+        blocks = index["blocks"]
+        offsets = [b[1] for b in blocks]
+        first = max(0, bisect.bisect_right(offsets, start) - 1)
+        last = max(first, bisect.bisect_right(offsets, max(start, end - 1)) - 1)
+        if last + 1 < len(blocks):
+            compressed_end = blocks[last + 1][0]
+        else:
+            compressed_end = index["compressed_size"]
+        return blocks[first][0], compressed_end, blocks[first][1]
 
-    def GetDiskInfo2(self):
-        # 取磁盘分区信息
-        temp = public.ExecShell("df -T -P|grep '/'|grep -v tmpfs")[0]
-        tempInodes = public.ExecShell("df -i -P|grep '/'|grep -v tmpfs")[0]
-        temp1 = temp.split('\n')
-        tempInodes1 = tempInodes.split('\n')
-        diskInfo = []
-        n = 0
-        cuts = []
-        for tmp in temp1:
-            n += 1
+
+"""
+=============去重分块存储===================
+"""
+
+
+class ContentChunker(object):
+    """内容定义分块
+
+    每个字节经随机表映射为一个比特，当最近的若干字节映射出的比特串等于固定模式时切分。
+    切分点只取决于局部内容，数据中间插入或删除内容只影响附近的数据块；
+    映射与查找由bytes.translate/find完成，不需要逐字节的Python循环。
+    """
+
+    def __init__(self, avg_size=1024 * 1024):
+        self.min_size = max(4096, avg_size // 4)
+        self.max_size = max(avg_size, 4096) * 4
+        bits = max(8, int(round(math.log(max(2, avg_size - self.min_size),
+                                         2))))
+
+        table = bytearray(256)
+        for i in range(256):
+            digest = bytearray(
+                hashlib.md5(("bt-cdc-%d" % i).encode("utf-8")).digest())
+            table[i] = 48 + (digest[0] & 1)
+        self.table = bytes(table)
+        seed = bytearray(hashlib.sha256(b"bt-cdc-pattern").digest())
+        self.pattern = bytes(bytearray(
+            48 + ((seed[i // 8] >> (i % 8)) & 1) for i in range(bits)))
+
+    def find_cut(self, buf):
+        """返回第一个数据块的长度，buf不足max_size时视为数据末尾"""
+        size = len(buf)
+        if size <= self.min_size:
+            return size
+        end = min(size, self.max_size)
+        start = self.min_size - len(self.pattern)
+        step = self.min_size * 2
+        while start < end:
+            stop = min(end, start + step)
+            pos = buf[start:stop].translate(self.table).find(self.pattern)
+            if pos != -1:
+                return start + pos + len(self.pattern)
+            if stop == end:
+                break
+            start = stop - len(self.pattern) + 1
+        return end
+
+    def split(self, stream, read_size=1024 * 1024):
+        """从stream中读取数据并依次返回数据块"""
+        buf = bytearray()
+        eof = False
+        while True:
+            while not eof and len(buf) < self.max_size:
+                data = stream.read(read_size)
+                if not data:
+                    eof = True
+                else:
+                    buf += data
+            if not buf:
+                return
+            cut = self.find_cut(buf)
+            yield bytes(buf[:cut])
+            del buf[:cut]
+
+
+class _FileLock(object):
+    """基于flock的进程间文件锁"""
+
+    def __init__(self, file_name, shared=False):
+        self.file_name = file_name
+        self.shared = shared
+        self.__f = None
+
+    def __enter__(self):
+        import fcntl
+        self.__f = open(self.file_name, "a")
+        fcntl.flock(self.__f.fileno(),
+                    fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        import fcntl
+        fcntl.flock(self.__f.fileno(), fcntl.LOCK_UN)
+        self.__f.close()
+        return False
+
+
+class DedupStore(object):
+    """去重分块存储
+
+    数据块以SHA256命名，zlib压缩后只存储一次：
+        <prefix>chunks/<哈希前2位>/<哈希>
+    每次备份生成一个快照索引对象(gzip压缩的JSON)，按顺序记录组成数据的数据块。
+    本地缓存已确认存在的数据块，避免逐块查询；备份持有共享锁，回收持有排他锁，
+    防止回收删除正在备份中被引用的数据块。
+    """
+
+    CHUNK_DIR = "chunks/"
+    INDEX_SUFFIX = ".dedup"
+
+    def __init__(self, bucket, prefix, cache_dir, avg_size=1024 * 1024,
+                 num_threads=4, retries=2, throttle=None,
+                 traffic_headers=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.throttle = throttle
+        self.traffic_headers = traffic_headers
+        self.chunker = ContentChunker(avg_size)
+        self.num_threads = max(1, num_threads)
+        self.retries = retries
+        self.error = None
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, 384)
+        store_key = hashlib.md5(
+            "{}/{}".format(bucket.bucket_name, prefix).encode("utf-8")
+        ).hexdigest()
+        self.cache_file = os.path.join(cache_dir, store_key + ".chunks")
+        self.lock_file = os.path.join(cache_dir, store_key + ".lock")
+        self.__lock = threading.Lock()
+
+    def chunk_key(self, chunk_hash):
+        return self.prefix + self.CHUNK_DIR + chunk_hash[:2] + "/" + chunk_hash
+
+    def load_cache(self):
+        if not os.path.exists(self.cache_file):
+            return set()
+        with open(self.cache_file) as f:
+            return set(line.strip() for line in f if line.strip())
+
+    def backup(self, stream, index_name, source=""):
+        """分块上传数据并写入快照索引
+
+        :return: {"size": 数据总大小, "chunks": 块数, "new_chunks": 新增块数,
+                  "new_size": 新增块压缩后大小}
+        """
+        stats = {"size": 0, "chunks": 0, "new_chunks": 0, "new_size": 0}
+        with _FileLock(self.lock_file, shared=True):
+            known = self.load_cache()
+            uploaded = []
+            queue = Queue(maxsize=self.num_threads * 2)
+
+            def worker():
+                while True:
+                    item = queue.get()
+                    if item is None:
+                        return
+                    if self.error:
+                        continue
+                    try:
+                        size = self.__put_chunk(item[0], item[1])
+                        with self.__lock:
+                            uploaded.append(item[0])
+                            if size:
+                                stats["new_chunks"] += 1
+                                stats["new_size"] += size
+                    except Exception as e:
+                        self.error = e
+
+            threads = []
+            for i in range(self.num_threads):
+                t = threading.Thread(target=worker)
+                t.daemon = True
+                t.start()
+                threads.append(t)
+
+            chunks = []
+            pending = set()
             try:
-                inodes = tempInodes1[n - 1].split()
-                disk = re.findall(
-                    r"^(.+)\s+([\w\.]+)\s+([\w\.]+)\s+([\w\.]+)\s+([\w\.]+)\s+([\d%]{2,4})\s+(/.{0,50})$",
-                    tmp.strip())
-                if disk: disk = disk[0]
-                if len(disk) < 6: continue
-                if disk[2].find('M') != -1: continue
-                if disk[2].find('K') != -1: continue
-                if len(disk[6].split('/')) > 10: continue
-                if disk[6] in cuts: continue
-                if disk[6].find('docker') != -1: continue
-                if disk[1].strip() in ['tmpfs']: continue
-                arr = {}
-                arr['filesystem'] = disk[0].strip()
-                arr['type'] = disk[1].strip()
-                arr['path'] = disk[6]
-                tmp1 = [disk[2], disk[3], disk[4], disk[5]]
-                arr['size'] = tmp1
-                arr['inodes'] = [inodes[1], inodes[2], inodes[3], inodes[4]]
-                diskInfo.append(arr)
-            except:
-                continue
-        return diskInfo
+                for chunk in self.chunker.split(stream):
+                    if self.error:
+                        break
+                    chunk_hash = hashlib.sha256(chunk).hexdigest()
+                    chunks.append([chunk_hash, len(chunk)])
+                    stats["size"] += len(chunk)
+                    if chunk_hash not in known and chunk_hash not in pending:
+                        pending.add(chunk_hash)
+                        queue.put((chunk_hash, chunk))
+            finally:
+                for t in threads:
+                    queue.put(None)
+                for t in threads:
+                    t.join()
+                self.__append_cache(uploaded)
+            if self.error:
+                raise self.error
+
+            stats["chunks"] = len(chunks)
+            stats["index_size"], stats["index_etag"] = self.write_index(
+                index_name, {
+                "version": 1,
+                "source": source,
+                "time": int(time.time()),
+                "size": stats["size"],
+                "chunks": chunks,
+                })
+        return stats
+
+    def __put_chunk(self, chunk_hash, chunk, retries=None):
+        """上传数据块，已存在时返回0，否则返回上传的字节数"""
+        import zlib
+        if retries is None:
+            retries = self.retries
+        key = self.chunk_key(chunk_hash)
+        try:
+            if self.bucket.object_exists(key):
+                return 0
+            data = zlib.compress(chunk, 6)
+            if self.throttle:
+                self.throttle(len(data))
+            headers = None
+            if self.traffic_headers:
+                headers = self.traffic_headers(self.num_threads)
+            self.bucket.put_object(key, data, headers=headers)
+            return len(data)
+        except Exception as e:
+            if retries > 0:
+                time.sleep(1)
+                return self.__put_chunk(chunk_hash, chunk, retries - 1)
+            raise OsError("数据块{}上传失败：{}".format(chunk_hash, str(e)))
 
-    # 取磁盘可用空间
-    def get_disk_free(self, dfile):
-        diskInfo = self.GetDiskInfo2()
-        if not diskInfo: return '', 0, 0
-        _root = None
-        for d in diskInfo:
-            if d['path'] == '/':
-                _root = d
-                continue
-            if re.match("^{}/.+".format(d['path']), dfile):
-                return d['path'], float(d['size'][2]) * 1024, int(
-                    d['inodes'][2])
-        if _root:
-            return _root['path'], float(_root['size'][2]) * 1024, int(
-                _root['inodes'][2])
-        return '', 0, 0
+    def __append_cache(self, chunk_hashes):
+        if not chunk_hashes:
+            return
+        with open(self.cache_file, "a") as f:
+            f.write("\n".join(chunk_hashes) + "\n")
+
+    def write_index(self, index_name, index):
+        import gzip
+        import io
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+            f.write(json.dumps(index).encode("utf-8"))
+        data = buf.getvalue()
+        result = self.bucket.put_object(index_name, data)
+        return len(data), result.etag
+
+    def read_index(self, index_name):
+        import gzip
+        import io
+        data = self.bucket.get_object(index_name).read()
+        with gzip.GzipFile(fileobj=io.BytesIO(data), mode="rb") as f:
+            return json.loads(f.read().decode("utf-8"))
+
+    def read_chunk(self, chunk_hash):
+        import zlib
+        return zlib.decompress(
+            self.bucket.get_object(self.chunk_key(chunk_hash)).read())
+
+    def iter_data(self, index_name, window=None):
+        """按顺序读取快照数据，数据块由多个线程并发预取"""
+        chunks = self.read_index(index_name)["chunks"]
+
+        def fetch(i):
+            chunk_hash = chunks[i][0]
+            data = self.read_chunk(chunk_hash)
+            if hashlib.sha256(data).hexdigest() != chunk_hash:
+                raise OsError("数据块{}校验失败".format(chunk_hash))
+            return data
+
+        prefetcher = OrderedPrefetcher(fetch, len(chunks),
+                                       num_threads=self.num_threads,
+                                       window=window)
+        try:
+            for data in prefetcher:
+                yield data
+        finally:
+            prefetcher.close()
 
-    # map to list
-    def map_to_list(self, map_obj):
+    def gc(self, index_prefix):
+        """删除没有被index_prefix下任何快照索引引用的数据块
+
+        :return: (删除的块数, 释放的字节数)
+        """
+        with _FileLock(self.lock_file):
+            referenced = set()
+            for obj in oss2.ObjectIterator(self.bucket, prefix=index_prefix):
+                if obj.key.endswith(self.INDEX_SUFFIX):
+                    index = self.read_index(obj.key)
+                    referenced.update(c[0] for c in index["chunks"])
+
+            garbage = []
+            freed = 0
+            for obj in oss2.ObjectIterator(self.bucket,
+                                           prefix=self.prefix + self.CHUNK_DIR):
+                if obj.key.rsplit("/", 1)[-1] not in referenced:
+                    garbage.append(obj.key)
+                    freed += obj.size
+
+            for i in range(0, len(garbage), 1000):
+                self.bucket.batch_delete_objects(garbage[i:i + 1000])
+
+            known = self.load_cache() & referenced
+            tmp_file = self.cache_file + ".tmp"
+            with open(tmp_file, "w") as f:
+                f.write("".join(h + "\n" for h in known))
+            os.rename(tmp_file, self.cache_file)
+        return len(garbage), freed
+
+
+"""
+=============远程对象索引===================
+"""
+
+
+def prefix_upper_bound(prefix):
+    """以prefix开头的字符串的上界(不包含)，prefix不能为空"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def prefix_range_sql(prefix):
+    """匹配以prefix开头的对象名称的SQL条件与参数"""
+    if not prefix:
+        return "1=1", []
+    return "key>=? AND key<?", [prefix, prefix_upper_bound(prefix)]
+
+
+class ObjectIndex(object):
+    """远程备份对象的本地索引
+
+    使用SQLite记录备份目录下对象的名称、大小、ETag、CRC64与修改时间。
+    同步按轮进行：每轮从上次的分页标记继续列出对象并更新索引，可以分多次完成；
+    一轮结束时没有被列出的对象视为已删除。本客户端的上传、删除同时写入索引，
+    两轮同步之间索引也保持最新。
+    """
+
+    SYNC_PAGE_SIZE = 1000
+
+    def __init__(self, db_file, scope):
+        self.db_file = db_file
+        self.scope = scope
+        self.__init_db()
+
+    def connect(self):
+        import sqlite3
+        return sqlite3.connect(self.db_file, timeout=30)
+
+    def __init_db(self):
+        db_dir = os.path.dirname(self.db_file)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        conn = self.connect()
         try:
-            if type(map_obj) != list and type(map_obj) != str: map_obj = list(
-                map_obj)
-            return map_obj
-        except:
-            return []
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS objects ("
+                "key TEXT PRIMARY KEY, size INTEGER, etag TEXT, "
+                "crc64 TEXT, last_modified INTEGER, round INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta ("
+                         "name TEXT PRIMARY KEY, value TEXT)")
+            if self.__get_meta(conn, "scope") != self.scope:
+                # 存储空间或备份目录变化，重建索引
+                conn.execute("DELETE FROM objects")
+                conn.execute("DELETE FROM meta")
+                self.__set_meta(conn, "scope", self.scope)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def __get_meta(self, conn, name, default=None):
+        row = conn.execute("SELECT value FROM meta WHERE name=?",
+                           (name,)).fetchone()
+        return row[0] if row else default
+
+    def __set_meta(self, conn, name, value):
+        conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?,?)",
+                     (name, str(value)))
+
+    def get_meta(self, name, default=None):
+        conn = self.connect()
+        try:
+            return self.__get_meta(conn, name, default)
+        finally:
+            conn.close()
+
+    def set_meta(self, name, value):
+        conn = self.connect()
+        try:
+            self.__set_meta(conn, name, value)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get_synced_since(self):
+        """最近一次完整同步的开始时间，从未完整同步时返回0"""
+        return float(self.get_meta("synced_since", 0))
+
+    def is_ready(self):
+        return self.get_synced_since() > 0
+
+    def __put(self, conn, key, size, etag, crc64, last_modified, round_no):
+        # 不依赖UPSERT语法，兼容较旧的SQLite版本；ETag未变化时保留已知的CRC64
+        cursor = conn.execute(
+            "UPDATE objects SET size=?, crc64=CASE WHEN etag=? "
+            "THEN ifnull(?, crc64) ELSE ? END, etag=?, last_modified=?, "
+            "round=? WHERE key=?",
+            (size, etag, crc64, crc64, etag, last_modified, round_no, key))
+        if cursor.rowcount == 0:
+            conn.execute(
+                "INSERT INTO objects (key, size, etag, crc64, last_modified, "
+                "round) VALUES (?,?,?,?,?,?)",
+                (key, size, etag, crc64, last_modified, round_no))
+
+    def put(self, key, size, etag=None, crc64=None, last_modified=None):
+        """记录新上传的对象"""
+        conn = self.connect()
+        try:
+            round_no = int(self.__get_meta(conn, "round", 1))
+            self.__put(conn, key, size, etag, crc64,
+                       int(last_modified or time.time()), round_no)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def remove(self, keys):
+        """移除已删除的对象"""
+        conn = self.connect()
+        try:
+            conn.executemany("DELETE FROM objects WHERE key=?",
+                             [(k,) for k in keys])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def remove_prefix(self, prefix):
+        conn = self.connect()
+        try:
+            range_sql, range_args = prefix_range_sql(prefix)
+            conn.execute("DELETE FROM objects WHERE " + range_sql,
+                         range_args)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get(self, key):
+        conn = self.connect()
+        try:
+            row = conn.execute(
+                "SELECT key, size, etag, crc64, last_modified FROM objects "
+                "WHERE key=?", (key,)).fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None
+        return dict(zip(("key", "size", "etag", "crc64", "last_modified"),
+                        row))
+
+    def exists(self, keys):
+        """返回keys中存在于索引的对象名称集合"""
+        keys = list(keys)
+        found = set()
+        conn = self.connect()
+        try:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = conn.execute(
+                    "SELECT key FROM objects WHERE key IN ({})".format(
+                        ",".join("?" * len(batch))), batch).fetchall()
+                found.update(r[0] for r in rows)
+        finally:
+            conn.close()
+        return found
+
+    def iter_keys(self, prefix=""):
+        """按名称顺序遍历前缀下的对象 (key, size)"""
+        range_sql, range_args = prefix_range_sql(prefix)
+        conn = self.connect()
+        try:
+            for row in conn.execute("SELECT key, size FROM objects WHERE " +
+                                    range_sql + " ORDER BY key", range_args):
+                yield row
+        finally:
+            conn.close()
+
+    def find_by_name(self, prefix, file_name):
+        """在前缀下查找文件名为file_name的对象"""
+        range_sql, range_args = prefix_range_sql(prefix)
+        conn = self.connect()
+        try:
+            rows = conn.execute(
+                "SELECT key FROM objects WHERE " + range_sql +
+                " AND key LIKE ? ESCAPE '\\'",
+                range_args + ["%/" + re.sub(r"([\\%_])", r"\\\1",
+                                            file_name)]).fetchall()
+        finally:
+            conn.close()
+        for row in rows:
+            if row[0].endswith("/" + file_name):
+                return row[0]
+        return None
+
+    def get_dir_size(self, prefix):
+        range_sql, range_args = prefix_range_sql(prefix)
+        conn = self.connect()
+        try:
+            row = conn.execute(
+                "SELECT count(*), ifnull(sum(size),0) FROM objects WHERE " +
+                range_sql + " AND substr(key,-1)!='/'", range_args).fetchone()
+        finally:
+            conn.close()
+        return row[0], row[1]
+
+    def list_dir(self, prefix, marker="", page_size=1000):
+        """按目录层级分页列出对象，效果与带delimiter的list_objects相同
+
+        :return: (对象列表, next_marker)，目录项的size为None
+        """
+        entries = []
+        start = prefix
+        if marker:
+            # 目录项作为标记时跳过该目录下的所有对象
+            start = prefix_upper_bound(marker) if marker.endswith("/") \
+                else marker + "\0"
+        range_sql, range_args = prefix_range_sql(prefix)
+        conn = self.connect()
+        try:
+            done = False
+            while not done and len(entries) <= page_size:
+                rows = conn.execute(
+                    "SELECT key, size, etag, last_modified FROM objects "
+                    "WHERE " + range_sql + " AND key>=? ORDER BY key LIMIT ?",
+                    range_args + [start, page_size + 1]).fetchall()
+                done = len(rows) <= page_size
+                for key, size, etag, last_modified in rows:
+                    rel = key[len(prefix):]
+                    pos = rel.find("/")
+                    if pos != -1:
+                        dir_name = prefix + rel[:pos + 1]
+                        entries.append({"key": dir_name, "size": None})
+                        # 跳过目录下的其余对象，从目录之后重新查询
+                        start = prefix_upper_bound(dir_name)
+                        done = False
+                        break
+                    if rel:
+                        entries.append({"key": key, "size": size,
+                                        "etag": etag,
+                                        "last_modified": last_modified})
+                    start = key + "\0"
+                    if len(entries) > page_size:
+                        break
+        finally:
+            conn.close()
+
+        next_marker = ""
+        if len(entries) > page_size:
+            entries = entries[:page_size]
+            next_marker = entries[-1]["key"]
+        return entries, next_marker
+
+    def sync(self, bucket, prefix, max_pages=0):
+        """从存储空间同步对象列表
+
+        从上次中断的位置继续列出，每页写入一次；完整列出后删除本轮未出现的对象。
+        :param max_pages: 本次最多处理的页数，0表示直到本轮同步完成
+        :return: True本轮同步完成/False尚未完成
+        """
+        conn = self.connect()
+        try:
+            round_no = int(self.__get_meta(conn, "round", 1))
+            marker = self.__get_meta(conn, "sync_marker", "")
+            if not marker:
+                self.__set_meta(conn, "round_start", time.time())
+                conn.commit()
+            pages = 0
+            while True:
+                result = bucket.list_objects(prefix=prefix, marker=marker,
+                                             max_keys=self.SYNC_PAGE_SIZE)
+                for obj in result.object_list:
+                    self.__put(conn, obj.key, obj.size, obj.etag, None,
+                               obj.last_modified, round_no)
+                marker = result.next_marker if result.is_truncated else ""
+                self.__set_meta(conn, "sync_marker", marker)
+                if not marker:
+                    conn.execute("DELETE FROM objects WHERE round<?",
+                                 (round_no,))
+                    self.__set_meta(conn, "round", round_no + 1)
+                    self.__set_meta(conn, "synced_since",
+                                    self.__get_meta(conn, "round_start"))
+                    self.__set_meta(conn, "synced_time", time.time())
+                    conn.commit()
+                    return True
+                conn.commit()
+                pages += 1
+                if max_pages and pages >= max_pages:
+                    return False
+        finally:
+            conn.close()
 
 
 """
@@ -1077,6 +4920,13 @@ class OSSClient(OSClient, object):
     __bucket_name = None
     backup_path = None
     reload = False
+    # 同一组账号/存储空间共用的Bucket对象与HTTP连接池
+    __bucket = None
+    __bucket_key = None
+    __pool_size = 0
+    __bucket_lock = threading.Lock()
+    MIN_POOL_SIZE = 32
+    __object_index = None
 
     def __init__(self, load_config=True, config_file=None):
         super(OSSClient, self).__init__(
@@ -1098,6 +4948,8 @@ class OSSClient(OSClient, object):
             _endpoint = _endpoint.replace(_bucket_name + '.', '');
         self.__bucket_name = _bucket_name
         self.__endpoint = _endpoint;
+        if self.__bucket_key != self.get_bucket_key():
+            self.__bucket = None
 
         bp = data.get("backup_path").strip()
         if not verify_dir_name(bp):
@@ -1110,6 +4962,38 @@ class OSSClient(OSClient, object):
         else:
             self.backup_path = self.default_backup_path
 
+        self.stream_backup = bool(data.get("stream_backup", False))
+        self.compress_type = data.get("compress_type", "gzip")
+        self.compress_threads = int(data.get("compress_threads", 0) or 0)
+        self.backup_workers = int(data.get("backup_workers", 1) or 1)
+        self.incremental_backup = bool(data.get("incremental_backup", False))
+        self.incremental_full_every = int(
+            data.get("incremental_full_every", 7) or 7)
+        self.incremental_hash = bool(data.get("incremental_hash", False))
+        self.dedup_backup = bool(data.get("dedup_backup", False))
+        # 数据块过小时索引和请求数过多，分块也无法留出足够的切分范围
+        self.dedup_chunk_size = max(64 * 1024, int(
+            data.get("dedup_chunk_size", 1024 * 1024) or 1024 * 1024))
+        self.seekable_archive = bool(data.get("seekable_archive", False))
+        self.upload_limit = int(data.get("upload_limit", 0) or 0)
+        self.nice_level = int(data.get("nice_level", 0) or 0)
+        self.ionice_level = int(data.get("ionice_level", 0) or 0)
+        self.throttle_schedule = data.get("throttle_schedule") or []
+        self.encrypt_key_file = data.get("encrypt_key_file", "") or ""
+        self._cipher = None
+        if self.encrypt_key_file:
+            # 去重与可检索压缩包需要按内容/偏移读取明文，加密备份时不使用
+            self.dedup_backup = False
+            self.seekable_archive = False
+        self.upload_part_size = int(data.get("upload_part_size", 0) or 0)
+        self.upload_threads = int(data.get("upload_threads", 0) or 0)
+        self.compress_workers = int(data.get("compress_workers", 1) or 1)
+        self.upload_workers = int(data.get("upload_workers", 1) or 1)
+        self.parallel_dump = bool(data.get("parallel_dump", False))
+        self.reap_interval = float(data.get("reap_interval", 24) or 0)
+        self.reap_age = float(data.get("reap_age", 24) or 24)
+        self.dump_workers = int(data.get("dump_workers", 4) or 4)
+
     def get_config(self):
         """获取配置参数"""
         default_config = {
@@ -1177,15 +5061,52 @@ class OSSClient(OSClient, object):
             self.__access_key_secret
         )
 
-    def get_bucket(self):
-        """获取存储空间"""
+    def get_object_index(self):
+        """备份目录下对象的本地索引"""
+        scope = "{}|{}|{}".format(self.__endpoint, self.__bucket_name,
+                                  self.get_index_prefix())
+        index = self.__object_index
+        if index is None or index.scope != scope:
+            index = ObjectIndex(
+                os.path.join(self.get_setup_path(), "object_index.db"), scope)
+            self.__object_index = index
+        return index
+
+    def get_bucket_key(self):
+        return (self.__access_key_id, self.__access_key_secret,
+                self.__endpoint, self.__bucket_name)
+
+    def get_bucket(self, pool_size=0):
+        """获取存储空间
+
+        Bucket对象与HTTP会话在客户端内复用，列表、签名、上传、删除共用连接池，
+        仅在账号、Endpoint或存储空间变化时重新创建。
+        :param pool_size: 需要的连接池大小，超过当前连接池时重新创建会话
+        """
         try:
-            auth = self.authorize()
             name = self.__bucket_name
             endpoint = self.__endpoint
             if not endpoint or not name:
                 raise OsError("请检查阿里OSS配置是否正确。")
-            bucket = oss2.Bucket(auth, endpoint, name)
+            key = self.get_bucket_key()
+            with self.__bucket_lock:
+                if self.__bucket is not None and self.__bucket_key == key \
+                        and pool_size <= self.__pool_size:
+                    return self.__bucket
+                pool_size = max(pool_size, self.__pool_size,
+                                oss2.defaults.connection_pool_size,
+                                self.MIN_POOL_SIZE)
+                try:
+                    session = oss2.Session(pool_size=pool_size)
+                except TypeError:
+                    # 旧版本SDK不支持指定连接池大小
+                    session = oss2.Session()
+                # 开启CRC64校验：分片上传时SDK校验每个分片，完成后合并校验整个对象
+                bucket = oss2.Bucket(self.authorize(), endpoint, name,
+                                     session=session, enable_crc=True)
+                self.__bucket = bucket
+                self.__bucket_key = key
+                self.__pool_size = pool_size
             return bucket
         except OssError:
             raise OsError(
@@ -1201,18 +5122,20 @@ class OSSClient(OSClient, object):
                          object_name=None,
                          progress_callback=None,
                          progress_file_name=None,
-                         multipart_threshold=1024 * 1024 * 2,
-                         part_size=1024 * 1024 * 2,
+                         multipart_threshold=None,
+                         part_size=None,
                          store_dir="/tmp",
                          auto_cancel=True,
                          retries=2,
+                         num_threads=None,
                          ):
         """断点续传
 
         :param local_file_name: 本地文件名称
         :param object_name: 指定OS中存储的对象名称
         :param part_size: 指定分片上传的每个分片的大小。如不指定，则自动计算。
-        :param multipart_threshold: 文件长度大于该值时，则用分片上传。
+        :param multipart_threshold: 文件长度大于该值时，则用分片上传。如不指定，则自动计算。
+        :param num_threads: 并发上传线程数。如不指定，则自动计算。
         :param progress_callback: 进度回调函数，默认是把进度信息输出到标准输出。
         :param progress_file_name: 进度信息保存文件，进度格式参见[report_progress]
         :param store_dir: 上传分片存储目录, 默认/tmp。
@@ -1222,15 +5145,19 @@ class OSSClient(OSClient, object):
         """
 
         try:
-            bucket = self.get_bucket()
+            file_size = os.path.getsize(local_file_name)
+            auto_part_size, auto_threshold, auto_threads = \
+                self.get_upload_params(file_size)
+            part_size = part_size or auto_part_size
+            multipart_threshold = multipart_threshold or auto_threshold
+            num_threads = num_threads or auto_threads
+
+            bucket = self.get_bucket(pool_size=num_threads)
             _error_msg = self.error_msg
             if object_name is None:
                 temp_file_name = os.path.split(local_file_name)[1]
                 object_name = self.backup_path + temp_file_name
 
-            oss2.defaults.connection_pool_size = 4;
-            num_threads = oss2.defaults.multipart_num_threads
-
             if progress_file_name:
                 os.environ[PROGRESS_FILE_NAME] = progress_file_name
                 progress_callback = report_progress
@@ -1240,18 +5167,35 @@ class OSSClient(OSClient, object):
             if object_name[:1] == "/":
                 object_name = object_name[1:]
 
+            upload_callback = progress_callback
+            headers = self.get_traffic_headers(num_threads)
+            if headers:
+                # 进程内的总速度由令牌桶在进度回调中控制
+                upload_callback = _ThrottledProgress(self.throttle_upload,
+                                                     progress_callback)
+
             print("|-正在上传到 {}...".format(object_name))
+            print("|-文件大小：{}，分片大小：{}，分片数：{}，并发线程：{}".format(
+                public.to_size(file_size), public.to_size(part_size),
+                -(-file_size // part_size) if file_size >= multipart_threshold
+                else 1, num_threads))
+            start_time = time.time()
             result = oss2.resumable_upload(
                 bucket,
                 object_name,
                 local_file_name,
                 store=oss2.ResumableStore(root=store_dir),
+                headers=headers,
                 part_size=part_size,
                 multipart_threshold=multipart_threshold,
                 num_threads=num_threads,
-                progress_callback=progress_callback,
+                progress_callback=upload_callback,
             )
             if result.status == 200 or result.status == 204:
+                self.record_upload_speed(file_size, time.time() - start_time,
+                                         num_threads)
+                self.index_put(object_name, file_size, result.etag,
+                               getattr(result, "crc", None))
                 return True
             if self.error_msg:
                 self.error_msg += r"\n"
@@ -1281,6 +5225,7 @@ class OSSClient(OSClient, object):
                 progress_callback=progress_callback,
                 progress_file_name=progress_file_name,
                 retries=retries - 1,
+                num_threads=num_threads,
             )
         else:
             if auto_cancel:
@@ -1291,32 +5236,383 @@ class OSSClient(OSClient, object):
         self.error_msg += "文件{}上传失败。".format(object_name)
         return False
 
-    def get_list(self, path="/", delimiter="/"):
-        """获取存储空间中的所有文件对象"""
+    def stream_upload(self,
+                      stream,
+                      object_name,
+                      part_size=None,
+                      num_threads=None,
+                      store_dir="/tmp",
+                      retries=2,
+                      size_hint=0):
+        """流式分片上传
+
+        从stream中持续读取数据并按分片上传，适用于打包/导出命令的管道输出。
+        :param stream: 可读的文件对象，如管道
+        :param object_name: 指定OS中存储的对象名称
+        :param part_size: 初始分片大小。如不指定，则根据size_hint自动计算。
+        :param num_threads: 并发上传线程数。如不指定，则自动计算。
+        :param store_dir: 分片上传记录存储目录, 默认/tmp。
+        :param retries: 每个分片的重试次数
+        :param size_hint: 预估的数据大小
+        :return: 上传的字节数/False上传失败
+        """
+        if object_name[:1] == "/":
+            object_name = object_name[1:]
+        auto_part_size, _, auto_threads = self.get_upload_params(size_hint)
+        # 分片缓存在内存中，初始分片大小不超过64MB，数据超出预估时分片会自动增大
+        part_size = part_size or min(max(auto_part_size,
+                                         StreamUploader.MIN_PART_SIZE),
+                                     1024 * 1024 * 64)
+        num_threads = num_threads or auto_threads
+
+        cipher = self.get_cipher()
+        uploader = StreamUploader(self.get_bucket(pool_size=num_threads),
+                                  object_name,
+                                  part_size=part_size,
+                                  num_threads=num_threads,
+                                  store_dir=store_dir,
+                                  retries=retries,
+                                  on_complete=self.index_put,
+                                  throttle=self.throttle_upload,
+                                  headers=self.get_encrypt_headers(),
+                                  traffic_headers=self.get_traffic_headers)
+        writer = uploader
+        if cipher:
+            print("|-已启用{}客户端加密".format(ENCRYPT_ALGORITHM))
+            writer = EncryptingWriter(uploader, cipher,
+                                      num_threads=self.get_compress_threads())
+        print("|-正在流式上传到 {}...".format(object_name))
+        print("|-初始分片大小：{}，并发线程：{}".format(
+            public.to_size(part_size), num_threads))
+        try:
+            start_time = time.time()
+            while True:
+                data = stream.read(1024 * 1024)
+                if not data:
+                    break
+                writer.write(data)
+            size = writer.close()
+            print("|-上传完成，分片数：{}，最终分片大小：{}".format(
+                len(uploader.parts), public.to_size(uploader.part_size)))
+            self.record_upload_speed(size, time.time() - start_time,
+                                     num_threads)
+            return size
+        except Exception as e:
+            print("文件上传出现错误：")
+            print(e)
+            writer.abort()
+            if self.error_msg:
+                self.error_msg += r"\n"
+            self.error_msg += "文件{}上传出现错误：{}".format(object_name, str(e))
+        return False
+
+    def download_encrypted(self, object_name, file_name,
+                           part_size=1024 * 1024 * 8, num_threads=4,
+                           progress_callback=None):
+        """下载加密备份
+
+        分片并发下载的同时按顺序解密写入文件，密文不落地；
+        认证失败或CRC64校验失败时删除已写入的数据。
+        """
+        print("开始下载并解密文件{}".format(object_name))
+        reader = self.open_range_reader(object_name, part_size=part_size,
+                                        num_threads=num_threads)
+        total = reader.stream.size
+        temp_file_name = file_name + ".bt-download"
+        size = 0
+        try:
+            with open(temp_file_name, "wb") as f:
+                while True:
+                    data = reader.read(1024 * 1024)
+                    if not data:
+                        break
+                    f.write(data)
+                    size += len(data)
+                    if progress_callback:
+                        progress_callback(min(size, total), total)
+        except Exception:
+            if os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
+            raise
+        finally:
+            reader.close()
+        os.rename(temp_file_name, file_name)
+        print()
+        print("文件下载完成，已解密：{}".format(public.to_size(size)))
+        return True
+
+    def get_dedup_store(self):
+        prefix = self.backup_path
+        if prefix[:1] == "/":
+            prefix = prefix[1:]
+        return DedupStore(self.get_bucket(),
+                          prefix,
+                          os.path.join(self.get_setup_path(), "dedup"),
+                          avg_size=self.dedup_chunk_size,
+                          num_threads=oss2.defaults.multipart_num_threads,
+                          throttle=self.throttle_upload,
+                          traffic_headers=self.get_traffic_headers)
+
+    def dedup_upload(self, stream, object_name):
+        """去重分块上传
+
+        :param stream: 可读的文件对象，如tar命令的输出管道
+        :param object_name: 快照索引对象名称
+        :return: 数据总字节数/False上传失败
+        """
+        if object_name[:1] == "/":
+            object_name = object_name[1:]
+        print("|-正在去重上传到 {}...".format(object_name))
+        try:
+            stats = self.get_dedup_store().backup(stream, object_name)
+            self.index_put(object_name, stats["index_size"],
+                           stats["index_etag"])
+            print("|-数据块{}个，新增{}个，新增数据(压缩后)：{}".format(
+                stats["chunks"], stats["new_chunks"],
+                public.to_size(stats["new_size"])))
+            return stats["size"]
+        except Exception as e:
+            print("文件上传出现错误：")
+            print(e)
+            if self.error_msg:
+                self.error_msg += r"\n"
+            self.error_msg += "文件{}上传出现错误：{}".format(object_name, str(e))
+        return False
+
+    def dedup_gc(self):
+        """回收没有被任何目录备份快照引用的数据块"""
+        try:
+            index_prefix = self.build_object_name("path", "")
+            return self.get_dedup_store().gc(index_prefix)
+        except Exception as e:
+            print("回收数据块出现错误：" + str(e))
+            return 0, 0
+
+    def open_upload_stream(self, object_name, size_hint=0, num_threads=None):
+        """打开对象的流式分片上传
+
+        :param object_name: 对象名称
+        :param size_hint: 预估的数据大小，用于计算分片参数
+        :param num_threads: 并发上传线程数。如不指定，则自动计算。
+        :return: StreamUploader，启用加密时为EncryptingWriter
+        """
+        if object_name[:1] == "/":
+            object_name = object_name[1:]
+        part_size, _, auto_threads = self.get_upload_params(size_hint)
+        part_size = min(max(part_size, StreamUploader.MIN_PART_SIZE),
+                        1024 * 1024 * 64)
+        uploader = StreamUploader(self.get_bucket(), object_name,
+                                  part_size=part_size,
+                                  num_threads=num_threads or auto_threads,
+                                  on_complete=self.index_put,
+                                  throttle=self.throttle_upload,
+                                  headers=self.get_encrypt_headers(),
+                                  traffic_headers=self.get_traffic_headers)
+        cipher = self.get_cipher()
+        if cipher:
+            return EncryptingWriter(uploader, cipher,
+                                    num_threads=self.get_compress_threads())
+        return uploader
+
+    def get_encrypt_headers(self):
+        """加密对象的元数据标记，下载/读取时据此解密"""
+        if not self.get_cipher():
+            return None
+        return {ENCRYPT_META: ENCRYPT_ALGORITHM}
+
+    def read_object(self, object_name):
+        """读取对象内容，加密对象返回解密后的数据"""
+        if object_name[:1] == "/":
+            object_name = object_name[1:]
+        result = self.get_bucket().get_object(object_name)
+        if result.headers.get(ENCRYPT_META):
+            return DecryptingReader(result, self.require_cipher())
+        return result
+
+    def read_object_range(self, object_name, start, end):
+        """读取对象[start, end]范围内的数据"""
+        if object_name[:1] == "/":
+            object_name = object_name[1:]
+        return self.get_bucket().get_object(object_name,
+                                            byte_range=(start, end))
+
+    def open_range_reader(self, object_name, part_size=1024 * 1024 * 8,
+                          num_threads=None):
+        """并发分片读取对象，预取窗口为并发数的两倍，加密对象读取时解密"""
+        if object_name[:1] == "/":
+            object_name = object_name[1:]
+        num_threads = num_threads or oss2.defaults.multiget_num_threads
+        reader = RangeReader(self.get_bucket(pool_size=num_threads),
+                             object_name, part_size=part_size,
+                             num_threads=num_threads)
+        if reader.headers.get(ENCRYPT_META):
+            return DecryptingReader(reader, self.require_cipher())
+        return reader
+
+    def iter_dedup_data(self, object_name):
+        """按顺序读取去重快照的数据"""
+        if object_name[:1] == "/":
+            object_name = object_name[1:]
+        return self.get_dedup_store().iter_data(object_name)
+
+    def list_prefix_keys(self, prefix):
+        """列出指定前缀下的所有对象名称，索引可用时不请求存储空间"""
+        index = self.get_ready_index(prefix)
+        if index:
+            return [key for key, _ in index.iter_keys(prefix)]
+        return [obj.key for obj in
+                oss2.ObjectIterator(self.get_bucket(), prefix=prefix)]
+
+    def delete_prefix(self, prefix):
+        """删除指定前缀下的所有对象"""
+        keys = self.list_prefix_keys(prefix)
+        failed = self.delete_objects(keys)
+        if failed:
+            raise OsError("{}个文件删除失败".format(len(failed)))
+        self.index_remove_prefix(prefix)
+        return len(keys)
+
+    def delete_objects(self, object_names, retries=2):
+        """批量删除对象
 
+        每次请求最多删除1000个对象，未被确认删除的对象重试retries次。
+        :param object_names: 对象名称列表
+        :return: 删除失败的对象名称列表
+        """
         bucket = self.get_bucket()
+        pending = []
+        seen = set()
+        for name in object_names:
+            if name not in seen:
+                seen.add(name)
+                pending.append(name)
+        failed = []
+        for attempt in range(retries + 1):
+            failed = []
+            for i in range(0, len(pending), 1000):
+                batch = pending[i:i + 1000]
+                try:
+                    result = bucket.batch_delete_objects(batch)
+                    deleted = set(result.deleted_keys)
+                except Exception as e:
+                    print("批量删除文件出现错误：" + str(e))
+                    deleted = set()
+                self.index_remove([k for k in batch if k in deleted])
+                failed += [k for k in batch if k not in deleted]
+            if not failed:
+                break
+            pending = failed
+            if attempt < retries:
+                print("重新尝试删除{}个文件...".format(len(failed)))
+                time.sleep(1)
+        return failed
+
+    def get_list(self, path="/", delimiter="/", marker="", page_size=1000,
+                 with_url=False):
+        """分页获取存储空间中的文件对象
+
+        :param path: 目录
+        :param marker: 分页标记，从该对象之后开始列出，为空表示第一页
+        :param page_size: 每页数量，最大1000
+        :param with_url: 是否同时生成下载链接，默认只在下载时通过
+                         generate_download_url生成
+        :return: {"path", "list", "next_marker"}，next_marker为空表示已是最后一页
+        """
+
         data = []
         path = self.get_path(path);
+        page_size = min(max(int(page_size), 1), 1000)
+
+        index = self.get_ready_index(path) if delimiter == "/" else None
+        if index:
+            entries, next_marker = index.list_dir(path, marker, page_size)
+            for entry in entries:
+                tmp = {}
+                tmp['name'] = entry["key"][len(path):]
+                tmp['size'] = entry["size"]
+                if entry["size"] is None:
+                    tmp['type'] = None
+                    tmp['time'] = None
+                else:
+                    tmp['type'] = "Normal"
+                    tmp['time'] = entry["last_modified"]
+                    if with_url:
+                        tmp['download'] = self.generate_download_url(
+                            entry["key"])
+                data.append(tmp)
+            return {'path': path, 'list': data, 'next_marker': next_marker}
 
-        from itertools import islice
-        for b in islice(
-                oss2.ObjectIterator(bucket,
-                                    prefix=path,
-                                    delimiter=delimiter),
-                1000):
-            b.key = b.key.replace(path, '');
-            if not b.key: continue;
+        bucket = self.get_bucket()
+        result = bucket.list_objects(prefix=path,
+                                     delimiter=delimiter,
+                                     marker=marker,
+                                     max_keys=page_size)
+        for prefix in result.prefix_list:
+            data.append({
+                'name': prefix[len(path):],
+                'size': None,
+                'type': None,
+                'time': None,
+            })
+        for b in result.object_list:
+            name = b.key[len(path):]
+            if not name: continue;
             tmp = {}
-            tmp['name'] = b.key
+            tmp['name'] = name
             tmp['size'] = b.size
             tmp['type'] = b.type
-            tmp['download'] = self.generate_download_url(path + b.key);
+            if with_url:
+                tmp['download'] = self.generate_download_url(b.key);
             tmp['time'] = b.last_modified
             data.append(tmp)
+        data.sort(key=lambda x: x['name'])
 
-        mlist = {'path': path, 'list': data}
+        next_marker = result.next_marker if result.is_truncated else ""
+        mlist = {'path': path, 'list': data, 'next_marker': next_marker}
         return mlist
 
+    def get_dir_size_cache_file(self):
+        return os.path.join(self.get_setup_path(), "dir_size.json")
+
+    def get_dir_size(self, path, cache_time=600):
+        """统计目录下所有对象的数量与总大小
+
+        统计结果缓存cache_time秒，目录对象较多时需要多次列出请求。
+        :param path: 目录
+        :return: {"path", "size", "count"}
+        """
+        path = self.get_path(path)
+        index = self.get_ready_index(path)
+        if index:
+            count, size = index.get_dir_size(path)
+            return {"path": path, "size": size, "count": count,
+                    "time": int(time.time())}
+
+        cache_file = self.get_dir_size_cache_file()
+        try:
+            cache = json.loads(public.readFile(cache_file))
+        except Exception:
+            cache = {}
+        info = cache.get(path)
+        if info and time.time() - info["time"] < cache_time:
+            return info
+
+        size = 0
+        count = 0
+        for obj in oss2.ObjectIterator(self.get_bucket(), prefix=path):
+            if obj.key.endswith("/"):
+                continue
+            size += obj.size
+            count += 1
+        info = {"path": path, "size": size, "count": count,
+                "time": int(time.time())}
+        cache[path] = info
+        for key in list(cache):
+            if time.time() - cache[key]["time"] >= cache_time:
+                del cache[key]
+        public.writeFile(cache_file, json.dumps(cache))
+        return info
+
     def create_dir(self, dir_name):
         """创建远程目录
 
@@ -1337,9 +5633,34 @@ class OSSClient(OSClient, object):
         bucket = self.get_bucket()
         result = bucket.put_object_from_file(dir_name, file_name)
         if result.status == 200:
+            self.index_put(dir_name, 0, result.etag)
             return True
         os.remove(file_name);
 
+    # 本地断点记录目录：oss2.ResumableStore与StreamUploader
+    CHECKPOINT_DIRS = ("/tmp/.py-oss-upload", "/tmp/.bt-stream-upload")
+
+    def remove_upload_checkpoints(self, upload_ids):
+        """删除指定upload id对应的本地断点记录文件
+
+        :return: 删除的文件数
+        """
+        removed = 0
+        upload_ids = set(upload_ids)
+        for store_dir in self.CHECKPOINT_DIRS:
+            if not os.path.isdir(store_dir):
+                continue
+            for name in os.listdir(store_dir):
+                file_name = os.path.join(store_dir, name)
+                try:
+                    record = json.loads(public.readFile(file_name))
+                    if record.get("upload_id") in upload_ids:
+                        os.remove(file_name)
+                        removed += 1
+                except Exception:
+                    continue
+        return removed
+
     def cancel_upload(self, object_name):
         """取消断点续传
 
@@ -1352,40 +5673,96 @@ class OSSClient(OSClient, object):
         print("取消文件{}上传...".format(object_name))
         try:
             bucket = self.get_bucket()
-            upload_id = None
-            # 查找本次上传的upload id
-            from itertools import islice
-            # print("已有分片上传文件:")
-            for multi_upload in oss2.MultipartUploadIterator(
-                    bucket):
-                # print(multi_upload.key)
-                if object_name == multi_upload.key:
-                    print("upload_id:" + multi_upload.upload_id)
-                    upload_id = multi_upload.upload_id
-                    break
-            print("upload_id:" + repr(upload_id))
-            # 取消断点续传
-            result = bucket.abort_multipart_upload(object_name,
-                                                   upload_id)
-            if result.status == 200 or result.status == 204:
-                # TODO 删除本地进度文件
-                print("取消文件{}上传成功。".format(object_name))
+            # 按对象名称前缀查找本次上传的upload id
+            upload_ids = [u.upload_id for u in oss2.MultipartUploadIterator(
+                bucket, prefix=object_name) if u.key == object_name]
+            if not upload_ids:
+                print("没有找到文件{}的分片上传记录。".format(object_name))
                 return True
-            else:
-                print("取消文件{}上传失败。"
-                      "已上传文件分片会占用多余的存储空间，请及时清理。".format(object_name))
+            for upload_id in upload_ids:
+                print("upload_id:" + upload_id)
+                bucket.abort_multipart_upload(object_name, upload_id)
+            self.remove_upload_checkpoints(upload_ids)
+            print("取消文件{}上传成功。".format(object_name))
+            return True
         except Exception as e:
             print(e)
             print("取消文件{}上传失败。"
                   "已上传文件分片会占用多余的存储空间，请及时清理。".format(object_name))
 
+    def reap_uploads(self, max_age=24 * 3600, dry_run=False, workers=8):
+        """取消备份目录下过期的分片上传
+
+        一次列出备份目录前缀下所有进行中的分片上传，发起时间早于max_age秒的
+        由多个线程并发统计已上传分片大小并取消，同时删除对应的本地断点记录。
+        :param max_age: 分片上传的最长保留时间(秒)
+        :param dry_run: 只统计不取消
+        :param workers: 并发线程数
+        :return: {"count": 数量, "size": 释放的字节数, "failed": 失败数}
+        """
+        bucket = self.get_bucket(pool_size=workers)
+        deadline = time.time() - max_age
+        queue = Queue()
+        for upload in oss2.MultipartUploadIterator(
+                bucket, prefix=self.get_index_prefix()):
+            if upload.initiation_date < deadline:
+                queue.put(upload)
+        stats = {"count": 0, "size": 0, "failed": 0}
+        total = queue.qsize()
+        if not total:
+            print("|-没有需要清理的分片上传")
+            return stats
+        print("|-发现{}个超过{:.1f}小时的分片上传".format(total,
+                                                 max_age / 3600.0))
+
+        lock = threading.Lock()
+        reaped_ids = []
+
+        def worker():
+            while True:
+                try:
+                    upload = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    size = sum(part.size for part in oss2.PartIterator(
+                        bucket, upload.key, upload.upload_id))
+                    if not dry_run:
+                        bucket.abort_multipart_upload(upload.key,
+                                                      upload.upload_id)
+                    with lock:
+                        stats["count"] += 1
+                        stats["size"] += size
+                        reaped_ids.append(upload.upload_id)
+                except Exception as e:
+                    print("|-取消分片上传{}失败：{}".format(upload.key, e))
+                    with lock:
+                        stats["failed"] += 1
+
+        threads = []
+        for _ in range(min(workers, total)):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        removed = 0
+        if not dry_run:
+            removed = self.remove_upload_checkpoints(reaped_ids)
+        print("|-{}分片上传{}个，释放空间：{}，失败{}个，删除本地断点记录{}个".format(
+            "可清理" if dry_run else "已取消", stats["count"],
+            public.to_size(stats["size"]), stats["failed"], removed))
+        return stats
+
     def download_file(self,
                       object_name,
                       file_name,
                       progress_file_name=None,
                       progress_callback=None,
                       multiget_threshold=1024 * 1024 * 2,
-                      part_size=1024 * 1024 * 2,
+                      part_size=1024 * 1024 * 8,
                       store_dir="/tmp",
                       retries=2):
         """文件下载
@@ -1406,8 +5783,8 @@ class OSSClient(OSClient, object):
         try:
             import time
             start_time = time.time()
-            bucket = self.get_bucket()
             num_threads = oss2.defaults.multiget_num_threads
+            bucket = self.get_bucket(pool_size=num_threads)
 
             if object_name[:1] == "/":
                 object_name = object_name[1:]
@@ -1422,33 +5799,30 @@ class OSSClient(OSClient, object):
             # elif progress_callback is None:
             #     progress_callback = percentage
 
-            # 断点续传下载
+            if bucket.head_object(object_name).headers.get(ENCRYPT_META):
+                return self.download_encrypted(object_name, file_name,
+                                               part_size=part_size,
+                                               num_threads=num_threads,
+                                               progress_callback=progress_callback)
+
+            # 分片并行下载，下载过程中计算并合并校验CRC64
             print("开始下载文件{}".format(object_name))
-            oss2.resumable_download(
+            downloader = ParallelDownloader(
                 bucket,
                 object_name,
                 file_name,
-                store=oss2.ResumableDownloadStore(root=store_dir),
-                multiget_threshold=multiget_threshold,
                 part_size=part_size,
                 num_threads=num_threads,
+                store_dir=store_dir,
                 progress_callback=progress_callback,
+                multiget_threshold=multiget_threshold,
             )
-
-            # 验证
+            crc64 = downloader.download()
             print()
-            print("验证文件...")
-            if not os.path.isfile(file_name):
-                print("文件下载失败。")
-            else:
-                crc64 = self.calculate_file_crc64(file_name,
-                                                  block_size=part_size)
-                result = bucket.head_object(object_name)
-                if str(crc64) == result.headers['x-oss-hash-crc64ecma']:
-                    print("文件下载完成。")
-                    return True
-                else:
-                    print("文件验证失败。")
+            print("文件下载完成，CRC64校验通过：{}".format(crc64))
+            self.index_put(object_name, downloader.size,
+                           downloader.record["etag"], str(crc64))
+            return True
         except (NoSuchKey, NotFound) as e:
             print("下载目标文件{}不存在。".format(object_name))
             raise ObjectNotFound("下载目标文件{}不存在。".format(object_name))
@@ -1505,6 +5879,7 @@ class OSSClient(OSClient, object):
         bucket = self.get_bucket()
         result = bucket.delete_object(object_name)
         if result.status == 200 or result.status == 204:
+            self.index_remove([object_name])
             return True
 
     def batch_delete(self, object_names):
@@ -1518,6 +5893,7 @@ class OSSClient(OSClient, object):
             bucket = self.get_bucket()
             result = bucket.batch_delete_objects(object_names)
             if result.status == 200 or result.status == 204:
+                self.index_remove(object_names)
                 return True
         except Exception as e:
             raise RuntimeError("批量删除文件出现错误:" + str(e))
@@ -1585,17 +5961,21 @@ class alioss_main(object):
             if not backup_path:
                 backup_path = "bt_backup"
 
-            data = {
+            _client = OSSClient(load_config=False)
+            # 保留配置文件中的高级选项(如stream_backup)
+            data = _client.get_config()
+            data.update({
                 "access_key": access_key,
                 "secret_key": secret_key,
                 "bucket_name": bucket_name,
                 "bucket_domain": bucket_domain,
                 "backup_path": backup_path,
-            }
-            _client = OSSClient(load_config=False)
+            })
             _client.init_config(data)
             if _client.get_list():
                 _client.set_config(data)
+                # 后续请求使用新配置的客户端及其连接
+                self.__client = _client
                 return public.returnMsg(True, '设置成功!');
         except oss2.exceptions.ServerError as e:
             try:
@@ -1626,25 +6006,73 @@ class alioss_main(object):
     # 获取列表
     def get_list(self, get):
         try:
-            return self.client.get_list(get.path)
+            marker = getattr(get, "marker", "") or ""
+            page_size = int(getattr(get, "page_size", 1000) or 1000)
+            self.client.start_index_sync()
+            return self.client.get_list(get.path, marker=marker,
+                                        page_size=page_size)
         except:
             return public.returnMsg(False, "获取列表失败！")
 
+    def get_object_path(self, get):
+        path = get.path
+        filename = get.filename
+        if path[-1] != "/":
+            file_name = path + "/" + filename
+        else:
+            file_name = path + filename
+        if file_name[:1] == "/":
+            file_name = file_name[1:]
+        return file_name
+
+    # 获取下载链接
+    def get_download_url(self, get):
+        try:
+            url = self.client.generate_download_url(self.get_object_path(get))
+            return public.returnMsg(True, url)
+        except Exception as e:
+            return public.returnMsg(False, "生成下载链接失败：" + str(e))
+
+    # 获取没有备份记录引用的对象
+    def get_orphans(self, get):
+        try:
+            orphans = self.client.find_orphans()
+            return {"list": orphans,
+                    "size": sum(o["size"] for o in orphans)}
+        except Exception as e:
+            return public.returnMsg(False, "查找孤立文件失败：" + str(e))
+
+    # 浏览压缩包内容
+    def list_archive(self, get):
+        try:
+            return self.client.list_archive(self.get_object_path(get),
+                                            getattr(get, "dir", ""))
+        except Exception as e:
+            return public.returnMsg(False, "读取压缩包内容失败：" + str(e))
+
+    # 从压缩包中还原单个文件
+    def extract_archive_file(self, get):
+        try:
+            file_name = self.client.extract_archive_file(
+                self.get_object_path(get), get.member, get.target)
+            return public.returnMsg(True, "文件已还原到：" + file_name)
+        except Exception as e:
+            return public.returnMsg(False, "还原文件失败：" + str(e))
+
+    # 统计目录大小
+    def get_dir_size(self, get):
+        try:
+            return self.client.get_dir_size(get.path)
+        except Exception as e:
+            return public.returnMsg(False, "统计目录大小失败：" + str(e))
+
     # 删除文件
     def delete_file(self, get):
         try:
-            path = get.path
-            filename = get.filename
-            if path[-1] != "/":
-                file_name = path + "/" + filename
-            else:
-                file_name = path + filename
-
-            if file_name[-1] == "/":
+            file_name = self.get_object_path(get)
+            if file_name[-1:] == "/":
                 return public.returnMsg(False, "暂时不支持目录删除！")
 
-            if file_name[:1] == "/":
-                file_name = file_name[1:]
             if self.client.delete_object(file_name):
                 return public.returnMsg(True, '删除成功')
             return public.returnMsg(False, '文件{}删除失败！'.format(file_name))
@@ -1661,6 +6089,13 @@ class alioss_main(object):
             格式参考：web_192.168.1.245_20200703_183016.tar.gz
         """
         import re
+        index = self.client.get_ready_index()
+        if index:
+            object_name = index.find_by_name(
+                self.client.get_index_prefix(), filename)
+            if object_name:
+                return self.client.generate_download_url(object_name)
+
         _result = re.search("([^_]+)_.+", filename)
         if _result:
             file_type = _result.group(1)
@@ -1748,9 +6183,26 @@ if __name__ == "__main__":
             path = "/"
             if len(sys.argv) == 3:
                 path = sys.argv[2]
-            data = client.get_list(path);
+            data = client.get_list(path, with_url=True);
         elif _type == 'delete_file':
             data = client.delete_file(sys.argv[2]);
+        elif _type == 'restore_tables':
+            db_name = sys.argv[3] if len(sys.argv) > 3 else None
+            data = client.restore_database_tables(sys.argv[2], db_name)
+        elif _type == 'sync_index':
+            data = client.sync_object_index()
+        elif _type == 'restore':
+            target = sys.argv[4] if len(sys.argv) > 4 else None
+            data = client.restore(sys.argv[2], sys.argv[3], target)
+        elif _type == 'reap':
+            max_age = float(sys.argv[2]) if len(sys.argv) > 2 \
+                else client.reap_age
+            data = client.reap_uploads(max_age * 3600)
+        elif _type == 'orphans':
+            data = client.find_orphans()
+        elif _type == 'gen_key':
+            key_file = sys.argv[2] if len(sys.argv) > 2 else None
+            data = client.generate_encrypt_key(key_file)
         else:
             data = 'ERROR: 参数不正确!';
         if data:
@@ -2,17 +2,307 @@
 # coding: utf-8
 #  Author: Xetch
 
-import sys, os, json, ssl, time;
+import sys, os, json, ssl, time, struct;
 pluginPath = "/www/server/panel/plugin/btp_frps";
 frpsPath = pluginPath + '/bin/frps';
-frpsIniPath = pluginPath + '/conf/frps.ini';
+instancesPath = pluginPath + '/instances';
+systemdPath = '/etc/systemd/system';
+# 时间序列的精度及保存的数据点数量：1 秒保存 10 分钟，1 分钟保存 1 天，1 小时保存 30 天
+metricsTiers = [(1, 600), (60, 1440), (3600, 720)];
+# 首次读取日志时从末尾读取的字节数，以及每次最多读取的字节数
+logTailSize = 128 * 1024;
+logReadSize = 256 * 1024;
 os.chdir("/www/server/panel");
 sys.path.append("class/");
 import public, re;
-from BTPanel import cache;
+try:
+	from shlex import quote;
+except ImportError:
+	from pipes import quote;
+
+class FrpsInstance():
+	'''
+	frps 实例的文件路径及 systemd 服务名称，默认实例沿用插件原有的路径和 btp_frps 服务，
+	其它实例的配置和日志保存在 instances/<名称>/ 下，由模板服务 btp_frps@<名称> 管理
+	'''
+	def __init__(self, name=''):
+		name = str(name or '').strip();
+		self.default = name in ['', 'default'];
+		# 名称会拼接到路径及命令中，只允许字母、数字、下划线及中划线
+		if not self.default and not FrpsInstance.valid(name):
+			raise ValueError('invalid instance name: %r' % name);
+		self.name = 'default' if self.default else name;
+		base = pluginPath if self.default else instancesPath + '/' + name;
+		self.confPath = base + '/conf';
+		self.tempPath = base + '/temp';
+		self.configPath = self.confPath + '/config.json';
+		self.iniPath = self.confPath + '/frps.ini';
+		self.custom404Path = self.confPath + '/404.html';
+		self.logPath = self.tempPath + '/frps.log';
+		self.pidPath = self.tempPath + '/frps.pid';
+		# 启动 frps 时使用的配置副本，保存配置时与其对比判断是否需要重启
+		self.runningIniPath = self.tempPath + '/frps.running.ini';
+		self.metricsPath = self.tempPath + '/metrics';
+		self.collectorPidPath = self.tempPath + '/collector.pid';
+		if self.default:
+			self.unit = 'btp_frps';
+			self.servicePath = systemdPath + '/btp_frps.service';
+			cgroup = 'system.slice/btp_frps.service';
+		else:
+			self.unit = 'btp_frps@' + name;
+			self.servicePath = systemdPath + '/btp_frps@.service';
+			cgroup = 'system.slice/system-btp_frps.slice/btp_frps@%s.service' % name;
+		self.dropInPath = '%s/%s.service.d' % (systemdPath, self.unit);
+		self.cgroupPaths = ['/sys/fs/cgroup/' + cgroup + '/cgroup.procs', '/sys/fs/cgroup/systemd/' + cgroup + '/cgroup.procs'];
+
+	def systemd(self):
+		'''
+		是否由 systemd 管理，默认实例的服务文件在关闭时删除，模板实例以是否启用自启动判断
+		'''
+		if self.default:
+			return os.path.isfile(self.servicePath);
+		return os.path.exists('%s/multi-user.target.wants/%s.service' % (systemdPath, self.unit));
+
+	def exists(self):
+		return self.default or os.path.isdir(self.confPath);
+
+	@staticmethod
+	def valid(name):
+		return re.match(r'^[a-zA-Z0-9_\-]{1,32}$', name) is not None and name != 'default';
+
+	@staticmethod
+	def all():
+		instances = [FrpsInstance()];
+		if os.path.isdir(instancesPath):
+			for name in sorted(os.listdir(instancesPath)):
+				if FrpsInstance.valid(name) and os.path.isdir(instancesPath + '/' + name + '/conf'):
+					instances.append(FrpsInstance(name));
+		return instances;
+
+def dashboardConfig(instance):
+	'''
+	从实例配置中读取仪表盘地址及验证信息，未设置仪表盘端口时返回 None
+	'''
+	try:
+		config = json.loads(public.ReadFile(instance.configPath, mode='r'));
+	except:
+		return None;
+	port = str(config.get('dashboardPort', '')).strip();
+	if not port.isdigit():
+		return None;
+	addr = str(config.get('dashboardAddr', '')).strip() or str(config.get('bindAddr', '')).strip();
+	if addr in ['', '0.0.0.0', '::', '[::]']:
+		addr = '127.0.0.1';
+	elif ':' in addr and not addr.startswith('['):
+		addr = '[%s]' % addr;
+	# frps 未设置验证账户时默认为 admin / admin
+	user = str(config.get('dashboardUser', '')).strip() or 'admin';
+	pwd = str(config.get('dashboardPwd', '')).strip() or 'admin';
+	return {'url': 'http://%s:%s' % (addr, port), 'user': user, 'pwd': pwd};
+
+class MetricsRing():
+	'''
+	定长的环形时间序列文件，依次保存 1 秒、1 分钟、1 小时三种精度的数据，
+	每条记录为时间戳、入站速率、出站速率、连接数，写入位置由时间戳决定，文件大小固定
+	'''
+	record = struct.Struct('<Ifff');
+
+	def __init__(self, filename):
+		self.filename = filename;
+		# 低精度当前时间段的累计值：[开始时间, 数据点数量, [各项合计]]
+		self.pending = [None for tier in metricsTiers];
+		size = sum([slots for step, slots in metricsTiers]) * self.record.size;
+		if not os.path.isfile(filename) or os.path.getsize(filename) != size:
+			with open(filename, 'wb') as f:
+				f.truncate(size);
+		self.file = open(filename, 'r+b');
+
+	@staticmethod
+	def offset(tier, ts):
+		base = sum([slots for step, slots in metricsTiers[:tier]]);
+		step, slots = metricsTiers[tier];
+		return (base + ts // step % slots) * MetricsRing.record.size;
+
+	@staticmethod
+	def read(filename, step):
+		'''
+		读取指定精度仍在保存期内的数据点，按时间排序
+		'''
+		tiers = [item[0] for item in metricsTiers];
+		if step not in tiers or not os.path.isfile(filename):
+			return [];
+		tier = tiers.index(step);
+		slots = metricsTiers[tier][1];
+		with open(filename, 'rb') as f:
+			f.seek(MetricsRing.offset(tier, 0));
+			content = f.read(slots * MetricsRing.record.size);
+		since = time.time() - step * slots;
+		points = [];
+		for i in range(len(content) // MetricsRing.record.size):
+			ts, trafficIn, trafficOut, conns = MetricsRing.record.unpack_from(content, i * MetricsRing.record.size);
+			if ts > since:
+				points.append([ts, round(trafficIn, 1), round(trafficOut, 1), round(conns, 1)]);
+		points.sort(key=lambda point: point[0]);
+		return points;
+
+	def add(self, ts, values):
+		ts = int(ts);
+		self.__write(0, ts, values);
+		self.__feed(1, ts, values);
+
+	def close(self):
+		self.file.close();
+
+	def __feed(self, tier, ts, values):
+		'''
+		将上一精度的一个完整数据点并入当前精度，时间段结束后再继续并入更低精度
+		'''
+		if tier >= len(metricsTiers):
+			return;
+		step = metricsTiers[tier][0];
+		start = ts - ts % step;
+		pending = self.pending[tier];
+		if pending is not None and pending[0] != start:
+			self.__feed(tier + 1, pending[0], [value / pending[1] for value in pending[2]]);
+			pending = None;
+		if pending is None:
+			pending = [start, 0, [0.0 for value in values]];
+		pending[1] += 1;
+		pending[2] = [total + value for total, value in zip(pending[2], values)];
+		self.pending[tier] = pending;
+		# 未结束的时间段也写入当前平均值，便于查看最近的数据
+		self.__write(tier, start, [value / pending[1] for value in pending[2]]);
+
+	def __write(self, tier, ts, values):
+		self.file.seek(self.offset(tier, ts));
+		self.file.write(self.record.pack(ts, *values));
+		self.file.flush();
+
+class MetricsCollector():
+	'''
+	采集进程：每秒读取一次 frps 仪表盘接口，计算服务端及各代理的流量速率和连接数，
+	写入环形时间序列，并将最新数据写入 latest.json，插件接口只读取文件而不再请求 frps
+	'''
+	def __init__(self, instance):
+		self.instance = instance;
+		self.rings = {};
+		self.last = {};
+		self.dashboard = None;
+		self.configTime = 0;
+
+	def run(self):
+		os.system('mkdir -p ' + quote(self.instance.metricsPath));
+		pid = str(os.getpid());
+		filename = self.instance.collectorPidPath;
+		public.WriteFile(filename, pid, mode='w+');
+		self.prune();
+		failures = 0;
+		# frps 长时间无法访问（例如已被关闭）时退出，由插件接口在需要时重新启动
+		while failures < 60:
+			# 插件关闭采集或已启动新的采集进程时退出
+			if not os.path.isfile(filename) or public.ReadFile(filename, mode='r').strip() != pid:
+				break;
+			try:
+				self.collect(time.time());
+				failures = 0;
+			except Exception:
+				failures += 1;
+			time.sleep(1 - time.time() % 1);
+		for ring in self.rings.values():
+			ring.close();
+
+	def collect(self, now):
+		self.loadConfig();
+		if self.dashboard is None:
+			raise ValueError('dashboard is not configured');
+		server = self.fetch('/api/serverinfo');
+		counts = server.get('proxy_type_count') or {};
+		proxies = [];
+		for proxyType in ['tcp', 'udp', 'http', 'https', 'stcp', 'xtcp']:
+			if len(counts) > 0 and not counts.get(proxyType):
+				continue;
+			for item in self.fetch('/api/proxy/' + proxyType).get('proxies') or []:
+				proxies.append({
+					'name': item.get('name', ''),
+					'type': proxyType,
+					'status': item.get('status', ''),
+					'conns': int(item.get('cur_conns') or 0),
+					'trafficIn': int(item.get('today_traffic_in') or 0),
+					'trafficOut': int(item.get('today_traffic_out') or 0)
+				});
+
+		ts = int(now);
+		summary = {
+			'version': server.get('version', ''),
+			'clients': int(server.get('client_counts') or 0),
+			'conns': int(server.get('cur_conns') or 0),
+			'trafficIn': int(server.get('total_traffic_in') or 0),
+			'trafficOut': int(server.get('total_traffic_out') or 0)
+		};
+		self.sample('server', now, summary);
+		for proxy in proxies:
+			self.sample(self.seriesName(proxy['name']), now, proxy);
+
+		filename = self.instance.metricsPath + '/latest.json';
+		public.WriteFile(filename + '.tmp', json.dumps({'time': ts, 'server': summary, 'proxies': proxies}), mode='w+');
+		os.rename(filename + '.tmp', filename);
+
+	def sample(self, name, now, item):
+		'''
+		根据两次采集的流量计数计算速率（字节/秒），写入 item 并追加到时间序列
+		'''
+		last = self.last.get(name);
+		self.last[name] = (now, item['trafficIn'], item['trafficOut']);
+		item['in'] = item['out'] = 0.0;
+		if last is None or now <= last[0]:
+			return;
+		elapsed = now - last[0];
+		# 流量计数在每天零点或 frps 重启后清零，此时以当前计数作为增量
+		rates = [];
+		for value, previous in [(item['trafficIn'], last[1]), (item['trafficOut'], last[2])]:
+			rates.append(float(value if value < previous else value - previous) / elapsed);
+		item['in'], item['out'] = rates;
+		if name not in self.rings:
+			self.rings[name] = MetricsRing('%s/%s.dat' % (self.instance.metricsPath, name));
+		self.rings[name].add(now, [item['in'], item['out'], item['conns']]);
+
+	def fetch(self, path):
+		import base64;
+		try:
+			from urllib.request import Request, urlopen;
+		except ImportError:
+			from urllib2 import Request, urlopen;
+		request = Request(self.dashboard['url'] + path);
+		auth = base64.b64encode(('%s:%s' % (self.dashboard['user'], self.dashboard['pwd'])).encode('utf-8'));
+		request.add_header('Authorization', 'Basic ' + auth.decode('ascii'));
+		return json.loads(urlopen(request, timeout=2).read().decode('utf-8'));
+
+	def loadConfig(self):
+		# 配置文件变化时重新读取仪表盘地址
+		filename = self.instance.configPath;
+		mtime = os.path.getmtime(filename) if os.path.isfile(filename) else 0;
+		if mtime != self.configTime:
+			self.configTime = mtime;
+			self.dashboard = dashboardConfig(self.instance);
+
+	def prune(self):
+		# 清理超过最长保存期仍未更新的时间序列（已删除的代理）
+		expire = time.time() - max([step * slots for step, slots in metricsTiers]);
+		for name in os.listdir(self.instance.metricsPath):
+			filename = self.instance.metricsPath + '/' + name;
+			if name.endswith('.dat') and os.path.getmtime(filename) < expire:
+				os.remove(filename);
+
+	@staticmethod
+	def seriesName(proxy):
+		import hashlib;
+		return 'proxy_' + hashlib.md5(proxy.encode('utf-8')).hexdigest();
 
 class btp_frps_main():
 	def check(self, get):
+		instance = self.__instance(get);
+		if instance is None:
+			return public.returnMsg(False, '实例名称无效');
 		if not os.path.isfile(frpsPath):
 			return public.returnMsg(False, 'frps 未安装');
 
@@ -22,10 +312,12 @@ class btp_frps_main():
 
 		return public.returnMsg(True, {
 			'version': success.strip(),
-			'pid': self.__pid()
+			'instance': instance.name,
+			'pid': self.__pid(instance)
 		});
 
 	def install(self, get):
+		from BTPanel import cache;
 		taskName = 'frps';
 		if self.__getTaskStatus(taskName) != 1:
 			return public.returnMsg(False, '安装任务已在队列中');
@@ -73,10 +365,20 @@ class btp_frps_main():
 		return public.returnMsg(True, release);
 	
 	def save(self, get):
+		instance = self.__instance(get);
+		if instance is None:
+			return public.returnMsg(False, '实例名称无效');
+		if not instance.exists():
+			return public.returnMsg(False, '实例 %s 不存在' % instance.name);
 		try:
 			data = json.loads(get['json']);
-			os.system('mkdir -p ' + pluginPath + '/conf');
-			public.WriteFile(pluginPath + '/conf/config.json', get['json'], mode='w+');
+			# apply 表示 frps 运行中时立即应用新配置，不保存到配置文件
+			apply = data.pop('apply', False) == True;
+			conflict = self.__portConflict(instance, data);
+			if conflict:
+				return public.returnMsg(False, conflict);
+			os.system('mkdir -p ' + quote(instance.confPath));
+			public.WriteFile(instance.configPath, json.dumps(data), mode='w+');
 			keys = {
 				"bindAddr": "bind_addr",
 				"bindPort": "bind_port",
@@ -106,6 +408,8 @@ class btp_frps_main():
 			};
 			config = '[common]\n';
 			for key in keys.keys():
+				# 旧版本或空的配置可能缺少部分字段，缺少时视为未设置
+				data.setdefault(key, '');
 				if type(data[key]) == bool:
 					if data[key] == True:
 						data[key] = 'true';
@@ -113,25 +417,30 @@ class btp_frps_main():
 						data[key] = 'false';
 				if str(data[key]) != '':
 					config += '%s = %s\n' % (keys[key], str(data[key]));
-			if type(data['allowPorts']) == list and len(data['allowPorts']) > 0:
+			if type(data.get('allowPorts')) == list and len(data['allowPorts']) > 0:
 				config += 'allow_ports = %s\n' % ','.join(data['allowPorts']);
-			config += 'log_file = %s/temp/frps.log\n' % pluginPath;
-			filename = pluginPath + '/conf/404.html';
+			config += 'log_file = %s\n' % instance.logPath;
+			filename = instance.custom404Path;
 			if not os.path.isfile(filename):
 				public.WriteFile(filename, '', mode='w+');
-			if data['enabledCustom404Page'] == True and os.path.getsize(filename) > 0:
+			if data.get('enabledCustom404Page') == True and os.path.getsize(filename) > 0:
 				config += 'custom_404_page = %s\n' % filename;
-			public.WriteFile(frpsIniPath, config, mode='w+');
-			return public.returnMsg(True, '保存成功');
+			public.WriteFile(instance.iniPath, config, mode='w+');
+			self.__applyLimits(instance, data);
+			result = self.__apply(instance, apply);
+			return public.returnMsg(result['path'] != 'failed', result);
 		except ValueError:
 			return public.returnMsg(False, '请求错误，请刷新页面重试');
 
 	def read(self, get):
-		filename = pluginPath + '/conf/config.json';
+		instance = self.__instance(get);
+		if instance is None:
+			return public.returnMsg(False, '实例名称无效');
+		filename = instance.configPath;
 		if os.path.isfile(filename):
 			try:
 				config = json.loads(public.ReadFile(filename, mode='r'));
-				config['custom404Page'] = pluginPath + '/conf/404.html';
+				config['custom404Page'] = instance.custom404Path;
 				return public.returnMsg(True, config);
 			except ValueError:pass;
 		return public.returnMsg(False, '配置文件损坏或不存在');
@@ -175,11 +484,21 @@ class btp_frps_main():
 		};
 
 	def start(self, get):
-		pid = self.__pid();
+		instance = self.__instance(get);
+		if instance is None:
+			return public.returnMsg(False, '实例名称无效');
+		if not instance.exists():
+			return public.returnMsg(False, '实例 %s 不存在' % instance.name);
+		pid = self.__pid(instance);
 		if pid != False:
 			return public.returnMsg(True, 'frps 已开启，PID：%s' % pid);
+		# 其它实例共用模板服务，通过 %i 获取实例名称
+		if instance.default:
+			description, config = 'Frp Server Service', instance.iniPath;
+		else:
+			description, config = 'Frp Server Service (%i)', instancesPath + '/%i/conf/frps.ini';
 		service = '''[Unit]
-Description=Frp Server Service
+Description=%s
 After=network.target
 
 [Service]
@@ -190,69 +509,601 @@ RestartSec=5s
 ExecStart=%s -c %s
 
 [Install]
-WantedBy=multi-user.target''' % (frpsPath, frpsIniPath);
+WantedBy=multi-user.target''' % (description, frpsPath, config);
 		# 使用 systemd 管理自启动
-		filename = '/etc/systemd/system/btp_frps.service';
-		if os.path.isdir('/etc/systemd/system') and not os.path.isfile(filename):
+		filename = instance.servicePath;
+		if os.path.isdir(systemdPath) and not os.path.isfile(filename):
 			public.WriteFile(filename, service, mode='w+');
-			os.system('chown root:root %s' % filename);
-			os.system('chmod 755 %s' % filename);
+			os.system('chown root:root %s' % quote(filename));
+			os.system('chmod 755 %s' % quote(filename));
+		self.__snapshot(instance);
 		if os.path.isfile(filename):
-			os.system('systemctl enable btp_frps');
-			os.system('systemctl start btp_frps');
+			os.system('systemctl enable %s' % quote(instance.unit));
+			os.system('systemctl start %s' % quote(instance.unit));
 		else:
-			os.system('nohup %s -c %s &' % (frpsPath, frpsIniPath));
-		time.sleep(1);
-		pid = self.__pid();
-		if pid != False:
-			return public.returnMsg(True, '开启成功，PID：%s' % pid);
-		return public.returnMsg(False, '开启失败');
+			self.__spawn(instance);
+		result = self.__waitReady(instance, '开启');
+		if result['status']:
+			self.__startCollector(instance);
+		return result;
 
 	def stop(self, get):
-		pid = self.__pid();
+		instance = self.__instance(get);
+		if instance is None:
+			return public.returnMsg(False, '实例名称无效');
+		pid = self.__pid(instance);
 		if pid == False:
 			return public.returnMsg(True, 'frps 尚未运行');
-		filename = '/etc/systemd/system/btp_frps.service';
-		if os.path.isfile(filename):
-			os.system('systemctl stop btp_frps');
-			os.system('systemctl disable btp_frps');
-			os.system('rm -rf %s' % filename);
+		if instance.systemd():
+			os.system('systemctl stop %s' % quote(instance.unit));
+			os.system('systemctl disable %s' % quote(instance.unit));
+			# 模板服务由其它实例共用，不删除
+			if instance.default:
+				os.system('rm -rf %s' % quote(instance.servicePath));
 		else:
-			os.system('kill -9 %s' % pid);
+			self.__kill(instance, pid);
+		self.__stopCollector(instance);
 		return public.returnMsg(True, '关闭成功');
 
 	def restart(self, get):
-		if os.path.isfile('/etc/systemd/system/btp_frps.service'):
-			os.system('systemctl restart btp_frps');
+		instance = self.__instance(get);
+		if instance is None:
+			return public.returnMsg(False, '实例名称无效');
+		if not instance.exists():
+			return public.returnMsg(False, '实例 %s 不存在' % instance.name);
+		self.__snapshot(instance);
+		if instance.systemd():
+			os.system('systemctl restart %s' % quote(instance.unit));
 		else:
-			pid = self.__pid();
+			pid = self.__pid(instance);
 			if pid != False:
-				os.system('kill -9 %s' % pid);
-			os.system('nohup %s -c %s &' % (frpsPath, frpsIniPath));
-			import time;
-			time.sleep(1);
-		return public.returnMsg(True, '重启成功');
+				self.__kill(instance, pid);
+			self.__spawn(instance);
+		return self.__waitReady(instance, '重启');
+
+	def instances(self, get):
+		'''
+		汇总所有实例的运行状态、资源限制、内存占用及采集进程的最新统计数据
+		'''
+		result = [];
+		for instance in FrpsInstance.all():
+			config = self.__config(instance);
+			pid = self.__pid(instance);
+			item = {
+				'name': instance.name,
+				'pid': pid,
+				'systemd': instance.systemd(),
+				'bindAddr': config.get('bindAddr', ''),
+				'bindPort': self.__bindPort(instance),
+				'dashboardPort': config.get('dashboardPort', ''),
+				'cpuQuota': config.get('cpuQuota', ''),
+				'memoryMax': config.get('memoryMax', ''),
+				'limitNofile': config.get('limitNofile', ''),
+				'memory': 0,
+				'clients': 0,
+				'conns': 0,
+				'in': 0,
+				'out': 0
+			};
+			if pid != False:
+				status = public.ReadFile('/proc/%s/status' % pid, mode='r') or '';
+				match = re.search(r'^VmRSS:\s*(\d+)', status, re.M);
+				if match:
+					item['memory'] = int(match.group(1)) * 1024;
+				try:
+					latest = json.loads(public.ReadFile(instance.metricsPath + '/latest.json', mode='r'));
+					# 只使用最近的数据，避免显示已停止采集的旧数据
+					if time.time() - latest['time'] <= 10:
+						for key in ['clients', 'conns', 'in', 'out']:
+							item[key] = latest['server'][key];
+				except:pass;
+			result.append(item);
+		total = {};
+		for key in ['clients', 'conns', 'in', 'out', 'memory']:
+			total[key] = sum([item[key] for item in result]);
+		total['running'] = len([item for item in result if item['pid'] != False]);
+		return public.returnMsg(True, {'instances': result, 'total': total});
+
+	def create(self, get):
+		'''
+		创建实例，参数：{"name": "实例名称", "bindPort": 7100}，
+		其它配置复制默认实例，可能与其它实例冲突的端口留空
+		'''
+		try:
+			data = json.loads(get['json']);
+		except:
+			data = {};
+		name = str(data.get('name', '')).strip();
+		if not FrpsInstance.valid(name):
+			return public.returnMsg(False, '实例名称只能包含字母、数字、下划线及中划线，且不能为 default');
+		port = str(data.get('bindPort', '')).strip();
+		if not port.isdigit() or int(port) < 1 or int(port) > 65535:
+			return public.returnMsg(False, '请输入 1 至 65535 之间的 TCP 端口');
+		instance = FrpsInstance(name);
+		if instance.exists():
+			return public.returnMsg(False, '实例 %s 已存在' % name);
+		config = self.__config(FrpsInstance());
+		for key in ['bindUdpPort', 'kcpBindPort', 'vhostHttpPort', 'vhostHttpsPort', 'dashboardPort']:
+			config[key] = '';
+		config['bindPort'] = int(port);
+		conflict = self.__portConflict(instance, config);
+		if conflict:
+			return public.returnMsg(False, conflict);
+		os.system('mkdir -p %s %s' % (quote(instance.confPath), quote(instance.tempPath)));
+		try:
+			result = self.save({'instance': name, 'json': json.dumps(config)});
+		except Exception as e:
+			result = public.returnMsg(False, '创建失败：%s' % str(e));
+		if not result['status']:
+			os.system('rm -rf %s' % quote(instancesPath + '/' + name));
+			return result;
+		return public.returnMsg(True, '创建成功');
+
+	def remove(self, get):
+		instance = self.__instance(get);
+		if instance is None:
+			return public.returnMsg(False, '实例名称无效');
+		if instance.default:
+			return public.returnMsg(False, '默认实例不能删除');
+		if not instance.exists():
+			return public.returnMsg(False, '实例 %s 不存在' % instance.name);
+		self.stop(get);
+		if os.path.isdir(instance.dropInPath):
+			os.system('rm -rf %s' % quote(instance.dropInPath));
+			os.system('systemctl daemon-reload');
+		os.system('rm -rf %s' % quote(instancesPath + '/' + instance.name));
+		return public.returnMsg(True, '删除成功');
 
 	def logs(self, get):
-		filename = pluginPath + '/temp/frps.log';
+		instance = self.__instance(get);
+		if instance is None:
+			return public.returnMsg(False, '实例名称无效');
+		filename = instance.logPath;
 		if os.path.isfile(filename):
-			# 宝塔封装的 public.ReadFile 不适合读取大文件
-			success, failed = public.ExecShell('tail -n 1000 %s' % filename);
-			if success.strip() != '':
-				return public.returnMsg(True, success.strip());
+			# 宝塔封装的 public.ReadFile 不适合读取大文件，只读取末尾部分
+			size = os.path.getsize(filename);
+			with open(filename, 'rb') as f:
+				f.seek(max(0, size - logTailSize));
+				lines = self.__decodeLog(f.read()).strip().split('\n');
+			if size > logTailSize:
+				lines = lines[1:];
+			logs = '\n'.join(lines[-1000:]).strip();
+			if logs != '':
+				return public.returnMsg(True, logs);
 		return public.returnMsg(True, '暂无运行日志');
 
+	def tail(self, get):
+		'''
+		增量读取运行日志，参数为上次返回的游标及过滤条件：
+		{"inode": 0, "offset": 0, "sign": "", "level": "W,E", "proxy": "代理名称"}
+		没有游标、日志被轮转（inode 变化）或被清空（大小小于偏移或开头内容变化）时从末尾重新读取，
+		日志没有变化时只需要一次 stat 和一次 64 字节的读取
+		'''
+		try:
+			data = json.loads(get['json']);
+		except:
+			data = {};
+		instance = self.__instance(get);
+		if instance is None:
+			return public.returnMsg(False, '实例名称无效');
+		filename = instance.logPath;
+		result = {'inode': 0, 'offset': 0, 'sign': '', 'reset': False, 'more': False, 'logs': ''};
+		if not os.path.isfile(filename):
+			result['reset'] = True;
+			return public.returnMsg(True, result);
+
+		with open(filename, 'rb') as f:
+			stat = os.fstat(f.fileno());
+			sign = self.__logSign(f.read(64));
+			try:
+				offset = int(data.get('offset', -1));
+				inode = int(data.get('inode', 0));
+			except (TypeError, ValueError):
+				offset, inode = -1, 0;
+			if inode != stat.st_ino or offset < 0 or offset > stat.st_size or data.get('sign') != sign:
+				result['reset'] = True;
+				offset = max(0, stat.st_size - logTailSize);
+			content = b'';
+			if offset < stat.st_size:
+				f.seek(offset);
+				content = f.read(logReadSize);
+				if result['reset'] and offset > 0:
+					# 从中间开始读取时丢弃不完整的第一行
+					position = content.find(b'\n');
+					if position == -1:
+						position = len(content) - 1;
+					offset += position + 1;
+					content = content[position + 1:];
+				# 只返回完整的行，未写完的行留到下次读取
+				position = content.rfind(b'\n');
+				if position != -1:
+					content = content[:position + 1];
+				elif len(content) < logReadSize:
+					content = b'';
+			offset += len(content);
+
+		levels = [level for level in str(data.get('level', '')).upper().split(',') if level];
+		proxy = str(data.get('proxy', '')).strip();
+		lines = [];
+		for line in self.__decodeLog(content).split('\n'):
+			if line.strip() == '':
+				continue;
+			if len(levels) > 0:
+				match = re.search(r'\[([TDIWE])\]', line);
+				if not match or match.group(1) not in levels:
+					continue;
+			if proxy != '' and ('[%s]' % proxy) not in line:
+				continue;
+			lines.append(line);
+
+		result.update({
+			'inode': stat.st_ino,
+			'offset': offset,
+			'sign': sign,
+			'more': offset < stat.st_size,
+			'logs': '\n'.join(lines)
+		});
+		return public.returnMsg(True, result);
+
+	def metrics(self, get):
+		'''
+		读取采集进程保存的最新统计数据，返回服务端汇总及排名前 N 的代理，参数：
+		{"limit": 10, "sort": "rate"}，sort 可选 rate（总速率）、in、out、conns、traffic（今日流量）
+		'''
+		try:
+			data = json.loads(get['json']);
+		except:
+			data = {};
+		instance = self.__instance(get);
+		if instance is None:
+			return public.returnMsg(False, '实例名称无效');
+		if dashboardConfig(instance) is None:
+			return public.returnMsg(False, '请先在仪表盘设置中配置监听端口');
+		if self.__pid(instance) != False:
+			self.__startCollector(instance);
+		result = {'time': 0, 'server': None, 'proxies': [], 'total': 0, 'collecting': self.__collectorPid(instance) != False};
+		filename = instance.metricsPath + '/latest.json';
+		if os.path.isfile(filename):
+			try:
+				result.update(json.loads(public.ReadFile(filename, mode='r')));
+			except ValueError:pass;
+		keys = {
+			'rate': lambda item: item['in'] + item['out'],
+			'in': lambda item: item['in'],
+			'out': lambda item: item['out'],
+			'conns': lambda item: item['conns'],
+			'traffic': lambda item: item['trafficIn'] + item['trafficOut']
+		};
+		try:
+			limit = max(1, int(data.get('limit', 10)));
+		except (TypeError, ValueError):
+			limit = 10;
+		proxies = sorted(result['proxies'], key=keys.get(data.get('sort'), keys['rate']), reverse=True);
+		result.update({'proxies': proxies[:limit], 'total': len(proxies)});
+		return public.returnMsg(True, result);
+
+	def history(self, get):
+		'''
+		读取服务端或指定代理的历史数据，参数：{"name": "代理名称，为空表示服务端", "step": 60}，
+		step 为数据精度（秒），可选 1、60、3600，每个数据点为 [时间戳, 入站速率, 出站速率, 连接数]
+		'''
+		try:
+			data = json.loads(get['json']);
+			step = int(data.get('step', 60));
+		except:
+			data, step = {}, 60;
+		name = str(data.get('name', '')).strip();
+		series = MetricsCollector.seriesName(name) if name != '' else 'server';
+		instance = self.__instance(get);
+		if instance is None:
+			return public.returnMsg(False, '实例名称无效');
+		return public.returnMsg(True, {
+			'name': name,
+			'step': step,
+			'points': MetricsRing.read('%s/%s.dat' % (instance.metricsPath, series), step)
+		});
+
 	def clear(self, get):
-		filename = pluginPath + '/temp/frps.log';
-		os.system('cat /dev/null > %s' % filename);
+		instance = self.__instance(get);
+		if instance is None:
+			return public.returnMsg(False, '实例名称无效');
+		if os.path.isfile(instance.logPath):
+			os.system('cat /dev/null > %s' % quote(instance.logPath));
 		return public.returnMsg(True, '清理成功');
 
-	def __pid(self):
-		success, failed = public.ExecShell('ps -ef | grep %s | grep -v grep | awk \'{print $2}\' | head -n 1' % frpsPath);
-		if success.strip() == '':
+	def __decodeLog(self, content):
+		# 去掉日志中的颜色控制字符
+		return re.sub(r'\x1b\[[0-9;]*m', '', content.decode('utf-8', 'ignore'));
+
+	def __logSign(self, head):
+		import hashlib;
+		return hashlib.md5(head).hexdigest();
+
+	def __instance(self, get):
+		'''
+		获取请求指定的实例，未指定时为默认实例，名称无效时返回 None
+		'''
+		try:
+			name = get['instance'];
+		except:
+			name = '';
+		try:
+			return FrpsInstance(name);
+		except ValueError:
+			return None;
+
+	def __config(self, instance):
+		try:
+			return json.loads(public.ReadFile(instance.configPath, mode='r'));
+		except:
+			return {};
+
+	def __pid(self, instance):
+		'''
+		获取实例 frps 的 PID，不存在时返回 False
+		systemd 管理时读取服务的 cgroup（读取失败时使用 systemctl show），否则读取 PID 文件，
+		并通过 /proc/<pid>/exe 及命令行参数确认进程确实是该实例的 frps
+		'''
+		pids = [];
+		if instance.systemd():
+			for filename in instance.cgroupPaths:
+				if os.path.isfile(filename):
+					pids = public.ReadFile(filename, mode='r').split();
+					break;
+			if len(pids) == 0:
+				success, failed = public.ExecShell('systemctl show -p MainPID %s' % quote(instance.unit));
+				pids = [success.strip().split('=')[-1]];
+		elif os.path.isfile(instance.pidPath):
+			pids = [public.ReadFile(instance.pidPath, mode='r').strip()];
+		for pid in pids:
+			if pid.isdigit() and int(pid) > 0 and self.__isFrps(instance, pid):
+				return pid;
+		return False;
+
+	def __isFrps(self, instance, pid):
+		try:
+			exe = os.readlink('/proc/%s/exe' % pid);
+			with open('/proc/%s/cmdline' % pid, 'rb') as f:
+				cmdline = f.read().split(b'\0');
+		except (IOError, OSError):
 			return False;
+		# 运行中更新 frps 后原文件会被标记为已删除
+		if exe.endswith(' (deleted)'):
+			exe = exe[:-10];
+		return os.path.realpath(exe) == os.path.realpath(frpsPath) and instance.iniPath.encode('utf-8') in cmdline;
+
+	def __spawn(self, instance):
+		# 由 shell 在后台启动，frps 不会成为面板进程的子进程
+		os.system('mkdir -p ' + quote(instance.tempPath));
+		limit = str(self.__config(instance).get('limitNofile', '')).strip();
+		prefix = 'ulimit -n %s; ' % limit if limit.isdigit() else '';
+		success, failed = public.ExecShell('%snohup %s -c %s >/dev/null 2>&1 & echo $!' % (prefix, quote(frpsPath), quote(instance.iniPath)));
+		public.WriteFile(instance.pidPath, success.strip(), mode='w+');
 		return success.strip();
 
+	def __kill(self, instance, pid):
+		import signal;
+		try:
+			os.kill(int(pid), signal.SIGTERM);
+			for i in range(50):
+				time.sleep(0.1);
+				if not self.__isFrps(instance, pid):
+					break;
+			else:
+				os.kill(int(pid), signal.SIGKILL);
+		except OSError:pass;
+		if os.path.isfile(instance.pidPath):
+			os.remove(instance.pidPath);
+
+	def __applyLimits(self, instance, data):
+		'''
+		将实例的 CPU、内存及文件描述符限制写入 systemd 的 drop-in 配置，
+		运行中时通过 systemctl set-property 及 prlimit 立即生效，无需重启 frps
+		'''
+		limits = {};
+		for key in ['cpuQuota', 'memoryMax', 'limitNofile']:
+			value = str(data.get(key, '')).strip();
+			limits[key] = value if value.isdigit() and int(value) > 0 else '';
+		properties = [];
+		if limits['cpuQuota'] != '':
+			properties.append('CPUQuota=%s%%' % limits['cpuQuota']);
+		if limits['memoryMax'] != '':
+			# MemoryLimit 用于兼容 cgroup v1 的旧版本 systemd
+			properties += ['MemoryMax=%sM' % limits['memoryMax'], 'MemoryLimit=%sM' % limits['memoryMax']];
+		if os.path.isdir(systemdPath):
+			filename = instance.dropInPath + '/limits.conf';
+			content = '[Service]\n' + ''.join([item + '\n' for item in properties]);
+			if limits['limitNofile'] != '':
+				content += 'LimitNOFILE=%s\n' % limits['limitNofile'];
+			old = public.ReadFile(filename, mode='r') if os.path.isfile(filename) else '[Service]\n';
+			if content != old:
+				os.system('mkdir -p ' + quote(instance.dropInPath));
+				public.WriteFile(filename, content, mode='w+');
+				os.system('systemctl daemon-reload');
+		pid = self.__pid(instance);
+		if pid == False:
+			return;
+		if instance.systemd():
+			# 未设置的限制使用空值恢复为不限制
+			if limits['cpuQuota'] == '':
+				properties.append('CPUQuota=');
+			if limits['memoryMax'] == '':
+				properties += ['MemoryMax=infinity', 'MemoryLimit=infinity'];
+			os.system('systemctl set-property --runtime %s %s >/dev/null 2>&1' % (quote(instance.unit), ' '.join(properties)));
+		if limits['limitNofile'] != '':
+			os.system('prlimit --pid %s --nofile=%s:%s >/dev/null 2>&1' % (pid, limits['limitNofile'], limits['limitNofile']));
+
+	def __portConflict(self, instance, data):
+		'''
+		检查端口是否与其它实例冲突，监听地址不同（且都不是通配地址）时允许使用相同端口
+		'''
+		ports = self.__ports(data);
+		for other in FrpsInstance.all():
+			if other.name == instance.name:
+				continue;
+			for port in self.__ports(self.__config(other)):
+				for current in ports:
+					if current[0] != port[0] or current[1] != port[1]:
+						continue;
+					if current[2] == port[2] or '' in [current[2], port[2]]:
+						return '%s 端口 %s 已被实例 %s 使用' % (port[0].upper(), port[1], other.name);
+		return None;
+
+	def __ports(self, data):
+		# 返回 [(协议, 端口, 监听地址)]，通配地址统一为空字符串
+		def address(key):
+			value = str(data.get(key, '')).strip() or str(data.get('bindAddr', '')).strip();
+			return '' if value in ['0.0.0.0', '::', '[::]'] else value;
+		ports = [];
+		for protocol, key, addr in [
+			('tcp', 'bindPort', 'bindAddr'),
+			('udp', 'bindUdpPort', 'bindAddr'),
+			('udp', 'kcpBindPort', 'bindAddr'),
+			('tcp', 'vhostHttpPort', 'proxyBindAddr'),
+			('tcp', 'vhostHttpsPort', 'proxyBindAddr'),
+			('tcp', 'dashboardPort', 'dashboardAddr')
+		]:
+			port = str(data.get(key, '')).strip();
+			# 未设置 bind_port 时 frps 使用默认端口 7000
+			if key == 'bindPort' and port == '':
+				port = '7000';
+			if port.isdigit() and int(port) > 0:
+				ports.append((protocol, int(port), address(addr)));
+		return ports;
+
+	def __apply(self, instance, apply):
+		'''
+		对比新配置与运行中的配置，返回采用的处理方式：
+		stopped（frps 未运行）、unchanged（配置无变化）、pending（需要重启，等待用户确认）、restart（已重启）、failed（重启失败）
+		frps 不支持重新加载配置文件，除配置无变化外都需要重启才能生效，
+		重启会断开所有现有连接，conns 为重启前的连接数（来自采集进程，没有可用数据时为 None）
+		'''
+		result = {'path': 'stopped', 'keys': [], 'conns': None, 'msg': '保存成功'};
+		if self.__pid(instance) == False:
+			return result;
+		running = self.__parseIni(public.ReadFile(instance.runningIniPath, mode='r') if os.path.isfile(instance.runningIniPath) else '');
+		current = self.__parseIni(public.ReadFile(instance.iniPath, mode='r'));
+		result['keys'] = sorted([key for key in set(running) | set(current) if running.get(key) != current.get(key)]);
+		if len(result['keys']) == 0:
+			result.update({'path': 'unchanged', 'msg': '保存成功，运行中的配置没有变化，无需重启 frps'});
+			return result;
+		result['conns'] = self.__activeConns(instance);
+		if not apply:
+			result.update({'path': 'pending', 'msg': '保存成功！配置信息将在重启 frps 后生效'});
+			return result;
+		restart = self.restart({'instance': instance.name});
+		if not restart['status']:
+			result.update({'path': 'failed', 'msg': '保存成功，但' + restart['msg']});
+			return result;
+		result.update({'path': 'restart', 'msg': '保存成功，' + restart['msg'] + '，原有连接已断开，客户端将自动重连'});
+		return result;
+
+	def __parseIni(self, content):
+		config = {};
+		for line in (content or '').split('\n'):
+			line = line.strip();
+			if line == '' or line[0] in '#;[' or '=' not in line:
+				continue;
+			key, value = line.split('=', 1);
+			config[key.strip()] = value.strip();
+		return config;
+
+	def __snapshot(self, instance):
+		os.system('mkdir -p ' + quote(instance.tempPath));
+		if os.path.isfile(instance.iniPath):
+			public.WriteFile(instance.runningIniPath, public.ReadFile(instance.iniPath, mode='r'), mode='w+');
+
+	def __activeConns(self, instance):
+		'''
+		从采集进程的最新数据读取当前连接数，没有可用数据时返回 None
+		'''
+		try:
+			latest = json.loads(public.ReadFile(instance.metricsPath + '/latest.json', mode='r'));
+			if time.time() - latest['time'] <= 5:
+				return int(latest['server']['conns']);
+		except:pass;
+		return None;
+
+	def __collectorPid(self, instance):
+		if not os.path.isfile(instance.collectorPidPath):
+			return False;
+		pid = public.ReadFile(instance.collectorPidPath, mode='r').strip();
+		try:
+			with open('/proc/%s/cmdline' % pid, 'rb') as f:
+				cmdline = f.read();
+		except (IOError, OSError):
+			return False;
+		if b'btp_frps_main.py' in cmdline and b'collect' in cmdline:
+			return pid;
+		return False;
+
+	def __startCollector(self, instance):
+		'''
+		在后台启动采集进程，已在运行或未配置仪表盘时不做处理
+		'''
+		if self.__collectorPid(instance) != False or dashboardConfig(instance) is None:
+			return;
+		os.system('mkdir -p ' + quote(instance.metricsPath));
+		success, failed = public.ExecShell('nohup %s %s collect %s >/dev/null 2>&1 & echo $!' % (quote(sys.executable or 'python'), quote(pluginPath + '/btp_frps_main.py'), quote(instance.name)));
+		public.WriteFile(instance.collectorPidPath, success.strip(), mode='w+');
+
+	def __stopCollector(self, instance):
+		import signal;
+		pid = self.__collectorPid(instance);
+		if os.path.isfile(instance.collectorPidPath):
+			os.remove(instance.collectorPidPath);
+		if pid != False:
+			try:
+				os.kill(int(pid), signal.SIGTERM);
+			except OSError:pass;
+
+	def __bindPort(self, instance):
+		port = 7000;
+		if os.path.isfile(instance.iniPath):
+			match = re.search(r'^\s*bind_port\s*=\s*(\d+)', public.ReadFile(instance.iniPath, mode='r'), re.M);
+			if match:
+				port = int(match.group(1));
+		return port;
+
+	def __listening(self, port):
+		'''
+		从 /proc/net/tcp(6) 判断端口是否处于监听状态
+		'''
+		port = '%04X' % port;
+		for filename in ['/proc/net/tcp', '/proc/net/tcp6']:
+			if not os.path.isfile(filename):
+				continue;
+			with open(filename) as f:
+				next(f, None);
+				for line in f:
+					fields = line.split();
+					if len(fields) > 3 and fields[3] == '0A' and fields[1].split(':')[-1] == port:
+						return True;
+		return False;
+
+	def __waitReady(self, instance, action, timeout=10):
+		'''
+		等待 frps 监听 bind_port，超时或进程退出（例如配置错误）时立即返回，
+		systemd 启动后进程可能尚未执行 frps，因此在 1 秒内未找到进程时继续等待
+		'''
+		port = self.__bindPort(instance);
+		pid = False;
+		started = time.time();
+		deadline = started + timeout;
+		seen = False;
+		while time.time() < deadline:
+			pid = self.__pid(instance);
+			if pid != False and self.__listening(port):
+				return public.returnMsg(True, '%s成功，PID：%s' % (action, pid));
+			if pid != False:
+				seen = True;
+			elif seen or time.time() - started > 1:
+				break;
+			time.sleep(0.1);
+		if pid != False:
+			return public.returnMsg(True, '%s成功，PID：%s，但端口 %s 尚未监听，请查看运行日志' % (action, pid, port));
+		return public.returnMsg(False, '%s失败' % action);
+
 	def __getTaskStatus(self, taskName):
 		result = public.M('tasks').where("status!=?", ('1',)).field('status,name').select();
 		status = 1;
@@ -263,4 +1114,9 @@ WantedBy=multi-user.target''' % (frpsPath, frpsIniPath);
 				status = int(task['status']);
 		return status;
 
-#print(btp_frps_main().install({}));
\ No newline at end of file
+#print(btp_frps_main().install({}));
+
+if __name__ == '__main__':
+	# 采集进程，由插件通过 nohup 启动：python btp_frps_main.py collect <实例名称>
+	if len(sys.argv) > 1 and sys.argv[1] == 'collect':
+		MetricsCollector(FrpsInstance(sys.argv[2] if len(sys.argv) > 2 else '')).run();
\ No newline at end of file
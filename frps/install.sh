@@ -36,6 +36,15 @@ Uninstall()
 		systemctl disable btp_frps
 		rm -rf /etc/systemd/system/btp_frps.service
 	fi
+	if [ -d ${install_path}/instances ];then
+		for name in $(ls ${install_path}/instances);do
+			systemctl stop btp_frps@${name}
+			systemctl disable btp_frps@${name}
+		done
+	fi
+	rm -rf /etc/systemd/system/btp_frps@.service
+	rm -rf /etc/systemd/system/btp_frps.service.d /etc/systemd/system/btp_frps@*.service.d
+	systemctl daemon-reload
 	rm -rf $install_path
 	echo 'success'
 }
@@ -12,7 +12,13 @@ new Vue({
 				});
 			}
 			if (current === 'status') {
-				t.getLogs();
+				t.resetLogs();
+			}
+			if (current === 'metrics') {
+				t.getMetrics();
+			}
+			if (current === 'instances') {
+				t.getInstances(true);
 			}
 		}
 	},
@@ -39,10 +45,18 @@ new Vue({
 				name: "端口白名单",
 				value: "ports"
 			},
+			{
+				name: "流量统计",
+				value: "metrics"
+			},
 			{
 				name: "运行状态",
 				value: "status"
 			},
+			{
+				name: "实例管理",
+				value: "instances"
+			},
 			{
 				name: "关于",
 				value: "about"
@@ -115,10 +129,39 @@ new Vue({
 			subdomainHost: '',
 			tcpMux: true,
 			disableLogColor: false,
+			cpuQuota: '',
+			memoryMax: '',
+			limitNofile: '',
 			custom404Page: '/www/server/panel/plugin/btp_frps/conf/404.html',
 			enabledCustom404Page: false
 		},
 		logs: '',
+		logLines: [],
+		logCursor: {},
+		logFilter: {
+			level: '',
+			proxy: ''
+		},
+		metrics: {
+			time: 0,
+			server: null,
+			proxies: [],
+			total: 0,
+			collecting: false
+		},
+		metricsMsg: '加载中 ...',
+		metricsQuery: {
+			sort: 'rate',
+			limit: 10
+		},
+		history: {
+			name: '',
+			step: 60,
+			points: []
+		},
+		instance: 'default',
+		instances: [],
+		instanceTotal: {},
 		timer: null,
 		createdAt: (new Date()).getTime().toString()
 	},
@@ -239,29 +282,37 @@ new Vue({
 		removePort(index) {
 			this.config.allowPorts.splice(index, 1);
 		},
-		save(init) {
+		save(init, apply) {
 			const t = this;
-			const msgId = layer.msg(init === true ? "正在初始化配置，请稍等 ..." : "正在保存配置，请稍等 ...", {
+			const msgId = layer.msg(init === true ? "正在初始化配置，请稍等 ..." : (apply === true ? "正在保存配置并重启 frps，请稍等 ..." : "正在保存配置，请稍等 ..."), {
 				icon: 16,
 				time: 0,
 				shade: 0.3
 			});
-			t.api('save', t.config).then((response) => {
+			// apply 为 true 时服务端会在配置有变化时立即重启 frps，现有连接会被断开
+			t.api('save', Object.assign({apply: apply === true}, t.config)).then((response) => {
 				layer.close(msgId);
 				if (response.status === 200 && typeof response.data === 'object') {
+					const result = response.data.msg;
 					if (response.data.status) {
 						if (init === true) {
 							return layer.msg('初始化配置成功', {icon: 1});
 						}
-						if (!t.started) {
-							return layer.msg('保存成功', {icon: 1});
+						switch (result.path) {
+							case 'pending':
+								// frps 不支持重新加载配置，重启会断开所有现有连接
+								return layer.confirm(result.msg + '<br>变更项：' + result.keys.join('、') + '<br>重启将断开' + (result.conns === null ? '所有现有连接' : '当前的 ' + result.conns + ' 个连接') + '，客户端会自动重连', {icon: 1, btn: ['重启', '关闭']}, (index) => {
+									layer.close(index);
+									t.save(false, true);
+								});
+							case 'restart':
+								t.started = true;
+								return layer.msg(result.msg, {icon: 1});
+							default:
+								return layer.msg(result.msg, {icon: 1});
 						}
-						return layer.confirm('保存成功！配置信息将在重启 frps 后生效', {icon: 1, btn: ['重启', '关闭']}, (index) => {
-							layer.close(index);
-							t.restart();
-						});
 					}
-					return layer.alert(response.data.msg, {
+					return layer.alert(typeof result === 'object' ? result.msg : result, {
 						icon: 2
 					});
 				}
@@ -411,12 +462,26 @@ new Vue({
 			const t = this;
 			const $el = document.querySelector('#btp_frps');
 			if ($el && $el.getAttribute('data-created-at') === t.createdAt) {
-				t.api('logs').then((response) => {
-					t.timer = setTimeout(t.getLogs, 5000);
-					if (response.status === 200 && typeof response.data === 'object') {
-						t.logs = response.data.msg;
+				// 只获取上次读取位置之后的新日志，日志被轮转或清空时服务端会返回 reset
+				t.api('tail', Object.assign({}, t.logCursor, t.logFilter)).then((response) => {
+					if (response.status === 200 && typeof response.data === 'object' && response.data.status) {
+						const result = response.data.msg;
+						t.timer = setTimeout(t.getLogs, result.more ? 0 : 3000);
+						if (result.reset) {
+							t.logLines = [];
+						}
+						if (result.logs) {
+							t.logLines = t.logLines.concat(result.logs.split('\n')).slice(-1000);
+						}
+						t.logCursor = {
+							inode: result.inode,
+							offset: result.offset,
+							sign: result.sign
+						};
+						t.logs = t.logLines.length ? t.logLines.join('\n') : '暂无运行日志';
 						return;
 					}
+					t.timer = setTimeout(t.getLogs, 5000);
 					t.logs = '暂无日志';
 				}).catch((error) => {
 					t.timer = setTimeout(t.getLogs, 3000);
@@ -425,6 +490,185 @@ new Vue({
 				});
 			}
 		},
+		resetLogs() {
+			const t = this;
+			if (t.timer !== null) {
+				clearTimeout(t.timer);
+			}
+			t.logCursor = {};
+			t.logLines = [];
+			t.getLogs();
+		},
+		getMetrics() {
+			const t = this;
+			const $el = document.querySelector('#btp_frps');
+			if ($el && $el.getAttribute('data-created-at') === t.createdAt && t.current === 'metrics') {
+				// 数据由后台采集进程写入，这里只读取最新结果，不会直接请求 frps
+				Promise.all([t.api('metrics', t.metricsQuery), t.api('history', {name: t.history.name, step: t.history.step})]).then((responses) => {
+					t.timer = setTimeout(t.getMetrics, 3000);
+					const metrics = responses[0].data, history = responses[1].data;
+					if (typeof metrics !== 'object' || !metrics.status) {
+						t.metricsMsg = typeof metrics === 'object' ? metrics.msg : '暂无数据';
+						t.metrics.server = null;
+						return;
+					}
+					t.metrics = metrics.msg;
+					t.metricsMsg = metrics.msg.server ? '' : (metrics.msg.collecting ? '正在采集数据，请稍等 ...' : '暂无数据，请确认 frps 已开启');
+					if (typeof history === 'object' && history.status) {
+						t.history.points = history.msg.points;
+					}
+				}).catch((error) => {
+					t.timer = setTimeout(t.getMetrics, 5000);
+					t.metricsMsg = '接口请求失败';
+					console.error(error);
+				});
+			}
+		},
+		showHistory(name) {
+			const t = this;
+			if (t.timer !== null) {
+				clearTimeout(t.timer);
+			}
+			t.history.name = name;
+			t.history.points = [];
+			t.getMetrics();
+		},
+		historyLine(index) {
+			// 将历史数据转换为 SVG 折线坐标，index 为 1 时表示入站，2 表示出站
+			const points = this.history.points;
+			if (points.length < 2) {
+				return '';
+			}
+			const begin = points[0][0], span = Math.max(1, points[points.length - 1][0] - begin);
+			const max = Math.max(1, ...points.map((point) => Math.max(point[1], point[2])));
+			return points.map((point) => {
+				return ((point[0] - begin) / span * 600).toFixed(1) + ',' + (115 - point[index] / max * 110).toFixed(1);
+			}).join(' ');
+		},
+		historyMax() {
+			const points = this.history.points;
+			return points.length ? Math.max(...points.map((point) => Math.max(point[1], point[2]))) : 0;
+		},
+		formatSize(bytes, suffix) {
+			const units = ['B', 'KB', 'MB', 'GB', 'TB'];
+			let i = 0;
+			bytes = bytes || 0;
+			while (bytes >= 1024 && i < units.length - 1) {
+				bytes /= 1024;
+				i++;
+			}
+			return bytes.toFixed(i === 0 ? 0 : 2) + ' ' + units[i] + (suffix || '');
+		},
+		getInstances(poll) {
+			const t = this;
+			const $el = document.querySelector('#btp_frps');
+			if (poll === true && (!$el || $el.getAttribute('data-created-at') !== t.createdAt || t.current !== 'instances')) {
+				return;
+			}
+			t.api('instances').then((response) => {
+				if (poll === true) {
+					t.timer = setTimeout(() => {
+						t.getInstances(true);
+					}, 3000);
+				}
+				if (response.status === 200 && typeof response.data === 'object' && response.data.status) {
+					t.instances = response.data.msg.instances;
+					t.instanceTotal = response.data.msg.total;
+				}
+			}).catch((error) => {
+				if (poll === true) {
+					t.timer = setTimeout(() => {
+						t.getInstances(true);
+					}, 5000);
+				}
+				console.error(error);
+			});
+		},
+		switchInstance(name) {
+			const t = this;
+			t.instance = name;
+			t.logs = '';
+			t.logLines = [];
+			t.logCursor = {};
+			t.metrics.server = null;
+			t.metrics.proxies = [];
+			t.history.name = '';
+			t.history.points = [];
+			t.check();
+			layer.msg('已切换到实例 ' + name, {icon: 1});
+		},
+		createInstance() {
+			const t = this;
+			const name = '__btp_frps_' + (new Date()).getTime();
+			layer.open({
+				type: 1,
+				title: '添加实例',
+				closeBtn: 2,
+				area: '450px',
+				btn: ['确定', '取消'],
+				content: t.$refs.addInstance.innerHTML.replace(/__VALUE__/g, name),
+				yes(index, layers) {
+					const data = {
+						name: document.querySelector('input[name="' + name + '_name"]').value.trim(),
+						bindPort: document.querySelector('input[name="' + name + '_port"]').value.trim()
+					};
+					if (!data.name.match(/^[a-zA-Z0-9_\-]{1,32}$/) || data.name === 'default') {
+						layer.msg('实例名称只能包含字母、数字、下划线及中划线，且不能为 default', {icon: 2});
+						return false;
+					}
+					if (!data.bindPort.match(/^[0-9]\d*$/) || parseInt(data.bindPort) < 1 || parseInt(data.bindPort) > 65535) {
+						layer.msg('端口范围为 1 至 65535，请重新输入', {icon: 2});
+						return false;
+					}
+					t.api('create', data).then((response) => {
+						if (response.status === 200 && typeof response.data === 'object') {
+							if (response.data.status) {
+								layer.close(index);
+								t.getInstances();
+								return t.switchInstance(data.name);
+							}
+							return layer.msg(response.data.msg, {icon: 2});
+						}
+						layer.alert('发生未知错误，代码：' + response.status, {
+							icon: 2
+						});
+					}).catch((error) => {
+						layer.alert('接口请求失败', {
+							icon: 2
+						});
+						console.error(error);
+					});
+				}
+			});
+		},
+		removeInstance(name) {
+			const t = this;
+			layer.confirm('删除实例 ' + name + ' 将关闭该实例的 frps 并删除其配置及日志，是否继续？', {icon: 3, btn: ['删除', '取消']}, (index) => {
+				layer.close(index);
+				axios.get('/plugin?action=a&name=btp_frps&s=remove&instance=' + encodeURIComponent(name)).then((response) => {
+					if (response.status === 200 && typeof response.data === 'object') {
+						if (response.data.status) {
+							if (t.instance === name) {
+								t.switchInstance('default');
+							}
+							t.getInstances();
+							return layer.msg(response.data.msg, {icon: 1});
+						}
+						return layer.alert(response.data.msg, {
+							icon: 2
+						});
+					}
+					layer.alert('发生未知错误，代码：' + response.status, {
+						icon: 2
+					});
+				}).catch((error) => {
+					layer.alert('接口请求失败', {
+						icon: 2
+					});
+					console.error(error);
+				});
+			});
+		},
 		clearLogs() {
 			const t = this;
 			const msgId = layer.msg("正在清理 frps 运行日志，请稍等 ...", {
@@ -437,6 +681,8 @@ new Vue({
 				if (response.status === 200 && typeof response.data === 'object') {
 					if (response.data.status) {
 						t.logs = '暂无运行日志';
+						t.logLines = [];
+						t.logCursor = {};
 						return layer.msg('清理成功', {icon: 1});
 					}
 					return layer.alert(response.data.msg, {
@@ -578,14 +824,17 @@ new Vue({
 			});
 		},
 		api(action, data) {
+			// 所有接口都作用于当前选择的实例
+			const url = '/plugin?action=a&name=btp_frps&s=' + action + '&instance=' + encodeURIComponent(this.instance);
 			if (!data) {
-				return axios.get('/plugin?action=a&name=btp_frps&s=' + action);
+				return axios.get(url);
 			}
-			return axios.post('/plugin?action=a&name=btp_frps&s=' + action, 'json=' + encodeURIComponent(JSON.stringify(data)));
+			return axios.post(url, 'json=' + encodeURIComponent(JSON.stringify(data)));
 		}
 	},
 	created() {
 		this.check();
+		this.getInstances();
 	},
 	mounted() {
 		const t = this;
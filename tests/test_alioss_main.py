@@ -0,0 +1,170 @@
+# coding: utf-8
+# +-------------------------------------------------------------------
+# | alioss插件纯函数与文件格式测试，需要在安装了宝塔面板与oss2的环境中运行：
+# |     python -m unittest discover -s tests
+# +-------------------------------------------------------------------
+from __future__ import absolute_import, print_function, division
+
+import gzip
+import io
+import os
+import sys
+import tarfile
+import unittest
+import zlib
+
+_cwd = os.getcwd()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "alioss"))
+try:
+    import alioss_main as m
+except ImportError as e:
+    raise unittest.SkipTest("缺少宝塔面板或oss2环境：{}".format(e))
+finally:
+    os.chdir(_cwd)
+
+
+def crc64(data):
+    """逐位计算的CRC64(ECMA-182)，作为参照"""
+    mask = (1 << 64) - 1
+    crc = mask
+    for byte in bytearray(data):
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ (m.CRC64_POLY if crc & 1 else 0)
+    return crc ^ mask
+
+
+class Crc64CombineTest(unittest.TestCase):
+
+    def test_combine(self):
+        data = os.urandom(3000)
+        for split in (0, 1, 7, 1024, 2999, 3000):
+            a, b = data[:split], data[split:]
+            self.assertEqual(
+                m.crc64_combine(crc64(a), crc64(b), len(b)), crc64(data))
+
+    def test_combine_parts(self):
+        parts = [os.urandom(n) for n in (5, 0, 300, 1)]
+        self.assertEqual(
+            m.crc64_combine_parts((crc64(p), len(p)) for p in parts),
+            crc64(b"".join(parts)))
+
+
+class SmallSeekableArchiveWriter(m.SeekableArchiveWriter):
+    BLOCK_SIZE = 1000
+
+
+class SeekableArchiveTest(unittest.TestCase):
+
+    def test_get_block_range(self):
+        index = {"blocks": [[0, 0], [100, 10], [250, 20]],
+                 "compressed_size": 400}
+        get = m.SeekableArchiveWriter.get_block_range
+        self.assertEqual(get(index, 0, 10), (0, 100, 0))
+        self.assertEqual(get(index, 5, 11), (0, 250, 0))
+        self.assertEqual(get(index, 10, 20), (100, 250, 10))
+        self.assertEqual(get(index, 15, 25), (100, 400, 10))
+        self.assertEqual(get(index, 20, 20), (250, 400, 20))
+        self.assertEqual(get(index, 25, 100), (250, 400, 20))
+
+    def test_member_range(self):
+        files = {}
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            for i, size in enumerate((0, 1, 999, 1000, 1001, 5000)):
+                files["f%d" % i] = os.urandom(size)
+                info = tarfile.TarInfo("f%d" % i)
+                info.size = size
+                tar.addfile(info, io.BytesIO(files["f%d" % i]))
+        archive = io.BytesIO()
+        index = SmallSeekableArchiveWriter(archive, num_threads=2).build(
+            io.BytesIO(buf.getvalue()))
+        data = archive.getvalue()
+        self.assertEqual(
+            gzip.GzipFile(fileobj=io.BytesIO(data)).read(), buf.getvalue())
+        for name, _, size, _, offset in index["members"]:
+            start, end, block_offset = \
+                m.SeekableArchiveWriter.get_block_range(
+                    index, offset, offset + size)
+            plain = b""
+            chunk = data[start:end]
+            while chunk:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                plain += decompressor.decompress(chunk)
+                chunk = decompressor.unused_data
+            skip = offset - block_offset
+            self.assertEqual(plain[skip:skip + size], files[name])
+
+
+class _Sink(io.BytesIO):
+    """EncryptingWriter结束时会close目标，保留写入的数据"""
+
+    def close(self):
+        return len(self.getvalue())
+
+
+@unittest.skipIf(m.AESGCM is None, "未安装cryptography")
+class BackupCipherTest(unittest.TestCase):
+
+    def setUp(self):
+        class SmallCipher(m.BackupCipher):
+            RECORD_SIZE = 64
+        self.key = os.urandom(32)
+        self.cipher = SmallCipher(self.key)
+
+    def encrypt(self, data, writes=7):
+        sink = _Sink()
+        writer = m.EncryptingWriter(sink, self.cipher, num_threads=2)
+        for i in range(0, len(data), writes):
+            writer.write(data[i:i + writes])
+        writer.close()
+        return sink.getvalue()
+
+    def decrypt(self, data, cipher=None):
+        reader = m.DecryptingReader(io.BytesIO(data), cipher or self.cipher)
+        chunks = []
+        while True:
+            chunk = reader.read(10)
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+
+    def test_round_trip(self):
+        size = self.cipher.RECORD_SIZE
+        for n in (0, 1, size - 1, size, size + 1, size * 3, size * 3 + 1):
+            data = os.urandom(n)
+            self.assertEqual(self.decrypt(self.encrypt(data)), data)
+
+    def test_truncated(self):
+        size = self.cipher.RECORD_SIZE
+        record = size + self.cipher.TAG_SIZE
+        data = self.encrypt(os.urandom(size * 3))
+        for cut in (self.cipher.HEADER_SIZE + record,
+                    self.cipher.HEADER_SIZE + record * 2,
+                    len(data) - 1):
+            self.assertRaises(m.OsError, self.decrypt, data[:cut])
+
+    def test_tampered(self):
+        data = bytearray(self.encrypt(os.urandom(200)))
+        data[self.cipher.HEADER_SIZE + 70] ^= 1
+        self.assertRaises(m.OsError, self.decrypt, bytes(data))
+
+    def test_reordered(self):
+        size = self.cipher.RECORD_SIZE
+        record = size + self.cipher.TAG_SIZE
+        data = self.encrypt(os.urandom(size * 3))
+        head = self.cipher.HEADER_SIZE
+        first = data[head:head + record]
+        second = data[head + record:head + record * 2]
+        swapped = data[:head] + second + first + data[head + record * 2:]
+        self.assertRaises(m.OsError, self.decrypt, swapped)
+
+    def test_wrong_key(self):
+        data = self.encrypt(b"secret")
+        self.assertRaises(m.OsError, self.decrypt, data,
+                          m.BackupCipher(os.urandom(32)))
+
+
+if __name__ == "__main__":
+    unittest.main()